@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import re
+import time
+from functools import partial
+
+from bowtie2_stream import SpikeAlignmentStream
+from demux_engine import BARCODES, build_barcode_lookup
+from fastq_io import (
+    FastqWriter,
+    find_fastq_pairs,
+    open_fastq,
+    ordered_imap,
+    read_pair_chunks,
+    trimmed_output_paths,
+)
+from preprocess_engine import (
+    add_preprocess_stats,
+    new_preprocess_stats,
+    preprocess_block,
+)
+from trim_engine import (
+    MIN_LENGTH,
+    SLIDING_WINDOW,
+    SLIDING_WINDOW_QUALITY,
+    write_trim_report,
+)
+
+
+# Barcode lookup tables, built once per worker process
+_LOOKUPS = {}
+
+
+def preprocess_chunk(chunk, mismatches=1, window=SLIDING_WINDOW,
+                     threshold=SLIDING_WINDOW_QUALITY,
+                     min_length=MIN_LENGTH, clip_adapters=True):
+    """
+    Pool worker: preprocess one record-aligned chunk of raw reads and
+    return the per-barcode outputs as bytes blocks with the statistics.
+    """
+
+    r1_lines, r2_lines = chunk
+
+    if mismatches not in _LOOKUPS:
+        _LOOKUPS[mismatches] = build_barcode_lookup(
+            mismatches=mismatches
+        )
+
+    stats = new_preprocess_stats()
+
+    output = preprocess_block(
+        r1_lines,
+        r2_lines,
+        _LOOKUPS[mismatches],
+        stats,
+        window=window,
+        threshold=threshold,
+        min_length=min_length,
+        clip_adapters=clip_adapters
+    )
+
+    blocks = {
+        barcode: {
+            name: b"".join(lines)
+            for name, lines in barcode_lines.items()
+            if lines
+        }
+        for barcode, barcode_lines in output.items()
+    }
+
+    return blocks, stats
+
+
+def preprocess_pair(input_file, output_dir, pool, chunk_reads,
+                    max_pending, compress, compress_threads=2,
+                    stream=None, **options):
+    """
+    Read one raw R1/R2 pair once and write the final paired/unpaired
+    FASTQ files of every barcode, and their trimming histograms to
+    <output_dir>/logs.
+
+    With <stream> ({"alignment_dir", "index", "threads"}) no FASTQ files
+    are written; the reads of every barcode go straight into its spike
+    RNA alignments of Step 04 (bowtie2_stream.py).
+    """
+
+    name, file_names = input_file
+
+    # e.g. tp1_S1_L001_R1_001.fastq -> tp1_S1_L001
+    base_name = re.sub(r"_R1_001\.fastq(\.gz)?$", "", name)
+
+    stats = new_preprocess_stats()
+
+    writers = {}
+    streams = {}
+
+    preprocess_chunk_partial = partial(
+        preprocess_chunk,
+        **options
+    )
+
+    try:
+
+        for barcode in BARCODES:
+
+            sample = f"{barcode}_{base_name}"
+
+            if stream:
+
+                streams[barcode] = SpikeAlignmentStream(
+                    stream["alignment_dir"],
+                    sample,
+                    stream["index"],
+                    threads=stream["threads"]
+                )
+
+                writers[barcode] = streams[barcode].writers
+
+            else:
+
+                paths = trimmed_output_paths(output_dir, sample, compress)
+
+                writers[barcode] = {
+                    output: FastqWriter(path, threads=compress_threads)
+                    for output, path in paths.items()
+                }
+
+        with open_fastq(file_names["forward"], "rb") as forward_file, \
+             open_fastq(file_names["reverse"], "rb") as reverse_file:
+
+            for blocks, chunk_stats in ordered_imap(
+                pool,
+                preprocess_chunk_partial,
+                read_pair_chunks(forward_file, reverse_file, chunk_reads),
+                max_pending
+            ):
+
+                for barcode, barcode_blocks in blocks.items():
+                    for output, block in barcode_blocks.items():
+                        writers[barcode][output].write(block)
+
+                add_preprocess_stats(stats, chunk_stats)
+
+    except BaseException:
+
+        for spike_stream in streams.values():
+            spike_stream.abort()
+
+        for barcode_writers in writers.values():
+            for writer in barcode_writers.values():
+                writer.abort()
+
+        raise
+
+    for spike_stream in streams.values():
+        spike_stream.close()
+
+    for barcode_writers in writers.values():
+        for writer in barcode_writers.values():
+            writer.close()
+
+    for barcode, histograms in stats["histograms"].items():
+
+        sample = f"{barcode}_{base_name}"
+
+        write_trim_report(
+            os.path.join(output_dir, "logs", f"{sample}_trim_stats.json"),
+            os.path.join(output_dir, "logs", f"{sample}_trim_stats.tsv"),
+            sample,
+            histograms,
+            settings=options
+        )
+
+    report_stats(name, stats)
+
+    return stats
+
+
+def report_stats(name, stats):
+
+    demux = stats["demux"]
+    five_prime = stats["5prime"]
+    quality = stats["quality"]
+
+    def percent(value, total):
+        return (value / total) * 100 if total > 0 else 0
+
+    total = demux["total_reads"]
+    classified = quality["input_pairs"]
+
+    print(f"{name}")
+    print(f"  Read pairs:               {total}")
+    print(
+        f"  Barcode assigned:         {classified} "
+        f"({percent(classified, total):.2f}%, "
+        f"{demux['corrected_barcode']} with 1 mismatch)"
+    )
+    print(
+        f"  Unknown barcode:          {demux['unknown']} "
+        f"({percent(demux['unknown'], total):.2f}%)"
+    )
+    print(
+        f"  R1 trimmed by 5' G/N:     {five_prime['forward_trimmed_5prime']} "
+        f"({percent(five_prime['forward_trimmed_5prime'], classified):.2f}%)"
+    )
+    print(
+        f"  Both surviving:           {quality['both_surviving']} "
+        f"({percent(quality['both_surviving'], classified):.2f}%)"
+    )
+    print(
+        f"  R1 only surviving:        {quality['r1_only_surviving']} "
+        f"({percent(quality['r1_only_surviving'], classified):.2f}%)"
+    )
+    print(
+        f"  R2 only surviving:        {quality['r2_only_surviving']} "
+        f"({percent(quality['r2_only_surviving'], classified):.2f}%)"
+    )
+    print(
+        f"  Dropped:                  {quality['dropped']} "
+        f"({percent(quality['dropped'], classified):.2f}%)"
+    )
+    print()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Single-pass HELIOS NAD-Seq preprocessing: demultiplexing "
+            "with UMI extraction, 5' G/N trimming, adapter and "
+            "sliding-window quality trimming and MINLEN filtering. "
+            "Replaces Steps 01-03 and writes the paired/unpaired FASTQ "
+            "files expected by 04.bowtie2.sh."
+        )
+    )
+
+    parser.add_argument(
+        "input_dir",
+        help="Directory containing raw R1/R2 FASTQ files"
+    )
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Directory for trimmed FASTQ files. "
+            "Default: <parent_of_input_dir>/trimmomatic"
+        )
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of parallel processes"
+    )
+
+    parser.add_argument(
+        "--chunk-reads",
+        type=int,
+        default=200000,
+        help="Read pairs per chunk. Default: 200000"
+    )
+
+    parser.add_argument(
+        "--mismatches",
+        type=int,
+        choices=(0, 1),
+        default=1,
+        help="Mismatches allowed in the barcode. Default: 1"
+    )
+
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=SLIDING_WINDOW,
+        help=f"Sliding window size. Default: {SLIDING_WINDOW}"
+    )
+
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=SLIDING_WINDOW_QUALITY,
+        help=(
+            "Required average window quality. "
+            f"Default: {SLIDING_WINDOW_QUALITY}"
+        )
+    )
+
+    parser.add_argument(
+        "--min-length",
+        type=int,
+        default=MIN_LENGTH,
+        help=f"Minimum read length after trimming. Default: {MIN_LENGTH}"
+    )
+
+    parser.add_argument(
+        "--no-adapter-clip",
+        action="store_true",
+        help="Do not clip TruSeq adapter read-through."
+    )
+
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Write BGZF-compressed .fastq.gz output."
+    )
+
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=2,
+        help=(
+            "Background compression threads per output file "
+            "with --gzip. Default: 2"
+        )
+    )
+
+    parser.add_argument(
+        "--stream",
+        metavar="ALIGNMENT_DIR",
+        default=None,
+        help=(
+            "Do not write trimmed FASTQ files; stream the reads through "
+            "named pipes into the spike RNA alignments of Step 04, "
+            "written to ALIGNMENT_DIR/<sample>. Requires --spike-index. "
+            "Run 04.bowtie2.sh on the same alignment directory "
+            "afterwards for the remaining stages."
+        )
+    )
+
+    parser.add_argument(
+        "--spike-index",
+        default=None,
+        help="Bowtie2 index of the spike RNAs for --stream"
+    )
+
+    parser.add_argument(
+        "--bowtie2-threads",
+        type=int,
+        default=1,
+        help="Threads per bowtie2 process with --stream. Default: 1"
+    )
+
+    args = parser.parse_args()
+
+    if args.chunk_reads < 1:
+        raise ValueError(
+            "--chunk-reads must be at least 1."
+        )
+
+    if args.stream and not args.spike_index:
+        raise ValueError(
+            "--stream requires --spike-index."
+        )
+
+    start_time = time.perf_counter()
+
+    input_dir = os.path.abspath(args.input_dir)
+
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(
+            f"Input directory does not exist: {input_dir}"
+        )
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(input_dir),
+            "trimmomatic"
+        )
+
+    os.makedirs(os.path.join(output_dir, "logs"), exist_ok=True)
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Steps 01-03 - Preprocessing")
+    print("========================================")
+    print(f"Input directory:  {input_dir}")
+    print(f"Output directory: {output_dir}")
+    print(f"Processes:        {args.threads}")
+    print(f"Mismatches:       {args.mismatches}")
+    print(
+        f"Quality trimming: SLIDINGWINDOW:{args.window}:{args.quality} "
+        f"MINLEN:{args.min_length}"
+    )
+    print(f"Adapter clipping: {not args.no_adapter_clip}")
+
+    stream = None
+
+    if args.stream:
+        stream = {
+            "alignment_dir": os.path.abspath(args.stream),
+            "index": args.spike_index,
+            "threads": args.bowtie2_threads,
+        }
+
+        print(f"Streaming into:   {stream['alignment_dir']}")
+
+    print("========================================")
+
+    input_files, unpaired_files = find_fastq_pairs(input_dir)
+
+    for forward_file in unpaired_files:
+        print(
+            f"WARNING: No matching R2 file found for "
+            f"{forward_file}"
+        )
+
+    if not input_files:
+        raise RuntimeError(
+            "No valid R1/R2 FASTQ pairs were found."
+        )
+
+    print(f"FASTQ pairs found: {len(input_files)}")
+    print()
+
+    with multiprocessing.Pool(
+        processes=args.threads
+    ) as pool:
+
+        for input_file in input_files.items():
+
+            preprocess_pair(
+                input_file,
+                output_dir,
+                pool,
+                args.chunk_reads,
+                max_pending=2 * args.threads,
+                compress=args.gzip,
+                compress_threads=args.compress_threads,
+                stream=stream,
+                mismatches=args.mismatches,
+                window=args.window,
+                threshold=args.quality,
+                min_length=args.min_length,
+                clip_adapters=not args.no_adapter_clip
+            )
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print("========================================")
+    print(f"Preprocessing completed in {elapsed_time:.2f} seconds.")
+    print(f"Output directory: {output_dir}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
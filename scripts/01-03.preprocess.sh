@@ -0,0 +1,75 @@
+#!/bin/bash
+
+#SBATCH -N 1
+#SBATCH --mem=90000
+#SBATCH -t 8:00:00
+#SBATCH -p cpu-single
+
+# ============================================================
+# HELIOS NAD-Seq pipeline
+# Steps 01-03 (alternative): single-pass preprocessing
+#
+# Replaces 01.cutadapt.sh, 02.5prime_trim.sh and
+# 03.trimmomatic.sh. Raw R1/R2 reads are read once: demultiplexed
+# with UMIs, G/N-trimmed, adapter/quality-trimmed and filtered by
+# length, and written as the paired/unpaired FASTQ files used by
+# 04.bowtie2.sh.
+#
+# Usage:
+#   sbatch scripts/01-03.preprocess.sh <FASTQ_DIR> [OUTPUT_DIR] [OPTIONS]
+#
+# Example:
+#   sbatch scripts/01-03.preprocess.sh /path/to/fastq
+#
+# Optional output directory:
+#   sbatch scripts/01-03.preprocess.sh \
+#       /path/to/fastq \
+#       results/trimmomatic
+#
+# Any further options are passed to 01-03.preprocess.py, e.g.
+#   --threads 32 --gzip --min-length 20
+# ============================================================
+
+
+# Check that an input directory was provided
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 <FASTQ_DIR> [OUTPUT_DIR] [OPTIONS]"
+    exit 1
+fi
+
+
+# Input and optional output directories
+input_dir="$1"
+shift
+
+output_dir=""
+
+if [[ $# -ge 1 && "$1" != --* ]]; then
+    output_dir="$1"
+    shift
+fi
+
+# Remaining arguments are options for 01-03.preprocess.py
+preprocess_options=("$@")
+
+
+# Activate Conda environment
+source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+conda activate env.helios.yml
+
+
+# Run preprocessing
+if [ -n "$output_dir" ]; then
+
+    python scripts/01-03.preprocess.py \
+        "$input_dir" \
+        "$output_dir" \
+        "${preprocess_options[@]}"
+
+else
+
+    python scripts/01-03.preprocess.py \
+        "$input_dir" \
+        "${preprocess_options[@]}"
+
+fi
@@ -62,9 +62,10 @@ echo "Cutadapt output directory: $end_dir"
 cd "$start_dir" || exit 1
 
 
-# Find paired-end FASTQ files
-forward_reads=(*R1*.fastq)
-reverse_reads=(*R2*.fastq)
+# Find paired-end FASTQ files (.fastq or .fastq.gz)
+shopt -s nullglob
+forward_reads=(*R1*.fastq *R1*.fastq.gz)
+reverse_reads=(*R2*.fastq *R2*.fastq.gz)
 
 
 # Check that FASTQ files were found
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import time
+from functools import partial
+
+from demux_engine import (
+    BARCODES,
+    UNKNOWN,
+    add_demux_stats,
+    build_barcode_lookup,
+    demux_block,
+    new_demux_stats,
+)
+from fastq_io import (
+    FastqWriter,
+    fastq_output_path,
+    find_fastq_pairs,
+    open_fastq,
+    ordered_imap,
+    read_pair_chunks,
+)
+
+
+# Barcode lookup tables, built once per worker process
+_LOOKUPS = {}
+
+
+def demux_chunk(chunk, mismatches=1):
+    """
+    Pool worker: demultiplex one record-aligned chunk and return the
+    per-barcode output as bytes blocks together with the statistics.
+    """
+
+    r1_lines, r2_lines = chunk
+
+    if mismatches not in _LOOKUPS:
+        _LOOKUPS[mismatches] = build_barcode_lookup(
+            mismatches=mismatches
+        )
+
+    stats = new_demux_stats()
+
+    output = demux_block(
+        r1_lines,
+        r2_lines,
+        _LOOKUPS[mismatches],
+        stats
+    )
+
+    blocks = {
+        barcode: (b"".join(r1_out), b"".join(r2_out))
+        for barcode, (r1_out, r2_out) in output.items()
+    }
+
+    barcode_counts = {
+        barcode: len(r1_out) // 4
+        for barcode, (r1_out, r2_out) in output.items()
+    }
+
+    return blocks, stats, barcode_counts
+
+
+def demultiplex_pair(input_file, output_dir, pool, chunk_reads,
+                     max_pending, mismatches=1, compress=None,
+                     compress_threads=2):
+    """
+    Demultiplex one R1/R2 pair in a single pass.
+
+    Chunks are classified on every process of <pool> and written to the
+    per-barcode outputs in their original order. Output files are named
+    like the Cutadapt output of Step 01: <barcode>_<input basename>.
+    """
+
+    name, file_names = input_file
+
+    stats = new_demux_stats()
+    barcode_counts = {
+        barcode: 0
+        for barcode in list(BARCODES) + [UNKNOWN]
+    }
+
+    writers = {}
+
+    for barcode in barcode_counts:
+
+        paths = {}
+
+        for read in ("forward", "reverse"):
+
+            path = os.path.join(
+                output_dir,
+                f"{barcode}_{os.path.basename(file_names[read])}"
+            )
+
+            if compress is not None:
+                path = fastq_output_path(path, compress)
+
+            paths[read] = path
+
+        writers[barcode] = (
+            FastqWriter(paths["forward"], threads=compress_threads),
+            FastqWriter(paths["reverse"], threads=compress_threads)
+        )
+
+    demux_chunk_partial = partial(
+        demux_chunk,
+        mismatches=mismatches
+    )
+
+    try:
+
+        with open_fastq(file_names["forward"], "rb") as forward_file, \
+             open_fastq(file_names["reverse"], "rb") as reverse_file:
+
+            for blocks, chunk_stats, chunk_counts in ordered_imap(
+                pool,
+                demux_chunk_partial,
+                read_pair_chunks(forward_file, reverse_file, chunk_reads),
+                max_pending
+            ):
+
+                for barcode, (r1_block, r2_block) in blocks.items():
+                    writers[barcode][0].write(r1_block)
+                    writers[barcode][1].write(r2_block)
+
+                add_demux_stats(stats, chunk_stats)
+                add_demux_stats(barcode_counts, chunk_counts)
+
+    except BaseException:
+
+        for forward_out, reverse_out in writers.values():
+            forward_out.abort()
+            reverse_out.abort()
+
+        raise
+
+    for forward_out, reverse_out in writers.values():
+        forward_out.close()
+        reverse_out.close()
+
+    report_stats(name, stats, barcode_counts)
+
+    return stats
+
+
+def report_stats(name, stats, barcode_counts):
+
+    total_reads = stats["total_reads"]
+
+    def percent(value):
+        return (value / total_reads) * 100 if total_reads > 0 else 0
+
+    print(f"{name}")
+    print(f"  Read pairs:             {total_reads}")
+    print(
+        f"  Exact barcode:          {stats['exact_barcode']} "
+        f"({percent(stats['exact_barcode']):.2f}%)"
+    )
+    print(
+        f"  1-mismatch barcode:     {stats['corrected_barcode']} "
+        f"({percent(stats['corrected_barcode']):.2f}%)"
+    )
+    print(
+        f"  Unknown:                {stats['unknown']} "
+        f"({percent(stats['unknown']):.2f}%)"
+    )
+    print(
+        f"  R1 3' adapter trimmed:  {stats['r1_adapter_trimmed']} "
+        f"({percent(stats['r1_adapter_trimmed']):.2f}%)"
+    )
+
+    for barcode, count in barcode_counts.items():
+        print(
+            f"  {barcode:8s} {count:12d} ({percent(count):.2f}%)"
+        )
+
+    print()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Demultiplex HELIOS NAD-Seq FASTQ pairs by the R2 barcode "
+            "and move the random adapter region into the read name "
+            "as a UMI. In-process replacement for 01.cutadapt.sh."
+        )
+    )
+
+    parser.add_argument(
+        "input_dir",
+        help="Directory containing raw R1/R2 FASTQ files"
+    )
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Directory for demultiplexed FASTQ files. "
+            "Default: <parent_of_input_dir>/demultiplexed"
+        )
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Number of parallel processes"
+    )
+
+    parser.add_argument(
+        "--chunk-reads",
+        type=int,
+        default=200000,
+        help="Read pairs per chunk. Default: 200000"
+    )
+
+    parser.add_argument(
+        "--mismatches",
+        type=int,
+        choices=(0, 1),
+        default=1,
+        help="Mismatches allowed in the barcode. Default: 1"
+    )
+
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help=(
+            "Write BGZF-compressed .fastq.gz output. By default the "
+            "output is compressed if the input is."
+        )
+    )
+
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=2,
+        help=(
+            "Background compression threads per output file "
+            "for compressed output. Default: 2"
+        )
+    )
+
+    args = parser.parse_args()
+
+    if args.chunk_reads < 1:
+        raise ValueError(
+            "--chunk-reads must be at least 1."
+        )
+
+    start_time = time.perf_counter()
+
+    input_dir = os.path.abspath(args.input_dir)
+
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(
+            f"Input directory does not exist: {input_dir}"
+        )
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(input_dir),
+            "demultiplexed"
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Step 01 - Demultiplexing")
+    print("========================================")
+    print(f"Input directory:  {input_dir}")
+    print(f"Output directory: {output_dir}")
+    print(f"Processes:        {args.threads}")
+    print(f"Mismatches:       {args.mismatches}")
+    print("========================================")
+
+    input_files, unpaired_files = find_fastq_pairs(input_dir)
+
+    for forward_file in unpaired_files:
+        print(
+            f"WARNING: No matching R2 file found for "
+            f"{forward_file}"
+        )
+
+    if not input_files:
+        raise RuntimeError(
+            "No valid R1/R2 FASTQ pairs were found."
+        )
+
+    print(f"FASTQ pairs found: {len(input_files)}")
+    print()
+
+    with multiprocessing.Pool(
+        processes=args.threads
+    ) as pool:
+
+        for input_file in input_files.items():
+
+            demultiplex_pair(
+                input_file,
+                output_dir,
+                pool,
+                args.chunk_reads,
+                max_pending=2 * args.threads,
+                mismatches=args.mismatches,
+                compress=True if args.gzip else None,
+                compress_threads=args.compress_threads
+            )
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print("========================================")
+    print(f"Demultiplexing completed in {elapsed_time:.2f} seconds.")
+    print(f"Output directory: {output_dir}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
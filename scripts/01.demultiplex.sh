@@ -0,0 +1,73 @@
+#!/bin/bash
+
+#SBATCH -N 1
+#SBATCH --mem=90000
+#SBATCH -t 8:00:00
+#SBATCH -p cpu-single
+
+# ============================================================
+# HELIOS NAD-Seq pipeline
+# Step 01 (alternative): in-process demultiplexing with UMIs
+#
+# Replaces 01.cutadapt.sh. Reads are assigned to barcodes by an
+# exact/1-mismatch lookup of the R2 prefix, and the random
+# adapter region is appended to the read names as a UMI.
+#
+# Usage:
+#   sbatch scripts/01.demultiplex.sh <FASTQ_DIR> [OUTPUT_DIR] [OPTIONS]
+#
+# Example:
+#   sbatch scripts/01.demultiplex.sh /path/to/fastq
+#
+# Optional output directory:
+#   sbatch scripts/01.demultiplex.sh \
+#       /path/to/fastq \
+#       results/demultiplexed
+#
+# Any further options are passed to 01.demultiplex.py, e.g.
+#   --threads 32 --mismatches 0
+# ============================================================
+
+
+# Check that an input directory was provided
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 <FASTQ_DIR> [OUTPUT_DIR] [OPTIONS]"
+    exit 1
+fi
+
+
+# Input and optional output directories
+input_dir="$1"
+shift
+
+output_dir=""
+
+if [[ $# -ge 1 && "$1" != --* ]]; then
+    output_dir="$1"
+    shift
+fi
+
+# Remaining arguments are options for 01.demultiplex.py
+demux_options=("$@")
+
+
+# Activate Conda environment
+source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+conda activate env.helios.yml
+
+
+# Run demultiplexing
+if [ -n "$output_dir" ]; then
+
+    python scripts/01.demultiplex.py \
+        "$input_dir" \
+        "$output_dir" \
+        "${demux_options[@]}"
+
+else
+
+    python scripts/01.demultiplex.py \
+        "$input_dir" \
+        "${demux_options[@]}"
+
+fi
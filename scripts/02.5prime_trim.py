@@ -1,110 +1,74 @@
-import regex as re
 import time
 import os
 import multiprocessing
 from functools import partial
-import glob
+from collections import deque
 import argparse
 
+from fastq_io import (
+    fastq_output_path,
+    find_fastq_pairs,
+    FastqWriter,
+    open_fastq,
+    ordered_imap,
+    read_pair_chunks,
+)
+from trim_engine import (
+    add_trim_stats,
+    new_trim_stats,
+    trim_5prime_block,
+)
 
-def trim(input_file, output_files, adapter_keys=None):
-    total_reads = 0
-    short_reads = 0
-    forward_trimmed_5prime = 0
-    forward_tot_length = 0
 
-    bc, file_names = input_file
-
-    # Dictionary of adapters
-    adapters = {
-        "forward_5prime": r"^[GN]*",
-    }
-
-    # Initialize compiled adapters
-    compiled_adapters = {key: re.compile("") for key in adapters}
-
-    if adapter_keys:
-        if isinstance(adapter_keys, str):
-            adapter_keys = [adapter_keys]
-
-        for key in adapter_keys:
-            if key in adapters:
-                compiled_adapters[key] = re.compile(adapters[key])
-
-    forward_buffer = []
-    reverse_buffer = []
-    buffer_size = 25000
-
-    with open(file_names["forward"], "r") as forward_file, \
-         open(file_names["reverse"], "r") as reverse_file:
-
-        while True:
-            forward_lines = [next(forward_file, None) for _ in range(4)]
-            reverse_lines = [next(reverse_file, None) for _ in range(4)]
-
-            if None in forward_lines or None in reverse_lines:
-                break
-
-            total_reads += 1
+# Adapters that can be trimmed from the reads
+ADAPTERS = {
+    "forward_5prime": "^[GN]*",
+}
 
-            adapter_object = compiled_adapters["forward_5prime"]
 
-            if adapter_object.pattern != "":
-                match_forward_5prime = adapter_object.search(
-                    forward_lines[1].strip()
-                )
-
-                if match_forward_5prime:
-                    end_index = match_forward_5prime.end()
-
-                    # Trim sequence
-                    sequence = forward_lines[1].strip()
-                    quality = forward_lines[3].strip()
+def selected_adapters(adapter_keys=None):
+    """
+    Return the set of requested adapter keys. Adapters that are not
+    requested leave reads untouched.
+    """
 
-                    sequence = sequence[end_index:]
-                    quality = quality[end_index:]
+    if not adapter_keys:
+        return set()
 
-                    forward_lines[1] = sequence + "\n"
-                    forward_lines[3] = quality + "\n"
+    if isinstance(adapter_keys, str):
+        adapter_keys = [adapter_keys]
 
-                    if end_index != 0:
-                        forward_trimmed_5prime += 1
+    return {key for key in adapter_keys if key in ADAPTERS}
 
-            # Length after trimming
-            trimmed_length = len(forward_lines[1].strip())
-            forward_tot_length += trimmed_length
 
-            if trimmed_length < 18:
-                short_reads += 1
+def trim_chunk(forward_lines, adapter_keys=None):
+    """
+    Pool worker for chunked mode: trim the forward lines of one
+    record-aligned chunk and return them as a single bytes block
+    together with the chunk statistics.
+    """
 
-            forward_buffer.extend(forward_lines)
-            reverse_buffer.extend(reverse_lines)
+    stats = new_trim_stats()
 
-            if len(forward_buffer) >= buffer_size * 4:
-                with open(output_files[bc]["forward"], "a") as forward_out, \
-                     open(output_files[bc]["reverse"], "a") as reverse_out:
-
-                    forward_out.writelines(forward_buffer)
-                    reverse_out.writelines(reverse_buffer)
+    trim_5prime_block(
+        forward_lines,
+        stats,
+        trim_5prime="forward_5prime" in selected_adapters(adapter_keys)
+    )
 
-                forward_buffer = []
-                reverse_buffer = []
+    return b"".join(forward_lines), stats
 
-        # Write remaining reads
-        if forward_buffer:
-            with open(output_files[bc]["forward"], "a") as forward_out, \
-                 open(output_files[bc]["reverse"], "a") as reverse_out:
 
-                forward_out.writelines(forward_buffer)
-                reverse_out.writelines(reverse_buffer)
+def report_stats(bc, stats):
+    total_reads = stats["total_reads"]
 
     # Calculate statistics
     if total_reads > 0:
-        forward_average_length = forward_tot_length / total_reads
+        forward_average_length = stats["forward_tot_length"] / total_reads
         percent_forward_trimmed_5prime = (
-            forward_trimmed_5prime / total_reads
+            stats["forward_trimmed_5prime"] / total_reads
         ) * 100
-        percent_short = (short_reads / total_reads) * 100
+        percent_short = (stats["short_reads"] / total_reads) * 100
     else:
         forward_average_length = 0
         percent_forward_trimmed_5prime = 0
@@ -124,6 +88,104 @@ def trim(input_file, output_files, adapter_keys=None):
     )
 
 
+def trim(input_file, output_files, adapter_keys=None, compress_threads=2):
+    stats = new_trim_stats()
+
+    bc, file_names = input_file
+
+    trim_5prime = "forward_5prime" in selected_adapters(adapter_keys)
+
+    buffer_size = 25000
+
+    # Output handles stay open for the whole pair; blocks are written
+    # by the writer threads while the next block is trimmed.
+    with open_fastq(file_names["forward"], "rb") as forward_file, \
+         open_fastq(file_names["reverse"], "rb") as reverse_file, \
+         FastqWriter(
+             output_files[bc]["forward"],
+             threads=compress_threads
+         ) as forward_out, \
+         FastqWriter(
+             output_files[bc]["reverse"],
+             threads=compress_threads
+         ) as reverse_out:
+
+        for forward_lines, reverse_lines in read_pair_chunks(
+            forward_file,
+            reverse_file,
+            buffer_size
+        ):
+
+            trim_5prime_block(
+                forward_lines,
+                stats,
+                trim_5prime=trim_5prime
+            )
+
+            forward_out.write(b"".join(forward_lines))
+            reverse_out.write(b"".join(reverse_lines))
+
+    report_stats(bc, stats)
+
+
+def trim_chunked(input_file, output_files, pool, chunk_reads,
+                 max_pending, adapter_keys=None, compress_threads=2):
+    """
+    Trim a single FASTQ pair using every worker of <pool>.
+
+    The pair is split into record-aligned chunks of <chunk_reads> read
+    pairs. Forward chunks are trimmed in parallel and written back in
+    their original order, so the output is identical to trim(). Reverse
+    reads are not modified and stay in the main process.
+    """
+
+    stats = new_trim_stats()
+
+    bc, file_names = input_file
+
+    trim_chunk_partial = partial(
+        trim_chunk,
+        adapter_keys=adapter_keys
+    )
+
+    with open_fastq(file_names["forward"], "rb") as forward_file, \
+         open_fastq(file_names["reverse"], "rb") as reverse_file, \
+         FastqWriter(
+             output_files[bc]["forward"],
+             threads=compress_threads
+         ) as forward_out, \
+         FastqWriter(
+             output_files[bc]["reverse"],
+             threads=compress_threads
+         ) as reverse_out:
+
+        # Reverse chunks of the forward chunks in flight, in order
+        reverse_chunks = deque()
+
+        def forward_chunks():
+            for forward_lines, reverse_lines in read_pair_chunks(
+                forward_file,
+                reverse_file,
+                chunk_reads
+            ):
+                reverse_chunks.append(reverse_lines)
+                yield forward_lines
+
+        for forward_block, chunk_stats in ordered_imap(
+            pool,
+            trim_chunk_partial,
+            forward_chunks(),
+            max_pending
+        ):
+
+            forward_out.write(forward_block)
+            reverse_out.write(b"".join(reverse_chunks.popleft()))
+
+            add_trim_stats(stats, chunk_stats)
+
+    report_stats(bc, stats)
+
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -155,8 +217,53 @@ def main():
         help="Number of parallel processes"
     )
 
+    parser.add_argument(
+        "--chunked",
+        action="store_true",
+        help=(
+            "Process FASTQ pairs one at a time and split each pair "
+            "into record-aligned chunks that are trimmed on all "
+            "processes. Use this when a few large pairs dominate "
+            "the run time."
+        )
+    )
+
+    parser.add_argument(
+        "--chunk-reads",
+        type=int,
+        default=200000,
+        help=(
+            "Read pairs per chunk in --chunked mode. "
+            "Default: 200000"
+        )
+    )
+
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help=(
+            "Write BGZF-compressed *_trimmed.fastq.gz output. "
+            "Compressed input is always detected from the .gz suffix."
+        )
+    )
+
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=2,
+        help=(
+            "Background compression threads per output file "
+            "with --gzip. Default: 2"
+        )
+    )
+
     args = parser.parse_args()
 
+    if args.chunk_reads < 1:
+        raise ValueError(
+            "--chunk-reads must be at least 1."
+        )
+
     start_time = time.perf_counter()
 
     # Convert to absolute paths
@@ -181,44 +288,18 @@ def main():
     print(f"Input directory:  {input_dir}")
     print(f"Output directory: {output_dir}")
     print(f"Processes:        {args.threads}")
+    print(f"Chunked mode:     {args.chunked}")
+    print(f"Gzip output:      {args.gzip}")
 
-    # Find R1 and R2 files
-    all_forward_files = sorted(
-        glob.glob(os.path.join(input_dir, "*R1*.fastq"))
-    )
-
-    all_reverse_files = set(
-        glob.glob(os.path.join(input_dir, "*R2*.fastq"))
-    )
+    # Find R1 and R2 files (.fastq or .fastq.gz)
+    input_files, unpaired_files = find_fastq_pairs(input_dir)
 
-    if not all_forward_files:
-        raise FileNotFoundError(
-            f"No R1 FASTQ files found in {input_dir}"
-        )
-
-    # Pair R1 and R2 files
-    input_files = {}
-
-    for forward_file in all_forward_files:
-
-        reverse_file = forward_file.replace(
-            "R1_001.fastq",
-            "R2_001.fastq"
+    for forward_file in unpaired_files:
+        print(
+            f"WARNING: No matching R2 file found for "
+            f"{forward_file}"
         )
 
-        if reverse_file in all_reverse_files:
-            sample_name = os.path.basename(forward_file)
-
-            input_files[sample_name] = {
-                "forward": forward_file,
-                "reverse": reverse_file
-            }
-        else:
-            print(
-                f"WARNING: No matching R2 file found for "
-                f"{forward_file}"
-            )
-
     if not input_files:
         raise RuntimeError(
             "No valid R1/R2 FASTQ pairs were found."
@@ -246,36 +327,54 @@ def main():
         )
 
         output_files[name] = {
-            "forward": os.path.join(
-                output_dir,
-                forward_basename
+            "forward": fastq_output_path(
+                os.path.join(output_dir, forward_basename),
+                args.gzip
             ),
-            "reverse": os.path.join(
-                output_dir,
-                reverse_basename
+            "reverse": fastq_output_path(
+                os.path.join(output_dir, reverse_basename),
+                args.gzip
             )
         }
 
-        # Prevent accidental appending to previous output
-        for output_file in output_files[name].values():
-            if os.path.exists(output_file):
-                os.remove(output_file)
+    if args.chunked:
 
-    trim_partial = partial(
-        trim,
-        output_files=output_files,
-        adapter_keys=["forward_5prime"]
-    )
+        # One pair at a time, every process works on chunks
+        # of the same pair.
+        with multiprocessing.Pool(
+            processes=args.threads
+        ) as pool:
+
+            for input_file in input_files.items():
+
+                trim_chunked(
+                    input_file,
+                    output_files,
+                    pool,
+                    args.chunk_reads,
+                    max_pending=2 * args.threads,
+                    adapter_keys=["forward_5prime"],
+                    compress_threads=args.compress_threads
+                )
 
-    with multiprocessing.Pool(
-        processes=args.threads
-    ) as pool:
+    else:
 
-        pool.map(
-            trim_partial,
-            input_files.items()
+        trim_partial = partial(
+            trim,
+            output_files=output_files,
+            adapter_keys=["forward_5prime"],
+            compress_threads=args.compress_threads
         )
 
+        with multiprocessing.Pool(
+            processes=args.threads
+        ) as pool:
+
+            pool.map(
+                trim_partial,
+                input_files.items()
+            )
+
     end_time = time.perf_counter()
     elapsed_time = end_time - start_time
 
@@ -10,7 +10,7 @@
 # Step 02: 5' trimming
 #
 # Usage:
-#   sbatch scripts/02.5prime_trim.sh <CUTADAPT_DIR> [OUTPUT_DIR]
+#   sbatch scripts/02.5prime_trim.sh <CUTADAPT_DIR> [OUTPUT_DIR] [OPTIONS]
 #
 # Example:
 #   sbatch scripts/02.5prime_trim.sh results/cutadapt
@@ -19,19 +19,36 @@
 #   sbatch scripts/02.5prime_trim.sh \
 #       results/cutadapt \
 #       results/5prime_trimmed
+#
+# Any further options are passed to 02.5prime_trim.py, e.g.
+# chunked trimming of a few large FASTQ pairs:
+#   sbatch scripts/02.5prime_trim.sh \
+#       results/cutadapt \
+#       results/5prime_trimmed \
+#       --chunked --threads 32
 # ============================================================
 
 
 # Check that an input directory was provided
 if [ $# -lt 1 ]; then
-    echo "Usage: $0 <CUTADAPT_DIR> [OUTPUT_DIR]"
+    echo "Usage: $0 <CUTADAPT_DIR> [OUTPUT_DIR] [OPTIONS]"
     exit 1
 fi
 
 
 # Input and optional output directories
 input_dir="$1"
-output_dir="$2"
+shift
+
+output_dir=""
+
+if [[ $# -ge 1 && "$1" != --* ]]; then
+    output_dir="$1"
+    shift
+fi
+
+# Remaining arguments are options for 02.5prime_trim.py
+trim_options=("$@")
 
 
 # Activate Conda environment
@@ -58,12 +75,14 @@ if [ -n "$output_dir" ]; then
 
     python scripts/02.5prime_trim.py \
         "$input_dir" \
-        "$output_dir"
+        "$output_dir" \
+        "${trim_options[@]}"
 
 else
 
     python scripts/02.5prime_trim.py \
-        "$input_dir"
+        "$input_dir" \
+        "${trim_options[@]}"
 
 fi
 
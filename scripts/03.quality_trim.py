@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+import argparse
+import multiprocessing
+import os
+import re
+import time
+
+from bowtie2_stream import SpikeAlignmentStream, stage_complete
+from fastq_io import (
+    FastqWriter,
+    find_fastq_pairs,
+    is_gzipped,
+    open_fastq,
+    read_pair_chunks,
+    trimmed_output_paths,
+)
+from trim_engine import (
+    MIN_LENGTH,
+    SLIDING_WINDOW,
+    SLIDING_WINDOW_QUALITY,
+    add_trim_stats,
+    new_pair_histograms,
+    new_quality_stats,
+    quality_trim_pair_block,
+    write_trim_report,
+)
+
+
+def trim_sample(job):
+    """
+    Pool worker: quality-trim one Step 02 R1/R2 pair and write its
+    paired/unpaired outputs. Samples whose outputs all exist are skipped.
+
+    Trimming histograms are written to <output_dir>/logs as
+    <sample>_trim_stats.json and <sample>_trim_stats.tsv.
+
+    In stream mode the reads go straight into the spike RNA alignments
+    of Step 04 instead of FASTQ files; samples whose spike stage is
+    complete are skipped.
+
+    Returns (name, stats), with stats None for skipped samples.
+    """
+
+    name, file_names, output_dir, compress, options = job
+
+    # e.g. bc01_tp1_S1_L001_R1_001_trimmed.fastq -> bc01_tp1_S1_L001
+    base_name = re.sub(r"_R1_001_trimmed\.fastq(\.gz)?$", "", name)
+
+    if compress is None:
+        compress = is_gzipped(file_names["forward"])
+
+    stream = options["stream"]
+
+    if stream:
+
+        if stage_complete(stream["alignment_dir"], base_name, "spike"):
+            return base_name, None
+
+    else:
+
+        paths = trimmed_output_paths(output_dir, base_name, compress)
+
+        if all(os.path.isfile(path) for path in paths.values()):
+            return base_name, None
+
+    stats = new_quality_stats()
+    histograms = new_pair_histograms()
+
+    if stream:
+
+        spike_stream = SpikeAlignmentStream(
+            stream["alignment_dir"],
+            base_name,
+            stream["index"],
+            threads=stream["threads"]
+        )
+
+        writers = spike_stream.writers
+
+    else:
+
+        spike_stream = None
+
+        writers = {
+            output: FastqWriter(path, threads=options["compress_threads"])
+            for output, path in paths.items()
+        }
+
+    try:
+
+        with open_fastq(file_names["forward"], "rb") as forward_file, \
+             open_fastq(file_names["reverse"], "rb") as reverse_file:
+
+            for r1_lines, r2_lines in read_pair_chunks(
+                forward_file,
+                reverse_file,
+                options["chunk_reads"]
+            ):
+
+                chunk_stats = new_quality_stats()
+
+                output = quality_trim_pair_block(
+                    r1_lines,
+                    r2_lines,
+                    chunk_stats,
+                    window=options["window"],
+                    threshold=options["threshold"],
+                    min_length=options["min_length"],
+                    clip_adapters=options["clip_adapters"],
+                    histograms=histograms
+                )
+
+                for output_name, lines in output.items():
+                    if lines:
+                        writers[output_name].write(b"".join(lines))
+
+                add_trim_stats(stats, chunk_stats)
+
+    except BaseException:
+
+        if spike_stream is not None:
+            spike_stream.abort()
+        else:
+            for writer in writers.values():
+                writer.abort()
+
+        raise
+
+    if spike_stream is not None:
+        spike_stream.close()
+    else:
+        for writer in writers.values():
+            writer.close()
+
+    log_dir = os.path.join(output_dir, "logs")
+
+    write_trim_report(
+        os.path.join(log_dir, f"{base_name}_trim_stats.json"),
+        os.path.join(log_dir, f"{base_name}_trim_stats.tsv"),
+        base_name,
+        histograms,
+        stats=stats,
+        settings=options["settings"]
+    )
+
+    return base_name, stats
+
+
+def report_stats(name, stats):
+
+    total = stats["input_pairs"]
+
+    def percent(value):
+        return (value / total) * 100 if total > 0 else 0
+
+    print(f"{name}")
+    print(f"  Input read pairs:   {total}")
+    print(
+        f"  Both surviving:     {stats['both_surviving']} "
+        f"({percent(stats['both_surviving']):.2f}%)"
+    )
+    print(
+        f"  Forward only:       {stats['r1_only_surviving']} "
+        f"({percent(stats['r1_only_surviving']):.2f}%)"
+    )
+    print(
+        f"  Reverse only:       {stats['r2_only_surviving']} "
+        f"({percent(stats['r2_only_surviving']):.2f}%)"
+    )
+    print(
+        f"  Dropped:            {stats['dropped']} "
+        f"({percent(stats['dropped']):.2f}%)"
+    )
+    print()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "HELIOS NAD-Seq Step 03: paired-end adapter clipping, "
+            "sliding-window quality trimming and MINLEN filtering of "
+            "the Step 02 output. In-process replacement for "
+            "03.trimmomatic.sh with the same output files."
+        )
+    )
+
+    parser.add_argument(
+        "input_dir",
+        help="Directory containing Step 02 *_R1_001_trimmed.fastq files"
+    )
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Directory for trimmed FASTQ files. "
+            "Default: <parent_of_input_dir>/trimmomatic"
+        )
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Samples trimmed in parallel"
+    )
+
+    parser.add_argument(
+        "--chunk-reads",
+        type=int,
+        default=100000,
+        help="Read pairs trimmed per batch. Default: 100000"
+    )
+
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=SLIDING_WINDOW,
+        help=f"Sliding window size. Default: {SLIDING_WINDOW}"
+    )
+
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=SLIDING_WINDOW_QUALITY,
+        help=(
+            "Required average window quality. "
+            f"Default: {SLIDING_WINDOW_QUALITY}"
+        )
+    )
+
+    parser.add_argument(
+        "--min-length",
+        type=int,
+        default=MIN_LENGTH,
+        help=f"Minimum read length after trimming. Default: {MIN_LENGTH}"
+    )
+
+    parser.add_argument(
+        "--no-adapter-clip",
+        action="store_true",
+        help="Do not clip TruSeq adapter read-through."
+    )
+
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help=(
+            "Write BGZF-compressed .fastq.gz output. By default the "
+            "output is compressed if the input is."
+        )
+    )
+
+    parser.add_argument(
+        "--compress-threads",
+        type=int,
+        default=2,
+        help=(
+            "Background compression threads per output file "
+            "for compressed output. Default: 2"
+        )
+    )
+
+    parser.add_argument(
+        "--stream",
+        metavar="ALIGNMENT_DIR",
+        default=None,
+        help=(
+            "Do not write trimmed FASTQ files; stream the reads through "
+            "named pipes into the spike RNA alignments of Step 04, "
+            "written to ALIGNMENT_DIR/<sample>. Requires --spike-index. "
+            "Run 04.bowtie2.sh on the same alignment directory "
+            "afterwards for the remaining stages."
+        )
+    )
+
+    parser.add_argument(
+        "--spike-index",
+        default=None,
+        help="Bowtie2 index of the spike RNAs for --stream"
+    )
+
+    parser.add_argument(
+        "--bowtie2-threads",
+        type=int,
+        default=1,
+        help="Threads per bowtie2 process with --stream. Default: 1"
+    )
+
+    args = parser.parse_args()
+
+    if args.chunk_reads < 1:
+        raise ValueError(
+            "--chunk-reads must be at least 1."
+        )
+
+    if args.stream and not args.spike_index:
+        raise ValueError(
+            "--stream requires --spike-index."
+        )
+
+    start_time = time.perf_counter()
+
+    input_dir = os.path.abspath(args.input_dir)
+
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(
+            f"Input directory does not exist: {input_dir}"
+        )
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(input_dir),
+            "trimmomatic"
+        )
+
+    os.makedirs(os.path.join(output_dir, "logs"), exist_ok=True)
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Step 03 - Quality trimming")
+    print("========================================")
+    print(f"Input directory:  {input_dir}")
+    print(f"Output directory: {output_dir}")
+    print(f"Processes:        {args.processes}")
+    print(
+        f"Quality trimming: SLIDINGWINDOW:{args.window}:{args.quality} "
+        f"MINLEN:{args.min_length}"
+    )
+    print(f"Adapter clipping: {not args.no_adapter_clip}")
+    print("========================================")
+
+    input_files, unpaired_files = find_fastq_pairs(
+        input_dir,
+        forward_tag="R1_001_trimmed.fastq",
+        reverse_tag="R2_001_trimmed.fastq"
+    )
+
+    for forward_file in unpaired_files:
+        print(
+            f"WARNING: Matching R2 file not found for "
+            f"{forward_file}. Skipping..."
+        )
+
+    if not input_files:
+        raise RuntimeError(
+            "No R1/R2 trimmed FASTQ pairs were found. "
+            "Expected pattern: *R1_001_trimmed.fastq[.gz]"
+        )
+
+    print(f"FASTQ pairs found: {len(input_files)}")
+    print()
+
+    options = {
+        "chunk_reads": args.chunk_reads,
+        "window": args.window,
+        "threshold": args.quality,
+        "min_length": args.min_length,
+        "clip_adapters": not args.no_adapter_clip,
+        "compress_threads": args.compress_threads,
+        "stream": None,
+        "settings": {
+            "window": args.window,
+            "threshold": args.quality,
+            "min_length": args.min_length,
+            "clip_adapters": not args.no_adapter_clip,
+        },
+    }
+
+    if args.stream:
+        options["stream"] = {
+            "alignment_dir": os.path.abspath(args.stream),
+            "index": args.spike_index,
+            "threads": args.bowtie2_threads,
+        }
+
+        print(f"Streaming into spike RNA alignment: {args.stream}")
+        print()
+
+    jobs = [
+        (
+            name,
+            file_names,
+            output_dir,
+            True if args.gzip else None,
+            options
+        )
+        for name, file_names in input_files.items()
+    ]
+
+    with multiprocessing.Pool(
+        processes=min(args.processes, len(jobs))
+    ) as pool:
+
+        for base_name, stats in pool.imap(trim_sample, jobs):
+
+            if stats is None:
+                print(
+                    f"Output for {base_name} already exists. "
+                    "Skipping..."
+                )
+                print()
+                continue
+
+            report_stats(base_name, stats)
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print("========================================")
+    print(f"Step 03 completed in {elapsed_time:.2f} seconds.")
+    print(f"Output directory: {output_dir}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
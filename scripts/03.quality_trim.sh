@@ -0,0 +1,73 @@
+#!/bin/bash
+
+#SBATCH -N 1
+#SBATCH --mem=90000
+#SBATCH -t 8:00:00
+#SBATCH -p cpu-single
+
+# ============================================================
+# HELIOS NAD-Seq pipeline
+# Step 03 (alternative): in-process quality trimming
+#
+# Replaces 03.trimmomatic.sh without Java: adapter clipping,
+# SLIDINGWINDOW:4:20 and MINLEN:18 on batches of reads with NumPy,
+# samples in parallel. Writes the same paired/unpaired files.
+#
+# Usage:
+#   sbatch scripts/03.quality_trim.sh <INPUT_DIR> [OUTPUT_DIR] [OPTIONS]
+#
+# Example:
+#   sbatch scripts/03.quality_trim.sh results/5prime_trimmed
+#
+# Optional output directory:
+#   sbatch scripts/03.quality_trim.sh \
+#       results/5prime_trimmed \
+#       results/trimmomatic
+#
+# Any further options are passed to 03.quality_trim.py, e.g.
+#   --processes 16 --min-length 20
+# ============================================================
+
+
+# Check that an input directory was provided
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 <INPUT_DIR> [OUTPUT_DIR] [OPTIONS]"
+    exit 1
+fi
+
+
+# Input and optional output directories
+input_dir="$1"
+shift
+
+output_dir=""
+
+if [[ $# -ge 1 && "$1" != --* ]]; then
+    output_dir="$1"
+    shift
+fi
+
+# Remaining arguments are options for 03.quality_trim.py
+trim_options=("$@")
+
+
+# Activate Conda environment
+source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+conda activate env.helios.yml
+
+
+# Run quality trimming
+if [ -n "$output_dir" ]; then
+
+    python scripts/03.quality_trim.py \
+        "$input_dir" \
+        "$output_dir" \
+        "${trim_options[@]}"
+
+else
+
+    python scripts/03.quality_trim.py \
+        "$input_dir" \
+        "${trim_options[@]}"
+
+fi
@@ -22,6 +22,11 @@
 #
 # If OUTPUT_DIR is not provided, "trimmomatic" will be created
 # next to the input directory.
+#
+# The per-read Trimmomatic trimlog is about as large as the FASTQ
+# output and is only written with TRIMLOG=1, e.g.
+#   TRIMLOG=1 sbatch scripts/03.trimmomatic.sh results/5prime_trimmed
+# 03.quality_trim.py writes compact trimming histograms instead.
 # ============================================================
 
 
@@ -105,14 +110,17 @@ log_dir="${output_dir}/logs"
 mkdir -p "$log_dir"
 
 
-# Find Step 02 R1 files
+# Find Step 02 R1 files (.fastq or .fastq.gz)
 shopt -s nullglob
-R1_files=("$input_dir"/*R1_001_trimmed.fastq)
+R1_files=(
+    "$input_dir"/*R1_001_trimmed.fastq
+    "$input_dir"/*R1_001_trimmed.fastq.gz
+)
 
 if [ ${#R1_files[@]} -eq 0 ]; then
     echo "ERROR: No R1 trimmed FASTQ files found in:"
     echo "$input_dir"
-    echo "Expected pattern: *R1_001_trimmed.fastq"
+    echo "Expected pattern: *R1_001_trimmed.fastq[.gz]"
     exit 1
 fi
 
@@ -125,6 +133,14 @@ for R1_file in "${R1_files[@]}"; do
     # File name only
     file="$(basename "$R1_file")"
 
+    # Compressed input gives compressed output
+    # (Trimmomatic picks the format from the file name)
+    ext=".fastq"
+
+    if [[ "$file" == *.gz ]]; then
+        ext=".fastq.gz"
+    fi
+
     # Identify corresponding R2
     R2_file="${R1_file/R1_001_trimmed.fastq/R2_001_trimmed.fastq}"
 
@@ -137,17 +153,22 @@ for R1_file in "${R1_files[@]}"; do
 
 
     # Sample/base name
-    base_name="${file%_R1_001_trimmed.fastq}"
+    base_name="${file%_R1_001_trimmed${ext}}"
 
 
     # Output files
-    R1_paired="${output_dir}/${base_name}_R1_trimmed_paired.fastq"
-    R1_unpaired="${output_dir}/${base_name}_R1_trimmed_unpaired.fastq"
+    R1_paired="${output_dir}/${base_name}_R1_trimmed_paired${ext}"
+    R1_unpaired="${output_dir}/${base_name}_R1_trimmed_unpaired${ext}"
+
+    R2_paired="${output_dir}/${base_name}_R2_trimmed_paired${ext}"
+    R2_unpaired="${output_dir}/${base_name}_R2_trimmed_unpaired${ext}"
 
-    R2_paired="${output_dir}/${base_name}_R2_trimmed_paired.fastq"
-    R2_unpaired="${output_dir}/${base_name}_R2_trimmed_unpaired.fastq"
+    # Optional per-read trimlog
+    trimlog_args=()
 
-    trimlog="${log_dir}/${base_name}_trimmomatic.trimlog"
+    if [ "${TRIMLOG:-0}" = "1" ]; then
+        trimlog_args=(-trimlog "${log_dir}/${base_name}_trimmomatic.trimlog")
+    fi
 
 
     # Skip completed samples
@@ -171,7 +192,7 @@ for R1_file in "${R1_files[@]}"; do
         -jar "$TRIMMOMATIC_JAR" \
         PE \
         -phred33 \
-        -trimlog "$trimlog" \
+        "${trimlog_args[@]}" \
         "$R1_file" \
         "$R2_file" \
         "$R1_paired" \
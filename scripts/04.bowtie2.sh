@@ -34,6 +34,16 @@ set -euo pipefail
 # Optional output directory:
 #   results/alignment
 #
+# Each bowtie2 call uses BOWTIE2_THREADS threads (default: the CPUs
+# allocated by SLURM) and memory-maps its index with --mm, so that
+# concurrent jobs share one page-cached copy of each index.
+#
+# With BAM=1 every SAM file is replaced by a coordinate-sorted,
+# indexed BAM file (samtools from the helios conda environment).
+#
+# For one bowtie2 call per stage (paired and singleton reads together,
+# one *_combined.sam per stage) use 04.bowtie2_cascade.py --combined.
+#
 # If OUTPUT_DIR is omitted, "alignment" is created
 # next to the Trimmomatic input directory.
 # ============================================================
@@ -88,6 +98,83 @@ fi
 module load bio/bowtie2/2.4.5
 
 
+BAM="${BAM:-0}"
+
+if [ "$BAM" = 1 ]; then
+    source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+    conda activate env.helios.yml
+fi
+
+
+# ------------------------------------------------------------
+# Bowtie2 threads and throughput report
+# ------------------------------------------------------------
+
+THREADS="${BOWTIE2_THREADS:-${SLURM_CPUS_ON_NODE:-$(nproc)}}"
+
+
+# run_bowtie2 <label> <bowtie2 arguments...>
+run_bowtie2() {
+
+    local label="$1"
+    shift
+
+    local log
+    log="$(mktemp)"
+
+    local start
+    start="$(date +%s.%N)"
+
+    if ! bowtie2 -p "$THREADS" --mm "$@" 2> "$log"; then
+        cat "$log" >&2
+        rm -f "$log"
+        return 1
+    fi
+
+    local end
+    end="$(date +%s.%N)"
+
+    cat "$log" >&2
+
+    awk -v label="$label" -v start="$start" -v end="$end" '
+        / reads; of these:/ { reads = $1 }
+        END {
+            seconds = end - start
+            rate = (seconds > 0) ? reads / seconds : 0
+            printf "   %s: %d reads in %.1f s (%.0f reads/sec)\n",
+                label, reads, seconds, rate
+        }' "$log"
+
+    rm -f "$log"
+}
+
+
+# have_alignment <sam>: the SAM file or its BAM file exists
+have_alignment() {
+    [[ -f "$1" || -f "${1%.sam}.bam" ]]
+}
+
+
+# to_bam <sam>: replace a SAM file by a sorted, indexed BAM file
+to_bam() {
+
+    local sam="$1"
+    local bam="${sam%.sam}.bam"
+
+    if [ -s "$sam" ]; then
+        samtools sort -@ "$THREADS" -O bam -T "${bam}.sort" \
+            -o "${bam}.tmp" "$sam"
+    else
+        printf '@HD\tVN:1.0\tSO:coordinate\n' |
+            samtools view -b -o "${bam}.tmp" -
+    fi
+
+    samtools index "${bam}.tmp" "${bam}.bai"
+    mv "${bam}.tmp" "$bam"
+    rm -f "$sam"
+}
+
+
 echo "========================================"
 echo "HELIOS NAD-Seq: Step 04 - Bowtie2"
 echo "========================================"
@@ -97,20 +184,41 @@ echo
 echo "Spike index:       $SPIKE_INDEX"
 echo "tRNA/rRNA index:   $TRNA_RRNA_INDEX"
 echo "E. coli index:     $ECOLI_INDEX"
+echo "Bowtie2 threads:   $THREADS"
+echo "BAM output:        $BAM"
 echo "========================================"
 
 
 # ------------------------------------------------------------
-# Find paired R1 files from Step 03
+# Find paired R1 files from Step 03 (.fastq or .fastq.gz)
 # ------------------------------------------------------------
 
 shopt -s nullglob
-R1_FILES=("$TRIM_DIR"/*R1_trimmed_paired.fastq)
+R1_FILES=(
+    "$TRIM_DIR"/*R1_trimmed_paired.fastq
+    "$TRIM_DIR"/*R1_trimmed_paired.fastq.gz
+)
+
+
+# Samples streamed into the spike stage with --stream
+# (03.quality_trim.py, 01-03.preprocess.py) have no trimmed FASTQ
+# files; they are picked up from their spike alignments.
+for spike_sam in "$OUTPUT_DIR"/*/*_spike_paired.sam; do
+
+    base="$(basename "$spike_sam" _spike_paired.sam)"
+
+    if [[ ! -f "${TRIM_DIR}/${base}_R1_trimmed_paired.fastq" &&
+          ! -f "${TRIM_DIR}/${base}_R1_trimmed_paired.fastq.gz" ]]; then
+        R1_FILES+=("stream:${base}")
+    fi
+
+done
+
 
 if [ ${#R1_FILES[@]} -eq 0 ]; then
     echo "ERROR: No paired R1 FASTQ files found."
     echo "Expected pattern:"
-    echo "*R1_trimmed_paired.fastq"
+    echo "*R1_trimmed_paired.fastq[.gz]"
     exit 1
 fi
 
@@ -124,53 +232,73 @@ echo "Samples found: ${#R1_FILES[@]}"
 
 for R1_PATH in "${R1_FILES[@]}"; do
 
-    r1="$(basename "$R1_PATH")"
-
     echo
     echo "========================================"
-    echo "Sample: $r1"
-    echo "========================================"
 
+    if [[ "$R1_PATH" == stream:* ]]; then
 
-    # --------------------------------------------------------
-    # Identify paired R2
-    # --------------------------------------------------------
+        # Spike stage already done by --stream
+        base="${R1_PATH#stream:}"
 
-    R2_PATH="${R1_PATH/_R1_trimmed_paired.fastq/_R2_trimmed_paired.fastq}"
+        echo "Sample: $base (streamed)"
+        echo "========================================"
 
-    if [ ! -f "$R2_PATH" ]; then
-        echo "ERROR: Missing paired R2 file for:"
-        echo "$R1_PATH"
-        continue
-    fi
+    else
 
+        r1="$(basename "$R1_PATH")"
 
-    # --------------------------------------------------------
-    # Identify singleton files from Trimmomatic
-    # --------------------------------------------------------
+        # bowtie2 reads gzip-compressed FASTQ directly
+        ext=".fastq"
 
-    R1_UNPAIRED="${R1_PATH/_paired.fastq/_unpaired.fastq}"
-    R2_UNPAIRED="${R2_PATH/_paired.fastq/_unpaired.fastq}"
+        if [[ "$r1" == *.gz ]]; then
+            ext=".fastq.gz"
+        fi
 
+        echo "Sample: $r1"
+        echo "========================================"
 
-    if [ ! -f "$R1_UNPAIRED" ]; then
-        echo "WARNING: Missing R1 unpaired file:"
-        echo "$R1_UNPAIRED"
-        : > "$R1_UNPAIRED"
-    fi
 
-    if [ ! -f "$R2_UNPAIRED" ]; then
-        echo "WARNING: Missing R2 unpaired file:"
-        echo "$R2_UNPAIRED"
-        : > "$R2_UNPAIRED"
-    fi
+        # --------------------------------------------------------
+        # Identify paired R2
+        # --------------------------------------------------------
+
+        R2_PATH="${R1_PATH/_R1_trimmed_paired.fastq/_R2_trimmed_paired.fastq}"
+
+        if [ ! -f "$R2_PATH" ]; then
+            echo "ERROR: Missing paired R2 file for:"
+            echo "$R1_PATH"
+            continue
+        fi
+
+
+        # --------------------------------------------------------
+        # Identify singleton files from Trimmomatic
+        # --------------------------------------------------------
 
+        R1_UNPAIRED="${R1_PATH/_paired.fastq/_unpaired.fastq}"
+        R2_UNPAIRED="${R2_PATH/_paired.fastq/_unpaired.fastq}"
 
-    # --------------------------------------------------------
-    # Sample base name
-    # --------------------------------------------------------
 
-    base="${r1%_R1_trimmed_paired.fastq}"
+        if [ ! -f "$R1_UNPAIRED" ]; then
+            echo "WARNING: Missing R1 unpaired file:"
+            echo "$R1_UNPAIRED"
+            : > "$R1_UNPAIRED"
+        fi
+
+        if [ ! -f "$R2_UNPAIRED" ]; then
+            echo "WARNING: Missing R2 unpaired file:"
+            echo "$R2_UNPAIRED"
+            : > "$R2_UNPAIRED"
+        fi
+
+
+        # --------------------------------------------------------
+        # Sample base name
+        # --------------------------------------------------------
+
+        base="${r1%_R1_trimmed_paired${ext}}"
+
+    fi
 
 
     # Create a separate directory for each sample
@@ -194,9 +322,9 @@ for R1_PATH in "${R1_FILES[@]}"; do
     spike_R2_unp_fastq="${sample_dir}/${base}_unaligned_spike_R2_unpaired.fastq"
 
 
-    if [[ -f "$spike_paired_sam" &&
-          -f "$spike_unpaired_r1_sam" &&
-          -f "$spike_unpaired_r2_sam" ]]; then
+    if have_alignment "$spike_paired_sam" &&
+       have_alignment "$spike_unpaired_r1_sam" &&
+       have_alignment "$spike_unpaired_r2_sam"; then
 
         echo "Spike alignment already exists. Skipping."
 
@@ -204,7 +332,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         echo "-> Aligning paired reads to spike RNA"
 
-        bowtie2 \
+        run_bowtie2 "spike paired" \
             -x "$SPIKE_INDEX" \
             -1 "$R1_PATH" \
             -2 "$R2_PATH" \
@@ -216,7 +344,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$R1_UNPAIRED" ]; then
 
-            bowtie2 \
+            run_bowtie2 "spike R1 singletons" \
                 -x "$SPIKE_INDEX" \
                 -U "$R1_UNPAIRED" \
                 -S "$spike_unpaired_r1_sam" \
@@ -234,7 +362,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$R2_UNPAIRED" ]; then
 
-            bowtie2 \
+            run_bowtie2 "spike R2 singletons" \
                 -x "$SPIKE_INDEX" \
                 -U "$R2_UNPAIRED" \
                 -S "$spike_unpaired_r2_sam" \
@@ -247,6 +375,13 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         fi
 
+
+        if [ "$BAM" = 1 ]; then
+            to_bam "$spike_paired_sam"
+            to_bam "$spike_unpaired_r1_sam"
+            to_bam "$spike_unpaired_r2_sam"
+        fi
+
     fi
 
 
@@ -269,9 +404,9 @@ for R1_PATH in "${R1_FILES[@]}"; do
     spike_paired2="${spike_unconc_pref}.2.fastq"
 
 
-    if [[ -f "$rrna_paired_sam" &&
-          -f "$rrna_unpaired_r1_sam" &&
-          -f "$rrna_unpaired_r2_sam" ]]; then
+    if have_alignment "$rrna_paired_sam" &&
+       have_alignment "$rrna_unpaired_r1_sam" &&
+       have_alignment "$rrna_unpaired_r2_sam"; then
 
         echo "tRNA/rRNA depletion already exists. Skipping."
 
@@ -282,7 +417,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
         if [[ -s "$spike_paired1" &&
               -s "$spike_paired2" ]]; then
 
-            bowtie2 \
+            run_bowtie2 "tRNA/rRNA paired" \
                 -x "$TRNA_RRNA_INDEX" \
                 -1 "$spike_paired1" \
                 -2 "$spike_paired2" \
@@ -302,7 +437,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$spike_R1_unp_fastq" ]; then
 
-            bowtie2 \
+            run_bowtie2 "tRNA/rRNA R1 singletons" \
                 -x "$TRNA_RRNA_INDEX" \
                 -U "$spike_R1_unp_fastq" \
                 -S "$rrna_unpaired_r1_sam" \
@@ -320,7 +455,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$spike_R2_unp_fastq" ]; then
 
-            bowtie2 \
+            run_bowtie2 "tRNA/rRNA R2 singletons" \
                 -x "$TRNA_RRNA_INDEX" \
                 -U "$spike_R2_unp_fastq" \
                 -S "$rrna_unpaired_r2_sam" \
@@ -333,6 +468,13 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         fi
 
+
+        if [ "$BAM" = 1 ]; then
+            to_bam "$rrna_paired_sam"
+            to_bam "$rrna_unpaired_r1_sam"
+            to_bam "$rrna_unpaired_r2_sam"
+        fi
+
     fi
 
 
@@ -350,9 +492,9 @@ for R1_PATH in "${R1_FILES[@]}"; do
     ecoli_paired2="${rrna_unconc_pref}.2.fastq"
 
 
-    if [[ -f "$ecoli_paired_sam" &&
-          -f "$ecoli_R1_unp_sam" &&
-          -f "$ecoli_R2_unp_sam" ]]; then
+    if have_alignment "$ecoli_paired_sam" &&
+       have_alignment "$ecoli_R1_unp_sam" &&
+       have_alignment "$ecoli_R2_unp_sam"; then
 
         echo "E. coli alignment already exists. Skipping."
 
@@ -363,7 +505,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
         if [[ -s "$ecoli_paired1" &&
               -s "$ecoli_paired2" ]]; then
 
-            bowtie2 \
+            run_bowtie2 "E. coli paired" \
                 -x "$ECOLI_INDEX" \
                 -1 "$ecoli_paired1" \
                 -2 "$ecoli_paired2" \
@@ -382,7 +524,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$rrna_R1_unp_fastq" ]; then
 
-            bowtie2 \
+            run_bowtie2 "E. coli R1 singletons" \
                 -x "$ECOLI_INDEX" \
                 -U "$rrna_R1_unp_fastq" \
                 -S "$ecoli_R1_unp_sam" \
@@ -399,7 +541,7 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         if [ -s "$rrna_R2_unp_fastq" ]; then
 
-            bowtie2 \
+            run_bowtie2 "E. coli R2 singletons" \
                 -x "$ECOLI_INDEX" \
                 -U "$rrna_R2_unp_fastq" \
                 -S "$ecoli_R2_unp_sam" \
@@ -411,6 +553,13 @@ for R1_PATH in "${R1_FILES[@]}"; do
 
         fi
 
+
+        if [ "$BAM" = 1 ]; then
+            to_bam "$ecoli_paired_sam"
+            to_bam "$ecoli_R1_unp_sam"
+            to_bam "$ecoli_R2_unp_sam"
+        fi
+
     fi
 
 
@@ -0,0 +1,1053 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from itertools import islice
+
+from alignment_cache import (
+    AlignmentCache,
+    collapse_reads,
+    expand_alignments,
+    index_signature,
+    read_stage_sam,
+    write_unique_fastq,
+)
+from bowtie2_stream import (
+    STAGES,
+    bowtie2_command,
+    bowtie2_read_count,
+    open_fifo,
+    release_fifo,
+    sam_to_bam,
+    stage_complete,
+    stage_output_paths,
+    tag_origin,
+    unaligned_inputs,
+)
+from fastq_io import FastqWriter, open_fastq
+
+
+# Read streams of a sample; the paired stream is aligned with -1/-2
+STREAMS = ("paired", "R1_unpaired", "R2_unpaired")
+
+
+def find_samples(trim_dir, output_dir):
+    """
+    Step 03 samples ({base_name: inputs or None}).
+
+    Samples are found by their *R1_trimmed_paired.fastq[.gz] file, plus
+    samples whose spike stage was streamed with --stream and therefore
+    have no trimmed FASTQ files (inputs None).
+    """
+
+    samples = {}
+
+    r1_files = sorted(
+        glob.glob(os.path.join(trim_dir, "*R1_trimmed_paired.fastq"))
+        + glob.glob(os.path.join(trim_dir, "*R1_trimmed_paired.fastq.gz"))
+    )
+
+    for r1_paired in r1_files:
+
+        base_name = re.sub(
+            r"_R1_trimmed_paired\.fastq(\.gz)?$",
+            "",
+            os.path.basename(r1_paired)
+        )
+
+        r2_paired = r1_paired.replace(
+            "_R1_trimmed_paired.fastq",
+            "_R2_trimmed_paired.fastq"
+        )
+
+        if not os.path.isfile(r2_paired):
+            print(f"WARNING: Missing paired R2 file for {r1_paired}")
+            continue
+
+        inputs = {
+            "R1_paired": r1_paired,
+            "R2_paired": r2_paired,
+            "R1_unpaired": r1_paired.replace("_paired.fastq", "_unpaired.fastq"),
+            "R2_unpaired": r2_paired.replace("_paired.fastq", "_unpaired.fastq"),
+        }
+
+        for key in ("R1_unpaired", "R2_unpaired"):
+            if not os.path.isfile(inputs[key]):
+                print(f"WARNING: Missing unpaired file: {inputs[key]}")
+                open(inputs[key], "w").close()
+
+        samples[base_name] = inputs
+
+    for spike_sam in sorted(
+        glob.glob(os.path.join(output_dir, "*", "*_spike_paired.sam"))
+        + glob.glob(os.path.join(output_dir, "*", "*_spike_paired.bam"))
+    ):
+        base_name = re.sub(
+            r"_spike_paired\.[sb]am$",
+            "",
+            os.path.basename(spike_sam)
+        )
+        samples.setdefault(base_name, None)
+
+    return samples
+
+
+def plan_stages(output_dir, base_name, trimmed_inputs, combined=False):
+    """
+    First stage to run for a sample and its input files.
+
+    Complete stages (all SAM files present, or with <combined> also the
+    combined SAM file) are skipped. A stage can only be resumed if the
+    unaligned reads of the stage before it are on disk (from
+    04.bowtie2.sh or --stream); otherwise the cascade starts earlier.
+
+    Returns (first_stage_index, inputs); first_stage_index is
+    len(STAGES) if the sample is done.
+    """
+
+    first = 0
+
+    while (
+        first < len(STAGES)
+        and stage_complete(output_dir, base_name, STAGES[first][0], combined)
+    ):
+        first += 1
+
+    while first > 0:
+
+        inputs = unaligned_inputs(
+            output_dir,
+            base_name,
+            STAGES[first - 1][0]
+        )
+
+        if inputs is not None or first == len(STAGES):
+            return first, inputs
+
+        first -= 1
+
+    if trimmed_inputs is None:
+        raise FileNotFoundError(
+            f"No input reads for {base_name}: neither trimmed FASTQ "
+            "files nor unaligned reads of a completed stage were found."
+        )
+
+    return 0, trimmed_inputs
+
+
+def stage_threads(sample_threads, stream, stages=1, index=0):
+    """
+    bowtie2 threads of one process of a sample whose <stages> remaining
+    stages run at the same time; <index> is the position of the stage
+    among them.
+
+    Every singleton stream gets one thread. The rest of the sample's
+    budget is split between the paired streams of the stages, earlier
+    stages (which see more reads) first, with at least one thread each.
+    """
+
+    if stream != "paired":
+        return 1
+
+    share, extra = divmod(sample_threads - 2 * stages, stages)
+
+    return max(1, share + (index < extra))
+
+
+def sample_thread_usage(sample_threads, combined=False):
+    """
+    Threads one sample runs at most with a budget of <sample_threads>.
+
+    With <combined> the stages run one after another on the whole
+    budget. Otherwise all stages run at once, and every bowtie2 process
+    needs at least one thread.
+    """
+
+    if combined:
+        return sample_threads
+
+    return max(sample_threads, len(STAGES) * len(STREAMS))
+
+
+def record_exit(process, exit_times):
+    """
+    Wait for <process> and store the time it exited in
+    exit_times[process.pid]. Run in a thread, so that the exit time is
+    not delayed by the other work of the waiting thread.
+    """
+
+    process.wait()
+    exit_times[process.pid] = time.perf_counter()
+
+
+def align_sample(base_name, trimmed_inputs, output_dir, indexes,
+                 sample_threads, bowtie2="bowtie2", bam=False):
+    """
+    Run the spike -> tRNA/rRNA -> E. coli cascade for one sample.
+
+    All remaining stages run at the same time, sharing the
+    <sample_threads> budget (stage_threads): every bowtie2 process
+    writes the reads it could not align (--un-conc/--un) to a named pipe
+    read by the next stage, so no unaligned FASTQ files are written.
+    SAM files go to temporary names and are moved into place stage by
+    stage once all three alignments of a stage have succeeded; with
+    <bam> they are then replaced by sorted, indexed BAM files.
+
+    Returns a list of (stage, reads, seconds) for the stages that were
+    run; reads count pairs of the paired stream once and seconds run
+    from the start of the stage's bowtie2 processes until the last of
+    them exits. As the stages are piped, a stage cannot finish before
+    the stages feeding it.
+    """
+
+    first, inputs = plan_stages(output_dir, base_name, trimmed_inputs)
+
+    if first == len(STAGES):
+        return []
+
+    sample_dir = os.path.join(output_dir, base_name)
+    os.makedirs(sample_dir, exist_ok=True)
+
+    fifo_dir = tempfile.mkdtemp(prefix=".fifo.", dir=sample_dir)
+
+    stages = STAGES[first:]
+    processes = []
+    tmp_paths = []
+    timings = []
+    watchers = {}
+    exit_times = {}
+
+    try:
+
+        for i, (stage, options) in enumerate(stages):
+
+            paths = stage_output_paths(output_dir, base_name, stage)
+            last = i == len(stages) - 1
+
+            stage_start = time.perf_counter()
+
+            def tmp(key):
+                path = os.path.join(
+                    sample_dir,
+                    ".tmp." + os.path.basename(paths[key])
+                )
+                tmp_paths.append(path)
+                return path
+
+            outputs = {}
+
+            if not last:
+                unconc = os.path.join(fifo_dir, f"{stage}_paired.fastq")
+
+                outputs = {
+                    "R1_paired": os.path.join(fifo_dir, f"{stage}_paired.1.fastq"),
+                    "R2_paired": os.path.join(fifo_dir, f"{stage}_paired.2.fastq"),
+                    "R1_unpaired": os.path.join(fifo_dir, f"{stage}_R1_unpaired.fastq"),
+                    "R2_unpaired": os.path.join(fifo_dir, f"{stage}_R2_unpaired.fastq"),
+                }
+
+                for fifo in outputs.values():
+                    os.mkfifo(fifo)
+
+            stage_processes = {}
+
+            for stream in STREAMS:
+
+                command = bowtie2_command(
+                    bowtie2,
+                    indexes[stage],
+                    stage_threads(sample_threads, stream, len(stages), i),
+                    options
+                )
+
+                if stream == "paired":
+                    command += [
+                        "-1", inputs["R1_paired"],
+                        "-2", inputs["R2_paired"],
+                        "-S", tmp("paired_sam"),
+                    ]
+
+                    if not last:
+                        command += ["--un-conc", unconc]
+
+                else:
+                    command += [
+                        "-U", inputs[stream],
+                        "-S", tmp(f"{stream}_sam"),
+                    ]
+
+                    if not last:
+                        command += ["--un", outputs[stream]]
+
+                log_path = os.path.join(fifo_dir, f"{stage}_{stream}.log")
+
+                with open(log_path, "w") as log:
+                    process = subprocess.Popen(
+                        command,
+                        stdout=subprocess.DEVNULL,
+                        stderr=log
+                    )
+
+                stage_processes[stream] = (process, log_path)
+
+                watcher = threading.Thread(
+                    target=record_exit,
+                    args=(process, exit_times),
+                    daemon=True
+                )
+                watcher.start()
+                watchers[process.pid] = watcher
+
+            processes.append(
+                (stage, paths, stage_processes, outputs, stage_start)
+            )
+            inputs = outputs
+
+        # Wait for the stages in cascade order
+        for i, (stage, paths, stage_processes, outputs, stage_start) in (
+            enumerate(processes)
+        ):
+
+            for stream, (process, log_path) in stage_processes.items():
+
+                process.wait()
+
+                if process.returncode != 0:
+                    with open(log_path) as log:
+                        raise RuntimeError(
+                            f"bowtie2 ({stage}, {stream}) failed for "
+                            f"{base_name} with code "
+                            f"{process.returncode}:\n{log.read()}"
+                        )
+
+            # A process that exited without opening its --un outputs
+            # must not leave the next stage waiting for input
+            if i + 1 < len(processes):
+
+                next_processes = processes[i + 1][2]
+
+                for output, fifo in outputs.items():
+                    stream = "paired" if output.endswith("_paired") else output
+                    release_fifo(fifo, next_processes[stream][0])
+
+            for key in ("paired_sam", "R1_unpaired_sam", "R2_unpaired_sam"):
+                tmp_path = os.path.join(
+                    sample_dir,
+                    ".tmp." + os.path.basename(paths[key])
+                )
+                os.replace(tmp_path, paths[key])
+
+                # Only the threads of the finished stage are free
+                if bam:
+                    sam_to_bam(
+                        paths[key],
+                        sum(
+                            stage_threads(
+                                sample_threads,
+                                stream,
+                                len(processes),
+                                i
+                            )
+                            for stream in STREAMS
+                        )
+                    )
+
+            reads = 0
+
+            with open(paths["log"], "w") as fout:
+                for stream, (process, log_path) in stage_processes.items():
+                    with open(log_path) as log:
+                        text = log.read()
+
+                    reads += bowtie2_read_count(text)
+                    fout.write(f"# {stream}\n{text}\n")
+
+            for process, _ in stage_processes.values():
+                watchers[process.pid].join()
+
+            seconds = max(
+                exit_times[process.pid]
+                for process, _ in stage_processes.values()
+            ) - stage_start
+
+            timings.append((stage, reads, seconds))
+
+    except BaseException:
+
+        for _, _, stage_processes, _, _ in processes:
+            for process, _ in stage_processes.values():
+                if process.poll() is None:
+                    process.terminate()
+
+        for _, _, stage_processes, _, _ in processes:
+            for process, _ in stage_processes.values():
+                process.wait()
+
+        for path in tmp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+        raise
+
+    finally:
+        shutil.rmtree(fifo_dir, ignore_errors=True)
+
+    return timings
+
+
+def feed_fastq(paths, origins, writer, chunk_reads=100000):
+    """
+    Thread target: copy FASTQ files into one FastqWriter, tagging every
+    read with the origin of its file (tag_origin). Errors are stored on
+    the writer as feed_error; the writer is closed either way.
+    """
+
+    try:
+
+        for path, origin in zip(paths, origins):
+
+            with open_fastq(path, "rb") as fin:
+
+                while True:
+                    lines = list(islice(fin, chunk_reads * 4))
+
+                    if not lines:
+                        break
+
+                    writer.write(b"".join(tag_origin(lines, origin)))
+
+        writer.close()
+
+    except BaseException as error:
+        writer.feed_error = error
+        writer.abort()
+
+
+def align_sample_combined(base_name, trimmed_inputs, output_dir, indexes,
+                          sample_threads, bowtie2="bowtie2", bam=False):
+    """
+    Run the cascade for one sample with one bowtie2 call per stage.
+
+    Paired and singleton reads are aligned together (-1/-2 plus -U with
+    both singleton streams), so every stage loads its index once and
+    writes a single <base_name>_<stage>_combined.sam. The reads of the
+    first stage are fed through named pipes with their comment replaced
+    by the origin tag YO:Z:paired, YO:Z:R1_unpaired or YO:Z:R2_unpaired,
+    which --sam-append-comment (bowtie2 2.4.0 or later) adds to every
+    SAM record.
+
+    bowtie2 reads the paired inputs before the singletons and closes
+    its --un outputs only on exit, so stages cannot be piped into each
+    other: they run one after another on temporary unaligned FASTQ
+    files, each with all <sample_threads> threads.
+
+    With <bam> every SAM file is replaced by a sorted, indexed BAM file.
+
+    Returns a list of (stage, reads, seconds) like align_sample, with
+    the seconds of the stage's bowtie2 call.
+    """
+
+    first, inputs = plan_stages(
+        output_dir,
+        base_name,
+        trimmed_inputs,
+        combined=True
+    )
+
+    if first == len(STAGES):
+        return []
+
+    sample_dir = os.path.join(output_dir, base_name)
+    os.makedirs(sample_dir, exist_ok=True)
+
+    work_dir = tempfile.mkdtemp(prefix=".fifo.", dir=sample_dir)
+
+    # Tagged input of the first stage: pipe -> (reads, origins)
+    feeds = {
+        "R1_paired": ([inputs["R1_paired"]], ["paired"]),
+        "R2_paired": ([inputs["R2_paired"]], ["paired"]),
+        "unpaired": (
+            [inputs["R1_unpaired"], inputs["R2_unpaired"]],
+            ["R1_unpaired", "R2_unpaired"]
+        ),
+    }
+
+    inputs = {}
+
+    for name in feeds:
+        inputs[name] = os.path.join(work_dir, f"input_{name}.fastq")
+        os.mkfifo(inputs[name])
+
+    stages = STAGES[first:]
+    feeders = []
+    timings = []
+    process = None
+    tmp_sam = None
+
+    try:
+
+        for i, (stage, options) in enumerate(stages):
+
+            paths = stage_output_paths(output_dir, base_name, stage)
+            last = i == len(stages) - 1
+
+            stage_start = time.perf_counter()
+
+            tmp_sam = os.path.join(
+                sample_dir,
+                ".tmp." + os.path.basename(paths["combined_sam"])
+            )
+
+            command = bowtie2_command(
+                bowtie2,
+                indexes[stage],
+                sample_threads,
+                options
+            ) + [
+                "--sam-append-comment",
+                "-1", inputs["R1_paired"],
+                "-2", inputs["R2_paired"],
+                "-U", inputs["unpaired"],
+                "-S", tmp_sam,
+            ]
+
+            outputs = {}
+
+            if not last:
+                unconc = os.path.join(work_dir, f"{stage}_paired.fastq")
+
+                outputs = {
+                    "R1_paired": os.path.join(work_dir, f"{stage}_paired.1.fastq"),
+                    "R2_paired": os.path.join(work_dir, f"{stage}_paired.2.fastq"),
+                    "unpaired": os.path.join(work_dir, f"{stage}_unpaired.fastq"),
+                }
+
+                command += ["--un-conc", unconc, "--un", outputs["unpaired"]]
+
+            log_path = os.path.join(work_dir, f"{stage}.log")
+
+            with open(log_path, "w") as log:
+                process = subprocess.Popen(
+                    command,
+                    stdout=subprocess.DEVNULL,
+                    stderr=log
+                )
+
+            if i == 0:
+
+                for name, (paths_in, origins) in feeds.items():
+
+                    writer = FastqWriter(
+                        inputs[name],
+                        atomic=False,
+                        opener=lambda path, process=process: open_fifo(
+                            path,
+                            process
+                        )
+                    )
+                    writer.feed_error = None
+
+                    feeder = threading.Thread(
+                        target=feed_fastq,
+                        args=(paths_in, origins, writer),
+                        daemon=True
+                    )
+                    feeder.start()
+
+                    feeders.append((feeder, writer))
+
+            process.wait()
+
+            seconds = time.perf_counter() - stage_start
+
+            with open(log_path) as log:
+                text = log.read()
+
+            if process.returncode != 0:
+                raise RuntimeError(
+                    f"bowtie2 ({stage}) failed for {base_name} with code "
+                    f"{process.returncode}:\n{text}"
+                )
+
+            for feeder, writer in feeders:
+                feeder.join()
+
+                if writer.feed_error is not None:
+                    raise writer.feed_error
+
+            os.replace(tmp_sam, paths["combined_sam"])
+            tmp_sam = None
+
+            if bam:
+                sam_to_bam(paths["combined_sam"], sample_threads)
+
+            with open(paths["log"], "w") as fout:
+                fout.write(f"# combined\n{text}\n")
+
+            timings.append((stage, bowtie2_read_count(text), seconds))
+
+            # Unaligned reads not written (nothing left to align)
+            for path in outputs.values():
+                if not os.path.exists(path):
+                    open(path, "w").close()
+
+            for path in inputs.values():
+                os.remove(path)
+
+            inputs = outputs
+
+    except BaseException:
+
+        if process is not None and process.poll() is None:
+            process.terminate()
+            process.wait()
+
+        for feeder, writer in feeders:
+            feeder.join()
+
+        if tmp_sam is not None and os.path.exists(tmp_sam):
+            os.remove(tmp_sam)
+
+        raise
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return timings
+
+
+def collapse_align_sample(base_name, trimmed_inputs, output_dir, indexes,
+                          sample_threads, bowtie2="bowtie2", bam=False,
+                          cache=None):
+    """
+    Run the cascade for one sample on its unique sequences only.
+
+    The trimmed reads are collapsed into unique pairs and singletons
+    (alignment_cache.py). Sequences already in <cache> (an
+    AlignmentCache) are not aligned again; the others are aligned once
+    with align_sample and added to the cache. The SAM files of all
+    stages are then written read by read from the cached records, under
+    the names used by 04.bowtie2.sh. Samples without trimmed FASTQ
+    files (streamed with --stream) go through align_sample. With <bam>
+    the SAM files are replaced by sorted, indexed BAM files.
+
+    Returns a list of (stage, reads, seconds) like align_sample, with
+    the reads of the sample (not the unique sequences) entering each
+    stage and the seconds spent aligning its unique sequences (0 if
+    all were cached).
+    """
+
+    if trimmed_inputs is None:
+        return align_sample(
+            base_name,
+            trimmed_inputs,
+            output_dir,
+            indexes,
+            sample_threads,
+            bowtie2,
+            bam
+        )
+
+    if all(
+        stage_complete(output_dir, base_name, stage)
+        for stage, _ in STAGES
+    ):
+        return []
+
+    sample_dir = os.path.join(output_dir, base_name)
+    os.makedirs(sample_dir, exist_ok=True)
+
+    work_dir = tempfile.mkdtemp(prefix=".collapse.", dir=sample_dir)
+
+    signature = index_signature(indexes, STAGES)
+
+    stage_paths = {
+        stage: stage_output_paths(output_dir, base_name, stage)
+        for stage, _ in STAGES
+    }
+
+    sam_keys = ("paired_sam", "R1_unpaired_sam", "R2_unpaired_sam")
+
+    tmp_paths = {
+        stage: {
+            key: os.path.join(
+                sample_dir,
+                ".tmp." + os.path.basename(paths[key])
+            )
+            for key in sam_keys
+        }
+        for stage, paths in stage_paths.items()
+    }
+
+    logs = {stage: "" for stage, _ in STAGES}
+    seconds = {stage: 0.0 for stage, _ in STAGES}
+
+    try:
+
+        uniques, stats = collapse_reads(trimmed_inputs)
+
+        results = cache.lookup(signature, uniques)
+        missing = [key for key in uniques if key not in results]
+
+        stats["cached"] = len(uniques) - len(missing)
+
+        headers = cache.headers(signature)
+
+        if missing or len(headers) < len(STAGES):
+
+            unique_inputs = {
+                name: os.path.join(work_dir, f"unique_{name}.fastq")
+                for name in (
+                    "R1_paired", "R2_paired", "R1_unpaired", "R2_unpaired"
+                )
+            }
+
+            write_unique_fastq(uniques, missing, unique_inputs)
+
+            for stage, _, stage_seconds in align_sample(
+                base_name,
+                unique_inputs,
+                work_dir,
+                indexes,
+                sample_threads,
+                bowtie2
+            ):
+                seconds[stage] = stage_seconds
+
+            new_results = {}
+            headers = {}
+
+            for stage, _ in STAGES:
+
+                paths = stage_output_paths(work_dir, base_name, stage)
+
+                for key in sam_keys:
+                    header = read_stage_sam(paths[key], stage, new_results)
+
+                    if key == "paired_sam":
+                        headers[stage] = header
+
+                with open(paths["log"]) as log:
+                    logs[stage] = log.read()
+
+            # Sequences without any SAM record are cached as such
+            for key in missing:
+                new_results.setdefault(key, {})
+
+            cache.store(signature, new_results, headers)
+            results.update(new_results)
+
+        reads = expand_alignments(
+            trimmed_inputs,
+            results,
+            headers,
+            tmp_paths
+        )
+
+    except BaseException:
+
+        for paths in tmp_paths.values():
+            for path in paths.values():
+                if os.path.exists(path):
+                    os.remove(path)
+
+        raise
+
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    timings = []
+
+    for stage, paths in stage_paths.items():
+
+        for key in sam_keys:
+            os.replace(tmp_paths[stage][key], paths[key])
+
+            if bam:
+                sam_to_bam(paths[key], sample_threads)
+
+        with open(paths["log"], "w") as fout:
+            fout.write(
+                f"# collapsed: {stats['reads']} reads, "
+                f"{stats['unique']} unique, {stats['cached']} cached\n"
+                f"{logs[stage]}"
+            )
+
+        timings.append((stage, reads[stage], seconds[stage]))
+
+    return timings
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "HELIOS NAD-Seq Step 04: bowtie2 cascade (spike RNA -> "
+            "tRNA/rRNA -> E. coli) with the reads that fail one stage "
+            "piped straight into the next. Samples run concurrently "
+            "under a global thread budget. Writes the same SAM files "
+            "as 04.bowtie2.sh, without the unaligned FASTQ files."
+        )
+    )
+
+    parser.add_argument(
+        "trim_dir",
+        help="Step 03 directory with *R1_trimmed_paired.fastq[.gz] files"
+    )
+
+    parser.add_argument("spike_index", help="Bowtie2 index of the spike RNAs")
+    parser.add_argument("trna_rrna_index", help="Bowtie2 index of tRNA/rRNA")
+    parser.add_argument("ecoli_index", help="Bowtie2 index of E. coli")
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Alignment directory. "
+            "Default: <parent_of_trim_dir>/alignment"
+        )
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Total thread budget for all bowtie2 processes"
+    )
+
+    parser.add_argument(
+        "--sample-threads",
+        type=int,
+        default=8,
+        help=(
+            "Threads per sample, split between the bowtie2 processes "
+            "of its stages (one per process at least, so 9 without "
+            "--combined); --threads / threads per sample samples run "
+            "at the same time. Default: 8"
+        )
+    )
+
+    parser.add_argument(
+        "--combined",
+        action="store_true",
+        help=(
+            "Align paired and singleton reads of a stage in one bowtie2 "
+            "call and write one <sample>_<stage>_combined.sam per stage, "
+            "with the origin of every read in the YO:Z tag."
+        )
+    )
+
+    parser.add_argument(
+        "--bam",
+        action="store_true",
+        help=(
+            "Write coordinate-sorted, indexed BAM files instead of SAM "
+            "files (sorted and compressed with pysam on the sample's "
+            "threads)."
+        )
+    )
+
+    parser.add_argument(
+        "--collapse",
+        action="store_true",
+        help=(
+            "Align every unique read pair and singleton sequence once "
+            "and reuse earlier alignments from the --cache file. The "
+            "per-read SAM files are written from the unique alignments."
+        )
+    )
+
+    parser.add_argument(
+        "--cache",
+        default=None,
+        help=(
+            "SQLite alignment cache for --collapse. "
+            "Default: <output_dir>/alignment_cache.sqlite"
+        )
+    )
+
+    parser.add_argument(
+        "--bowtie2",
+        default="bowtie2",
+        help="bowtie2 executable. Default: bowtie2"
+    )
+
+    args = parser.parse_args()
+
+    if args.sample_threads < 1 or (
+        args.sample_threads < 3 and not args.combined
+    ):
+        raise ValueError(
+            "--sample-threads must be at least 3 "
+            "(one paired and two singleton streams), "
+            "or 1 with --combined."
+        )
+
+    if args.collapse and args.combined:
+        raise ValueError(
+            "--collapse cannot be combined with --combined."
+        )
+
+    start_time = time.perf_counter()
+
+    trim_dir = os.path.abspath(args.trim_dir)
+
+    if not os.path.isdir(trim_dir):
+        raise FileNotFoundError(
+            f"Trimmomatic input directory does not exist: {trim_dir}"
+        )
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(trim_dir),
+            "alignment"
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    indexes = {
+        "spike": args.spike_index,
+        "rrna": args.trna_rrna_index,
+        "eColi": args.ecoli_index,
+    }
+
+    concurrent_samples = max(
+        1,
+        args.threads // sample_thread_usage(
+            args.sample_threads,
+            combined=args.combined
+        )
+    )
+
+    cache = None
+
+    if args.collapse:
+        cache = AlignmentCache(
+            args.cache
+            or os.path.join(output_dir, "alignment_cache.sqlite")
+        )
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Step 04 - Bowtie2 cascade")
+    print("========================================")
+    print(f"Trimmomatic input: {trim_dir}")
+    print(f"Output directory:  {output_dir}")
+    print()
+    print(f"Spike index:       {args.spike_index}")
+    print(f"tRNA/rRNA index:   {args.trna_rrna_index}")
+    print(f"E. coli index:     {args.ecoli_index}")
+    print()
+    print(f"Thread budget:     {args.threads}")
+    print(f"Samples at once:   {concurrent_samples}")
+    print(
+        "Threads/sample:    "
+        f"{sample_thread_usage(args.sample_threads, args.combined)}"
+    )
+    print(f"Combined calls:    {args.combined}")
+    print(f"BAM output:        {args.bam}")
+
+    if cache is not None:
+        print(f"Alignment cache:   {cache.path}")
+
+    print("========================================")
+
+    samples = find_samples(trim_dir, output_dir)
+
+    if not samples:
+        raise RuntimeError(
+            "No samples found. Expected pattern: "
+            "*R1_trimmed_paired.fastq[.gz]"
+        )
+
+    print(f"Samples found: {len(samples)}")
+    print()
+
+    failed = []
+
+    if args.combined:
+        align = partial(align_sample_combined, bam=args.bam)
+    elif args.collapse:
+        align = partial(collapse_align_sample, bam=args.bam, cache=cache)
+    else:
+        align = partial(align_sample, bam=args.bam)
+
+    with ThreadPoolExecutor(max_workers=concurrent_samples) as executor:
+
+        futures = {
+            executor.submit(
+                align,
+                base_name,
+                inputs,
+                output_dir,
+                indexes,
+                args.sample_threads,
+                args.bowtie2
+            ): base_name
+            for base_name, inputs in samples.items()
+        }
+
+        for future in as_completed(futures):
+
+            base_name = futures[future]
+
+            try:
+                timings = future.result()
+            except Exception as error:
+                print(f"ERROR: {base_name}: {error}")
+                print()
+                failed.append(base_name)
+                continue
+
+            if not timings:
+                print(f"{base_name}: alignment already exists. Skipping.")
+                continue
+
+            print(f"{base_name}")
+
+            for stage, reads, seconds in timings:
+
+                # Stages of --collapse with every sequence cached
+                if seconds == 0:
+                    print(f"  {stage:8s} {reads:12d} reads (cached)")
+                    continue
+
+                print(
+                    f"  {stage:8s} {reads:12d} reads in {seconds:8.1f} s "
+                    f"({reads / seconds:,.0f} reads/sec)"
+                )
+
+            print()
+
+    if cache is not None:
+        cache.close()
+
+    elapsed_time = time.perf_counter() - start_time
+
+    print("========================================")
+    print(f"Step 04 completed in {elapsed_time:.2f} seconds.")
+    print(f"Output directory: {output_dir}")
+
+    if failed:
+        print(f"Failed samples: {', '.join(sorted(failed))}")
+
+    print("========================================")
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+#!/bin/bash
+
+#SBATCH -N 1
+#SBATCH --mem=90000
+#SBATCH -t 8:00:00
+#SBATCH -p cpu-single
+
+# ============================================================
+# HELIOS NAD-Seq pipeline
+# Step 04 (alternative): piped Bowtie2 cascade
+#
+# Same alignment order and SAM files as 04.bowtie2.sh, but the
+# reads that fail one stage are piped straight into the next
+# stage and samples run concurrently under one thread budget.
+# No unaligned FASTQ files are written.
+#
+# Usage:
+#   sbatch scripts/04.bowtie2_cascade.sh \
+#       <TRIMMOMATIC_DIR> \
+#       <SPIKE_INDEX> \
+#       <TRNA_RRNA_INDEX> \
+#       <ECOLI_INDEX> \
+#       [OUTPUT_DIR] [OPTIONS]
+#
+# Example:
+#   sbatch scripts/04.bowtie2_cascade.sh \
+#       results/trimmomatic \
+#       /path/to/spikeRnas \
+#       /path/to/trna_rrna \
+#       /path/to/NC_00913.3_pUC19c
+#
+# Any further options are passed to 04.bowtie2_cascade.py, e.g.
+#   --threads 48 --sample-threads 12
+# ============================================================
+
+
+if [ $# -lt 4 ]; then
+    echo "Usage:"
+    echo "$0 <TRIMMOMATIC_DIR> <SPIKE_INDEX> <TRNA_RRNA_INDEX> <ECOLI_INDEX> [OUTPUT_DIR] [OPTIONS]"
+    exit 1
+fi
+
+
+# Load Bowtie2
+module load bio/bowtie2/2.4.5
+
+
+# Activate Conda environment
+source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+conda activate env.helios.yml
+
+
+python scripts/04.bowtie2_cascade.py "$@"
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import heapq
+import multiprocessing
+import os
+import re
+from collections import deque
+
+import pysam
+
+
+# ------------------------------------------------------------
+# UMI handling
+# ------------------------------------------------------------
+
+def extract_barcode(filename):
+    """
+    Extract barcode from filename.
+
+    Example:
+        bc01_tp1_S1_L001_eColi_paired.sam
+        -> bc01
+    """
+    match = re.search(r'(bc\d+)', os.path.basename(filename))
+    return match.group(1) if match else None
+
+
+def read_umi(query_name):
+    """
+    UMI appended to the read name by 01.demultiplex.py
+    (@<read_id>_<UMI>).
+    """
+
+    umi = query_name.rpartition("_")[2]
+
+    if not umi or umi == query_name:
+        raise ValueError(
+            f"Read name without UMI: {query_name}. "
+            "Demultiplex with 01.demultiplex.py to add UMIs."
+        )
+
+    return umi
+
+
+def hamming_one(a, b):
+    """
+    True if two UMIs of equal length differ at exactly one position.
+    """
+
+    if len(a) != len(b):
+        return False
+
+    mismatches = 0
+
+    for x, y in zip(a, b):
+        if x != y:
+            mismatches += 1
+            if mismatches > 1:
+                return False
+
+    return mismatches == 1
+
+
+def directional_clusters(umi_counts):
+    """
+    Group UMIs with the directional method of UMI-tools.
+
+    UMI a absorbs UMI b if they differ at one position and
+    count(a) >= 2 * count(b) - 1. Starting from the most abundant UMI,
+    everything reachable through such edges forms one cluster, i.e.
+    one original molecule.
+
+    Returns a list of clusters; the first UMI of a cluster is its root.
+    """
+
+    umis = sorted(
+        umi_counts,
+        key=lambda umi: (-umi_counts[umi], umi)
+    )
+
+    visited = set()
+    clusters = []
+
+    for root in umis:
+
+        if root in visited:
+            continue
+
+        cluster = [root]
+        visited.add(root)
+        queue = deque([root])
+
+        while queue:
+            node = queue.popleft()
+
+            for other in umis:
+                if (
+                    other not in visited
+                    and umi_counts[node] >= 2 * umi_counts[other] - 1
+                    and hamming_one(node, other)
+                ):
+                    visited.add(other)
+                    cluster.append(other)
+                    queue.append(other)
+
+        clusters.append(cluster)
+
+    return clusters
+
+
+# ------------------------------------------------------------
+# Streaming deduplication
+# ------------------------------------------------------------
+
+def five_prime_position(read):
+    """
+    Unclipped 5' position of an alignment (0-based), so that copies of
+    a molecule with different soft-clipping share one position.
+    """
+
+    cigar = read.cigartuples
+
+    if read.is_reverse:
+        clipped = cigar[-1][1] if cigar and cigar[-1][0] == 4 else 0
+        return read.reference_end - 1 + clipped
+
+    clipped = cigar[0][1] if cigar and cigar[0][0] == 4 else 0
+    return read.reference_start - clipped
+
+
+def is_follower(read):
+    """
+    Read 2 of a pair whose mates both map to the same reference follows
+    the duplicate decision of read 1.
+    """
+
+    return (
+        read.is_paired
+        and read.is_read2
+        and not read.mate_is_unmapped
+        and read.reference_id == read.next_reference_id
+    )
+
+
+def has_follower(read):
+    return (
+        read.is_paired
+        and read.is_read1
+        and not read.mate_is_unmapped
+        and read.reference_id == read.next_reference_id
+    )
+
+
+def dedup_stream(reads, barcode, write, window=1000):
+    """
+    Remove PCR duplicates from coordinate-sorted alignments.
+
+    Reads are grouped by (barcode, reference, strand, unclipped 5'
+    position) and, within a group, UMIs are clustered with the
+    directional method; one read per cluster is kept. For pairs, read 1
+    decides and read 2 follows. Unmapped, secondary and supplementary
+    records are passed through.
+
+    Records are written through <write> in input order. Only the reads
+    within <window> bp of the current position are held in memory: a
+    read 2 still waiting for its read 1 when it falls <window> bp
+    behind is kept, as is one whose read 1 never appears, and the
+    slot of a read 1 is dropped once the position of its read 2 has
+    been passed.
+
+    Returns a statistics dictionary.
+    """
+
+    stats = {
+        "total": 0,
+        "groups": 0,
+        "molecules": 0,
+        "duplicates": 0,
+        "written": 0,
+    }
+
+    # Records in input order with a shared decision slot [keep]
+    fifo = deque()
+
+    # (barcode, reference, strand, 5' position) -> {umi: [slots]}
+    buckets = {}
+    bucket_heap = []
+
+    # Decision slots shared between the two mates of a pair
+    mate_slots = {}
+
+    # Reads 2 waiting for their read 1, in input order:
+    # (position, name, slot)
+    waiting = deque()
+
+    # Reads 1 waiting for their read 2: (mate position, name, slot)
+    expected = []
+
+    current_reference = None
+
+    def flush_bucket(key):
+        umi_slots = buckets.pop(key)
+
+        clusters = directional_clusters(
+            {umi: len(slots) for umi, slots in umi_slots.items()}
+        )
+
+        stats["groups"] += 1
+        stats["molecules"] += len(clusters)
+
+        for cluster in clusters:
+            # Keep the first read carrying the root UMI
+            umi_slots[cluster[0]][0][0] = True
+
+            for umi in cluster:
+                for slot in umi_slots[umi]:
+                    if slot[0] is None:
+                        slot[0] = False
+                        stats["duplicates"] += 1
+
+    def flush_until(position):
+        while bucket_heap and (
+            position is None or bucket_heap[0][0] < position
+        ):
+            _, key = heapq.heappop(bucket_heap)
+            flush_bucket(key)
+
+    def release_mates(position):
+        # Mates whose read 1 did not appear within <window> are kept;
+        # a read 1 that appears later is deduplicated on its own
+        while waiting and (
+            position is None or waiting[0][0] < position - window
+        ):
+            _, name, slot = waiting.popleft()
+
+            if mate_slots.get(name) is slot:
+                del mate_slots[name]
+                slot[0] = True
+
+        # Reads 1 whose read 2 was not at its mate position
+        while expected and (
+            position is None or expected[0][0] < position
+        ):
+            _, name, slot = heapq.heappop(expected)
+
+            if mate_slots.get(name) is slot:
+                del mate_slots[name]
+
+    def emit():
+        while fifo and fifo[0][1][0] is not None:
+            read, slot = fifo.popleft()
+
+            if slot[0]:
+                write(read)
+                stats["written"] += 1
+
+    for read in reads:
+
+        stats["total"] += 1
+
+        if read.reference_id != current_reference:
+            flush_until(None)
+            release_mates(None)
+            current_reference = read.reference_id
+
+        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+            fifo.append((read, [True]))
+            emit()
+            continue
+
+        if is_follower(read):
+            slot = mate_slots.pop(read.query_name, None)
+
+            if slot is None:
+                # Read 1 comes later in coordinate order
+                slot = [None]
+                mate_slots[read.query_name] = slot
+                waiting.append(
+                    (read.reference_start, read.query_name, slot)
+                )
+
+            fifo.append((read, slot))
+
+        else:
+            slot = None
+
+            if has_follower(read):
+                slot = mate_slots.pop(read.query_name, None)
+
+                if slot is None:
+                    # Read 2 comes later in coordinate order
+                    slot = [None]
+                    mate_slots[read.query_name] = slot
+                    heapq.heappush(
+                        expected,
+                        (read.next_reference_start, read.query_name, slot)
+                    )
+
+            if slot is None:
+                slot = [None]
+
+            key = (
+                barcode,
+                read.reference_id,
+                read.is_reverse,
+                five_prime_position(read)
+            )
+
+            if key not in buckets:
+                buckets[key] = {}
+                heapq.heappush(bucket_heap, (key[3], key))
+
+            buckets[key].setdefault(
+                read_umi(read.query_name),
+                []
+            ).append(slot)
+
+            fifo.append((read, slot))
+
+        flush_until(read.reference_start - window)
+        release_mates(read.reference_start)
+        emit()
+
+    flush_until(None)
+    release_mates(None)
+    emit()
+
+    return stats
+
+
+def dedup_file(job):
+    """
+    Deduplicate one alignment file. Input that is not coordinate-sorted
+    is sorted first with samtools sort (bounded memory, spills to disk).
+    """
+
+    input_path, output_path, threads, window = job
+
+    barcode = extract_barcode(input_path)
+
+    tmp_path = os.path.join(
+        os.path.dirname(output_path),
+        ".tmp." + os.path.basename(output_path)
+    )
+    sorted_path = None
+
+    with pysam.AlignmentFile(input_path) as alignments:
+        sort_order = alignments.header.to_dict().get("HD", {}).get("SO")
+
+    if sort_order != "coordinate":
+        sorted_path = tmp_path + ".sorted.bam"
+
+        pysam.sort(
+            "-@", str(threads),
+            "-T", tmp_path + ".sort",
+            "-o", sorted_path,
+            input_path
+        )
+
+        input_path = sorted_path
+
+    write_mode = "wb" if output_path.endswith(".bam") else "w"
+
+    try:
+        with pysam.AlignmentFile(input_path, threads=threads) as alignments, \
+             pysam.AlignmentFile(
+                 tmp_path,
+                 write_mode,
+                 template=alignments,
+                 threads=threads
+             ) as out:
+
+            stats = dedup_stream(
+                alignments,
+                barcode,
+                out.write,
+                window=window
+            )
+
+        os.replace(tmp_path, output_path)
+
+    finally:
+        for path in (tmp_path, sorted_path):
+            if path and os.path.exists(path):
+                os.remove(path)
+
+    return output_path, stats
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Collapse PCR duplicates in the E. coli alignments of "
+            "Step 04 using the UMIs added by 01.demultiplex.py."
+        )
+    )
+
+    parser.add_argument(
+        "input_dir",
+        help=(
+            "Step 04 alignment directory containing per-sample "
+            "subdirectories."
+        )
+    )
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Directory for deduplicated alignments, with the same "
+            "per-sample layout and file names. "
+            "Default: <parent_of_input_dir>/dedup"
+        )
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=4,
+        help="Files deduplicated in parallel. Default: 4."
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=2,
+        help="samtools/htslib threads per file. Default: 2."
+    )
+
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=1000,
+        help=(
+            "Distance in bp behind the current position after which "
+            "a 5' position group is complete. Must exceed the read "
+            "length plus soft-clipping. Default: 1000."
+        )
+    )
+
+    args = parser.parse_args()
+
+
+    # ---------------------------------------------------------
+    # Input/output directories
+    # ---------------------------------------------------------
+
+    input_dir = os.path.abspath(args.input_dir)
+
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(
+            f"Input alignment directory does not exist: {input_dir}"
+        )
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(input_dir),
+            "dedup"
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Step 04 - UMI deduplication")
+    print("========================================")
+    print(f"Input directory:  {input_dir}")
+    print(f"Output directory: {output_dir}")
+    print("========================================")
+
+
+    # ---------------------------------------------------------
+    # Find E. coli alignments recursively
+    # ---------------------------------------------------------
+
+    alignment_files = sorted(
+        glob.glob(
+            os.path.join(input_dir, "**", "*_eColi_*.sam"),
+            recursive=True
+        )
+        + glob.glob(
+            os.path.join(input_dir, "**", "*_eColi_*.bam"),
+            recursive=True
+        )
+    )
+
+    if not alignment_files:
+        raise FileNotFoundError(
+            "No E. coli SAM/BAM files were found under "
+            f"{input_dir}"
+        )
+
+    print(f"E. coli SAM/BAM files found: {len(alignment_files)}")
+    print()
+
+    jobs = []
+
+    for input_path in alignment_files:
+
+        output_path = os.path.join(
+            output_dir,
+            os.path.relpath(input_path, input_dir)
+        )
+
+        os.makedirs(
+            os.path.dirname(output_path),
+            exist_ok=True
+        )
+
+        jobs.append(
+            (input_path, output_path, args.threads, args.window)
+        )
+
+
+    # ---------------------------------------------------------
+    # Deduplicate
+    # ---------------------------------------------------------
+
+    total_all = 0
+    written_all = 0
+
+    with multiprocessing.Pool(
+        processes=args.processes
+    ) as pool:
+
+        for output_path, stats in pool.imap(dedup_file, jobs):
+
+            total_all += stats["total"]
+            written_all += stats["written"]
+
+            print(f"Processed: {os.path.relpath(output_path, output_dir)}")
+            print(f"  Alignments:          {stats['total']}")
+            print(f"  Position groups:     {stats['groups']}")
+            print(f"  Molecules (UMIs):    {stats['molecules']}")
+            print(f"  Duplicates removed:  {stats['duplicates']}")
+            print(f"  Written:             {stats['written']}")
+            print()
+
+
+    if total_all > 0:
+        retained_all_percent = (written_all / total_all) * 100
+    else:
+        retained_all_percent = 0
+
+    print("========================================")
+    print("UMI deduplication completed.")
+    print("----------------------------------------")
+    print(f"Total alignments:    {total_all}")
+    print(f"Written alignments:  {written_all}")
+    print(f"Overall retained:    {retained_all_percent:.2f}%")
+    print(f"Output directory:    {output_dir}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+#!/bin/bash
+
+#SBATCH -N 1
+#SBATCH --mem=90000
+#SBATCH -t 8:00:00
+#SBATCH -p cpu-single
+
+# ============================================================
+# HELIOS NAD-Seq pipeline
+# Step 04b: UMI deduplication
+#
+# Collapses PCR duplicates in the E. coli alignments of Step 04
+# using the UMIs that 01.demultiplex.py appends to the read
+# names. Run it between Step 04 and Step 05 and give its output
+# directory to 05.filter_sam_by_A_start.py instead of the Step 04
+# directory; Step 06 then counts the deduplicated A-start reads.
+#
+# Usage:
+#   sbatch scripts/04.umi_dedup.sh <BOWTIE2_DIR> [OUTPUT_DIR] [OPTIONS]
+#
+# Example:
+#   sbatch scripts/04.umi_dedup.sh results/bowtie2
+#   python scripts/05.filter_sam_by_A_start.py results/dedup
+#
+# If OUTPUT_DIR is omitted, "dedup" is created next to the
+# Step 04 directory, with the same per-sample layout and file
+# names.
+#
+# Any further options are passed to 04.umi_dedup.py, e.g.
+#   --processes 8 --threads 4
+# ============================================================
+
+
+# Check that an input directory was provided
+if [ $# -lt 1 ]; then
+    echo "Usage: $0 <BOWTIE2_DIR> [OUTPUT_DIR] [OPTIONS]"
+    exit 1
+fi
+
+
+# Input and optional output directories
+input_dir="$1"
+shift
+
+output_dir=""
+
+if [[ $# -ge 1 && "$1" != --* ]]; then
+    output_dir="$1"
+    shift
+fi
+
+# Remaining arguments are options for 04.umi_dedup.py
+dedup_options=("$@")
+
+
+# Activate Conda environment
+source /opt/bwhpc/common/devel/miniconda/3-py39-4.12.0/etc/profile.d/conda.sh
+conda activate env.helios.yml
+
+
+# Run UMI deduplication
+if [ -n "$output_dir" ]; then
+
+    python scripts/04.umi_dedup.py \
+        "$input_dir" \
+        "$output_dir" \
+        "${dedup_options[@]}"
+
+else
+
+    python scripts/04.umi_dedup.py \
+        "$input_dir" \
+        "${dedup_options[@]}"
+
+fi
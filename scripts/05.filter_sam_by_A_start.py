@@ -1,17 +1,30 @@
-```python
 #!/usr/bin/env python3
 
 import glob
+import multiprocessing
 import os
 import argparse
 
+import pysam
+
+from feature_counts import FeatureCounter, FeatureIndex, write_counts
+from five_prime import five_prime_end, is_a_start, sam_five_prime_end
+
+
+# Feature index of a counting worker process (see init_counting)
+FEATURE_INDEX = None
+
 
 def filter_sam_by_first_base(sam_path, out_path):
     """
-    Copy SAM headers and retain only alignments for which the
-    first base of the SEQ field is 'A'.
-
-    The SEQ field corresponds to column 10 of a SAM alignment.
+    Copy SAM headers and retain only alignments whose transcript
+    5′ end is an 'A'.
+
+    The 5′ end is the first aligned base of the read in read
+    orientation (see five_prime.py): soft clips are skipped, and for
+    reverse-strand alignments it is the complement of the last aligned
+    base of SEQ (column 10). Unmapped records are tested by the first
+    base of the read.
     """
 
     total_alignments = 0
@@ -26,7 +39,7 @@ def filter_sam_by_first_base(sam_path, out_path):
                 out.write(line)
                 continue
 
-            cols = line.rstrip("\n").split("\t")
+            cols = line.rstrip("\n").split("\t", 10)
 
             # Skip malformed SAM lines
             if len(cols) < 11:
@@ -34,21 +47,193 @@ def filter_sam_by_first_base(sam_path, out_path):
 
             total_alignments += 1
 
-            seq = cols[9]
-
-            if seq.startswith("A"):
+            if is_a_start(sam_five_prime_end(cols)):
                 out.write(line)
                 retained_alignments += 1
 
     return total_alignments, retained_alignments
 
 
+def filter_alignments_by_first_base(input_path, out_path, threads=1):
+    """
+    pysam version of filter_sam_by_first_base() for SAM or BAM input.
+
+    Only the 5′ end of each read is resolved. The header is
+    copied and the retained alignments are written in input order to
+    <out_path> as BAM (SAM if it ends in .sam). <threads> BGZF threads
+    are used for decompression and for compression. A zero-byte input
+    (written by 04.bowtie2.sh for stages without reads) gives a
+    header-only output.
+    """
+
+    total_alignments = 0
+    retained_alignments = 0
+
+    write_mode = "w" if out_path.endswith(".sam") else "wb"
+
+    # pysam cannot open a zero-byte file
+    if os.path.getsize(input_path) == 0:
+
+        with pysam.AlignmentFile(
+            out_path,
+            write_mode,
+            header={"HD": {"VN": "1.0"}}
+        ):
+            pass
+
+        return total_alignments, retained_alignments
+
+    with pysam.AlignmentFile(
+             input_path,
+             check_sq=False,
+             threads=threads
+         ) as alignments, \
+         pysam.AlignmentFile(
+             out_path,
+             write_mode,
+             template=alignments,
+             threads=threads
+         ) as out:
+
+        for read in alignments.fetch(until_eof=True):
+
+            total_alignments += 1
+
+            if is_a_start(five_prime_end(read)):
+                out.write(read)
+                retained_alignments += 1
+
+    return total_alignments, retained_alignments
+
+
+def filter_file(job):
+    """
+    Pool worker: filter one alignment file into a temporary file next
+    to its output and move it into place. Returns (input_path,
+    out_path, total, retained).
+    """
+
+    input_path, out_path, text, threads = job
+
+    tmp_path = os.path.join(
+        os.path.dirname(out_path),
+        ".tmp." + os.path.basename(out_path)
+    )
+
+    try:
+
+        if text:
+            total, retained = filter_sam_by_first_base(input_path, tmp_path)
+        else:
+            total, retained = filter_alignments_by_first_base(
+                input_path,
+                tmp_path,
+                threads=threads
+            )
+
+        os.replace(tmp_path, out_path)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return input_path, out_path, total, retained
+
+
+def count_alignments_by_first_base(
+    input_path,
+    index,
+    threads=1,
+    strandedness=0
+):
+    """
+    Count the A-start reads of a SAM or BAM file by their 5′ end
+    without writing them out (fused Steps 05/06).
+
+    Every record is tested as in filter_alignments_by_first_base().
+    Each retained read is added to a FeatureCounter on <index>, mates of
+    a pair included, as featureCounts 2.0.6 -p counts the reads of the
+    *.Astart files without --countReadPairs. Returns (total, retained,
+    counter); a zero-byte input has no reads.
+    """
+
+    total_alignments = 0
+    retained_alignments = 0
+
+    counter = FeatureCounter(index, strandedness)
+
+    # pysam cannot open a zero-byte file
+    if os.path.getsize(input_path) == 0:
+        return total_alignments, retained_alignments, counter
+
+    with pysam.AlignmentFile(
+        input_path,
+        check_sq=False,
+        threads=threads
+    ) as alignments:
+
+        for read in alignments.fetch(until_eof=True):
+
+            total_alignments += 1
+
+            end = five_prime_end(read)
+
+            if not is_a_start(end):
+                continue
+
+            retained_alignments += 1
+
+            counter.add(end)
+
+    counter.flush()
+
+    return total_alignments, retained_alignments, counter
+
+
+def init_counting(gtf_path, feature_type):
+    """
+    Pool initializer: load the feature index once per worker.
+    """
+
+    global FEATURE_INDEX
+
+    FEATURE_INDEX = FeatureIndex.from_gtf(gtf_path, feature_type)
+
+
+def count_file(job):
+    """
+    Pool worker: count one alignment file into <out_path> (a
+    featureCounts table) and <out_path>.summary. Returns (input_path,
+    out_path, total, retained).
+    """
+
+    input_path, out_path, threads, strandedness = job
+
+    total, retained, counter = count_alignments_by_first_base(
+        input_path,
+        FEATURE_INDEX,
+        threads=threads,
+        strandedness=strandedness
+    )
+
+    write_counts(
+        out_path,
+        counter,
+        input_path,
+        command=f"05.filter_sam_by_A_start.py --gtf {input_path}"
+    )
+
+    return input_path, out_path, total, retained
+
+
 def main():
 
     parser = argparse.ArgumentParser(
         description=(
-            "Filter E. coli SAM alignments generated by Step 04 "
-            "and retain reads whose SEQ field starts with A."
+            "Filter E. coli SAM/BAM alignments generated by Step 04 "
+            "and retain reads whose transcript 5′ end is an A: the "
+            "first aligned base in read orientation, after soft "
+            "clips, complemented for reverse-strand alignments."
         )
     )
 
@@ -56,7 +241,8 @@ def main():
         "input_dir",
         help=(
             "Step 04 alignment directory containing per-sample "
-            "subdirectories."
+            "subdirectories, or the output directory of "
+            "04.umi_dedup.py to count deduplicated reads."
         )
     )
 
@@ -66,12 +252,73 @@ def main():
         default=None,
         help=(
             "Directory for A-start-filtered SAM files. "
-            "Default: <parent_of_input_dir>/Astart"
+            "Default: <parent_of_input_dir>/Astart, or "
+            "<parent_of_input_dir>/featurecounts with --gtf"
+        )
+    )
+
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="Alignment files filtered in parallel"
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=2,
+        help=(
+            "BGZF compression/decompression threads per file. "
+            "Default: 2"
+        )
+    )
+
+    parser.add_argument(
+        "--text",
+        action="store_true",
+        help=(
+            "Filter SAM input line by line and write SAM output "
+            "(*.Astart.sam). BAM input is always read with pysam. "
+            "By default the output is BAM (*.Astart.bam)."
+        )
+    )
+
+    parser.add_argument(
+        "--gtf",
+        default=None,
+        help=(
+            "Intergenic GTF (make_intergenic_gtf.py). Count the "
+            "A-start reads by their 5′ end and write featureCounts "
+            "tables (*.Astart.table) for Step 07 instead of "
+            "A-start alignment files, replacing Step 06."
+        )
+    )
+
+    parser.add_argument(
+        "--feature-type",
+        default="intergenic",
+        help="GTF feature type counted with --gtf. Default: intergenic"
+    )
+
+    parser.add_argument(
+        "--strand",
+        type=int,
+        choices=(0, 1, 2),
+        default=0,
+        help=(
+            "Strandedness with --gtf, as featureCounts -s: 0 "
+            "unstranded (default), 1 stranded, 2 reversely stranded"
         )
     )
 
     args = parser.parse_args()
 
+    if args.gtf and not os.path.isfile(args.gtf):
+        raise FileNotFoundError(
+            f"GTF file does not exist: {args.gtf}"
+        )
+
 
     # ---------------------------------------------------------
     # Input directory
@@ -94,7 +341,7 @@ def main():
     else:
         output_dir = os.path.join(
             os.path.dirname(input_dir),
-            "Astart"
+            "featurecounts" if args.gtf else "Astart"
         )
 
     os.makedirs(output_dir, exist_ok=True)
@@ -105,6 +352,10 @@ def main():
     print("========================================")
     print(f"Input directory:  {input_dir}")
     print(f"Output directory: {output_dir}")
+
+    if args.gtf:
+        print(f"Counting with:    {args.gtf}")
+
     print("========================================")
 
 
@@ -115,16 +366,23 @@ def main():
     #   *_eColi_paired.sam
     #   *_eColi_R1_unpaired.sam
     #   *_eColi_R2_unpaired.sam
+    #
+    # or, with 04.bowtie2_cascade.py --combined:
+    #   *_eColi_combined.sam
+    #
+    # as SAM, or as sorted BAM (*.bam) with BAM output.
+    # 04.umi_dedup.py keeps these names and the layout.
     # ---------------------------------------------------------
 
-    pattern = os.path.join(
-        input_dir,
-        "**",
-        "*_eColi_*.sam"
-    )
-
     sam_files = sorted(
-        glob.glob(pattern, recursive=True)
+        glob.glob(
+            os.path.join(input_dir, "**", "*_eColi_*.sam"),
+            recursive=True
+        )
+        + glob.glob(
+            os.path.join(input_dir, "**", "*_eColi_*.bam"),
+            recursive=True
+        )
     )
 
 
@@ -140,68 +398,103 @@ def main():
 
 
     # ---------------------------------------------------------
-    # Filter each SAM file
+    # Filter the SAM/BAM files on a process pool
     # ---------------------------------------------------------
 
-    total_all = 0
-    retained_all = 0
-
+    jobs = []
 
     for sam_path in sam_files:
 
-        base = os.path.basename(sam_path)
-
-        output_name = base.replace(
-            ".sam",
-            ".Astart.sam"
+        stem, extension = os.path.splitext(
+            os.path.basename(sam_path)
         )
 
-        out_path = os.path.join(
-            output_dir,
-            output_name
-        )
+        if args.gtf:
+
+            jobs.append(
+                (
+                    sam_path,
+                    os.path.join(output_dir, f"{stem}.Astart.table"),
+                    args.threads,
+                    args.strand
+                )
+            )
 
+            continue
 
-        print(f"Processing: {base}")
+        text = args.text and extension == ".sam"
 
+        output_name = f"{stem}.Astart.{'sam' if text else 'bam'}"
 
-        total, retained = filter_sam_by_first_base(
-            sam_path,
-            out_path
+        jobs.append(
+            (
+                sam_path,
+                os.path.join(output_dir, output_name),
+                text,
+                args.threads
+            )
         )
 
 
-        total_all += total
-        retained_all += retained
+    total_all = 0
+    retained_all = 0
 
 
-        if total > 0:
-            retained_percent = (
-                retained / total
-            ) * 100
-        else:
-            retained_percent = 0
+    if args.gtf:
+        worker = count_file
+        pool_options = {
+            "initializer": init_counting,
+            "initargs": (args.gtf, args.feature_type),
+        }
+    else:
+        worker = filter_file
+        pool_options = {}
 
 
-        print(
-            f"  Total alignments:    {total}"
-        )
+    with multiprocessing.Pool(
+        processes=max(1, min(args.processes, len(jobs))),
+        **pool_options
+    ) as pool:
 
-        print(
-            f"  A-start alignments:  {retained}"
-        )
+        for sam_path, out_path, total, retained in pool.imap(
+            worker,
+            jobs
+        ):
 
-        print(
-            f"  Retained:            "
-            f"{retained_percent:.2f}%"
-        )
+            print(f"Processing: {os.path.basename(sam_path)}")
 
-        print(
-            f"  Output:              "
-            f"{output_name}"
-        )
 
-        print()
+            total_all += total
+            retained_all += retained
+
+
+            if total > 0:
+                retained_percent = (
+                    retained / total
+                ) * 100
+            else:
+                retained_percent = 0
+
+
+            print(
+                f"  Total alignments:    {total}"
+            )
+
+            print(
+                f"  A-start alignments:  {retained}"
+            )
+
+            print(
+                f"  Retained:            "
+                f"{retained_percent:.2f}%"
+            )
+
+            print(
+                f"  Output:              "
+                f"{os.path.basename(out_path)}"
+            )
+
+            print()
 
 
     # ---------------------------------------------------------
@@ -231,4 +524,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-```
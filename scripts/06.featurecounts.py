@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import glob
+import os
+import argparse
+
+import pysam
+
+from feature_counts import FeatureCounter, FeatureIndex, write_counts
+from five_prime import five_prime_end
+
+
+def count_alignment_file(input_path, counter, threads=1):
+    """
+    Count the reads of an A-start SAM or BAM file by their 5′ end.
+
+    Every read is counted, both mates of a pair included, as
+    featureCounts 2.0.6 -p counts reads without --countReadPairs; in
+    A-start files one mate is often filtered out. Unmapped reads are
+    reported as Unassigned_Unmapped. Returns the number of counted
+    reads (0 for a zero-byte file).
+    """
+
+    reads = 0
+
+    # pysam cannot open a zero-byte file
+    if os.path.getsize(input_path) == 0:
+        return reads
+
+    with pysam.AlignmentFile(
+        input_path,
+        check_sq=False,
+        threads=threads
+    ) as alignments:
+
+        for read in alignments.fetch(until_eof=True):
+
+            counter.add(five_prime_end(read))
+            reads += 1
+
+    counter.flush()
+
+    return reads
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Count the 5′ ends of A-start E. coli alignments from "
+            "Step 05 per intergenic feature (in-process replacement "
+            "for 06.featurecounts.sh)."
+        )
+    )
+
+    parser.add_argument(
+        "astart_dir",
+        help="Directory containing *_eColi_*.Astart.sam/.bam files."
+    )
+
+    parser.add_argument(
+        "gtf",
+        help="Intergenic GTF generated by make_intergenic_gtf.py."
+    )
+
+    parser.add_argument(
+        "output_dir",
+        nargs="?",
+        default=None,
+        help=(
+            "Directory for the count tables. "
+            "Default: <parent_of_astart_dir>/featurecounts"
+        )
+    )
+
+    parser.add_argument(
+        "--feature-type",
+        default="intergenic",
+        help="GTF feature type to count. Default: intergenic"
+    )
+
+    parser.add_argument(
+        "--strand",
+        type=int,
+        choices=(0, 1, 2),
+        default=0,
+        help=(
+            "Strandedness, as featureCounts -s: 0 unstranded "
+            "(default), 1 stranded, 2 reversely stranded"
+        )
+    )
+
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=2,
+        help="BGZF decompression threads. Default: 2"
+    )
+
+    args = parser.parse_args()
+
+
+    # ---------------------------------------------------------
+    # Inputs and output directory
+    # ---------------------------------------------------------
+
+    astart_dir = os.path.abspath(args.astart_dir)
+
+    if not os.path.isdir(astart_dir):
+        raise FileNotFoundError(
+            f"A-start SAM directory does not exist: {astart_dir}"
+        )
+
+    if not os.path.isfile(args.gtf):
+        raise FileNotFoundError(
+            f"Intergenic GTF does not exist: {args.gtf}"
+        )
+
+
+    if args.output_dir:
+        output_dir = os.path.abspath(args.output_dir)
+    else:
+        output_dir = os.path.join(
+            os.path.dirname(astart_dir),
+            "featurecounts"
+        )
+
+    os.makedirs(output_dir, exist_ok=True)
+
+
+    print("========================================")
+    print("HELIOS NAD-Seq: Step 06 - 5′-end counts")
+    print("========================================")
+    print(f"Input SAM directory: {astart_dir}")
+    print(f"Intergenic GTF:      {args.gtf}")
+    print(f"Output directory:    {output_dir}")
+    print("========================================")
+
+
+    # ---------------------------------------------------------
+    # Find A-start E. coli SAM files
+    # ---------------------------------------------------------
+
+    sam_files = sorted(
+        glob.glob(os.path.join(astart_dir, "*_eColi_*.Astart.sam"))
+        + glob.glob(os.path.join(astart_dir, "*_eColi_*.Astart.bam"))
+    )
+
+    if not sam_files:
+        raise FileNotFoundError(
+            "No A-start E. coli SAM files found in "
+            f"{astart_dir}"
+        )
+
+    print(f"SAM files found: {len(sam_files)}")
+
+
+    # ---------------------------------------------------------
+    # Load the annotation once for all files
+    # ---------------------------------------------------------
+
+    index = FeatureIndex.from_gtf(args.gtf, args.feature_type)
+
+    print(f"Meta-features:   {len(index.genes)}")
+    print()
+
+
+    # =========================================================
+    # Count every file
+    # =========================================================
+
+    for sam_path in sam_files:
+
+        filename = os.path.basename(sam_path)
+
+        output_file = os.path.join(
+            output_dir,
+            os.path.splitext(filename)[0] + ".table"
+        )
+
+
+        if os.path.exists(output_file):
+            print(f"Skipping {filename}:")
+            print(f"{output_file} already exists.")
+            print()
+            continue
+
+
+        print("----------------------------------------")
+        print(f"Processing: {filename}")
+
+        counter = FeatureCounter(index, args.strand)
+
+        reads = count_alignment_file(
+            sam_path,
+            counter,
+            threads=args.threads
+        )
+
+        write_counts(
+            output_file,
+            counter,
+            sam_path,
+            command=f"06.featurecounts.py {sam_path}"
+        )
+
+        print(f"  Reads:           {reads}")
+        print(f"  Assigned:        {counter.summary['Assigned']}")
+        print(f"Output: {output_file}")
+        print()
+
+
+    print("========================================")
+    print("Step 06 completed.")
+    print(f"Output directory: {output_dir}")
+    print("========================================")
+
+
+if __name__ == "__main__":
+    main()
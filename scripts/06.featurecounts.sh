@@ -1,4 +1,3 @@
-```bash
 #!/bin/bash
 
 #SBATCH -N 1
@@ -23,6 +22,19 @@ set -euo pipefail
 #       results/Astart \
 #       reference/ecoli_intergenic.gtf
 #
+# All paired-end files (*_paired, *_combined) are counted in one
+# featureCounts call with -p and all single-end files in a second
+# call, each with FEATURECOUNTS_THREADS threads (default: the CPUs
+# allocated by SLURM). The annotation is parsed once per call and
+# the output tables
+#   eColi_paired.Astart.multi.table
+#   eColi_single.Astart.multi.table
+# hold one count column per input file, which Step 07 reads
+# directly. An existing table is reused only if its count columns
+# are the current input files. With PER_FILE=1 every file is counted
+# in its own call into <file>.table as before. Keep one kind of
+# table per directory: Step 07 stops on files counted in both.
+#
 # If OUTPUT_DIR is omitted, "featurecounts" will be created
 # next to the Astart input directory.
 # ============================================================
@@ -92,12 +104,17 @@ if [ ! -x "$FEATURECOUNTS" ]; then
 fi
 
 
+THREADS="${FEATURECOUNTS_THREADS:-${SLURM_CPUS_ON_NODE:-$(nproc)}}"
+PER_FILE="${PER_FILE:-0}"
+
+
 echo "========================================"
 echo "HELIOS NAD-Seq: Step 06 - featureCounts"
 echo "========================================"
 echo "Input SAM directory: $ASTART_DIR"
 echo "Intergenic GTF:      $INTERGENIC_GTF"
 echo "Output directory:    $OUTPUT_DIR"
+echo "featureCounts threads: $THREADS"
 echo "========================================"
 
 
@@ -107,13 +124,16 @@ echo "========================================"
 
 shopt -s nullglob
 
-SAM_FILES=("$ASTART_DIR"/*_eColi_*.Astart.sam)
+SAM_FILES=(
+    "$ASTART_DIR"/*_eColi_*.Astart.sam
+    "$ASTART_DIR"/*_eColi_*.Astart.bam
+)
 
 
 if [ ${#SAM_FILES[@]} -eq 0 ]; then
     echo "ERROR: No A-start E. coli SAM files found."
     echo "Expected pattern:"
-    echo "*_eColi_*.Astart.sam"
+    echo "*_eColi_*.Astart.sam (or .bam)"
     exit 1
 fi
 
@@ -123,14 +143,118 @@ echo
 
 
 # ============================================================
-# Run featureCounts
+# Run featureCounts once for all paired-end and once for all
+# single-end files
+# ============================================================
+
+if [ "$PER_FILE" != "1" ]; then
+
+    PAIRED_FILES=()
+    SINGLE_FILES=()
+
+    for SAM_FILE in "${SAM_FILES[@]}"; do
+
+        filename="$(basename "$SAM_FILE")"
+
+        # Combined SAMs (04.bowtie2_cascade.py --combined) hold
+        # the pairs and singletons of a sample; with -p
+        # featureCounts counts their singletons as single-end reads
+        if [[ "$filename" == *_paired.Astart.[sb]am ]] || \
+           [[ "$filename" == *_combined.Astart.[sb]am ]]; then
+            PAIRED_FILES+=("$SAM_FILE")
+        else
+            SINGLE_FILES+=("$SAM_FILE")
+        fi
+
+    done
+
+
+    for layout in paired single; do
+
+        if [ "$layout" == "paired" ]; then
+            FILES=("${PAIRED_FILES[@]}")
+            PAIRED_OPTION=(-p)
+        else
+            FILES=("${SINGLE_FILES[@]}")
+            PAIRED_OPTION=()
+        fi
+
+
+        if [ ${#FILES[@]} -eq 0 ]; then
+            continue
+        fi
+
+
+        OUTPUT_FILE="${OUTPUT_DIR}/eColi_${layout}.Astart.multi.table"
+
+
+        # The table is kept only if its count columns (from column
+        # 7 of the header) are the current input files; otherwise
+        # samples were added or removed and all files are recounted
+        if [ -f "$OUTPUT_FILE" ]; then
+
+            TABLE_FILES="$(sed -n '/^#/d; p; q' "$OUTPUT_FILE" | cut -f 7-)"
+            INPUT_FILES="$(IFS=$'\t'; echo "${FILES[*]}")"
+
+            if [ "$TABLE_FILES" == "$INPUT_FILES" ]; then
+                echo "Skipping ${layout}-end files:"
+                echo "$OUTPUT_FILE already exists."
+                echo
+                continue
+            fi
+
+            echo "Input files of $OUTPUT_FILE changed;"
+            echo "recounting the ${layout}-end files."
+
+        fi
+
+
+        echo "----------------------------------------"
+        echo "Counting ${#FILES[@]} ${layout}-end files"
+
+
+        "$FEATURECOUNTS" \
+            "${PAIRED_OPTION[@]}" \
+            -T "$THREADS" \
+            -a "$INTERGENIC_GTF" \
+            -t intergenic \
+            -o "$OUTPUT_FILE" \
+            "${FILES[@]}"
+
+
+        if [ $? -ne 0 ]; then
+            echo "ERROR: featureCounts failed for the"
+            echo "${layout}-end files."
+            exit 1
+        fi
+
+
+        echo "Output: $OUTPUT_FILE"
+        echo
+
+    done
+
+
+    echo "========================================"
+    echo "Step 06 completed."
+    echo "Output directory: $OUTPUT_DIR"
+    echo "========================================"
+
+    exit 0
+
+fi
+
+
+# ============================================================
+# Run featureCounts per file (PER_FILE=1)
 # ============================================================
 
 for SAM_FILE in "${SAM_FILES[@]}"; do
 
     filename="$(basename "$SAM_FILE")"
 
-    base="${filename%.sam}"
+    # featureCounts reads SAM and BAM alike
+    base="${filename%.[sb]am}"
 
     OUTPUT_FILE="${OUTPUT_DIR}/${base}.table"
 
@@ -149,14 +273,20 @@ for SAM_FILE in "${SAM_FILES[@]}"; do
 
     # --------------------------------------------------------
     # Paired-end SAM
+    #
+    # Combined SAMs (04.bowtie2_cascade.py --combined) hold the
+    # pairs and singletons of a sample; with -p featureCounts
+    # counts their singletons as in the single-end tables.
     # --------------------------------------------------------
 
-    if [[ "$filename" == *_paired.Astart.sam ]]; then
+    if [[ "$filename" == *_paired.Astart.[sb]am ]] || \
+       [[ "$filename" == *_combined.Astart.[sb]am ]]; then
 
         echo "Detected paired-end alignment."
 
         "$FEATURECOUNTS" \
             -p \
+            -T "$THREADS" \
             -a "$INTERGENIC_GTF" \
             -t intergenic \
             -o "$OUTPUT_FILE" \
@@ -172,6 +302,7 @@ for SAM_FILE in "${SAM_FILES[@]}"; do
         echo "Detected single-end alignment."
 
         "$FEATURECOUNTS" \
+            -T "$THREADS" \
             -a "$INTERGENIC_GTF" \
             -t intergenic \
             -o "$OUTPUT_FILE" \
@@ -201,4 +332,3 @@ echo "========================================"
 echo "Step 06 completed."
 echo "Output directory: $OUTPUT_DIR"
 echo "========================================"
-```
@@ -1,12 +1,25 @@
-```python
 #!/usr/bin/env python3
 
 import pandas as pd
 import glob
+import hashlib
+import json
 import os
 import re
 import argparse
 
+from count_cube import (
+    CSV_FILENAME,
+    CUBE_FILENAME,
+    CountCube,
+    export_csv,
+    load_cube,
+)
+
+
+# Fingerprints of the merged tables, next to the count cube
+MANIFEST_FILENAME = "merged_by_barcode_Astart_readCount_manifest.json"
+
 
 # ------------------------------------------------------------
 # Helper functions
@@ -44,6 +57,304 @@ def timepoint_sort_key(tp):
     return int(match.group()) if match else 0
 
 
+def find_count_columns(table_files):
+    """
+    List the count columns of featureCounts tables as
+    (name, file, column) entries.
+
+    A per-file table (<sample>.Astart.table) has one count column
+    (column 6) and is named after its file. A multi-file table of
+    06.featurecounts.sh (*.multi.table) has one count column per
+    input file; each is named as the per-file table of that input,
+    e.g. bc01_tp1_..._eColi_paired.Astart.table.
+
+    Raises ValueError if two entries have the same name, e.g. after a
+    PER_FILE=1 run and a multi-file run of 06.featurecounts.sh into
+    the same directory, which would count that input twice.
+    """
+
+    entries = []
+    sources = {}
+
+    def add_entry(name, file, column):
+
+        if name in sources:
+            raise ValueError(
+                f"Counts of {name} found in both {sources[name]} "
+                f"and {file}. Remove one of them."
+            )
+
+        sources[name] = file
+        entries.append((name, file, column))
+
+    for file in sorted(table_files):
+
+        if not file.endswith(".multi.table"):
+            add_entry(os.path.basename(file), file, 6)
+            continue
+
+        header = pd.read_csv(
+            file,
+            sep="\t",
+            comment="#",
+            nrows=0
+        ).columns
+
+        for column, sample_file in enumerate(header[6:], start=6):
+
+            name = re.sub(
+                r"\.[sb]am$",
+                "",
+                os.path.basename(sample_file)
+            ) + ".table"
+
+            add_entry(name, file, column)
+
+    return entries
+
+
+def table_kind(name):
+    """
+    Alignment layout of a count entry: "paired", "unpaired" or
+    "combined" (04.bowtie2_cascade.py --combined), else None.
+
+    "unpaired" is tested before "paired" because the word
+    "unpaired" also contains "paired".
+    """
+
+    for kind in ("combined", "unpaired", "paired"):
+        if f"_{kind}" in name:
+            return kind
+
+    return None
+
+
+def read_count_columns(file, columns):
+    """
+    Read the Geneid column and the count <columns> (positions) of a
+    featureCounts table. Returns a DataFrame indexed by Geneid with
+    one int32 column per requested position.
+    """
+
+    header = pd.read_csv(
+        file,
+        sep="\t",
+        comment="#",
+        nrows=0
+    ).columns
+
+    if len(header) < 7 or max(columns) >= len(header):
+        raise ValueError(
+            f"Unexpected featureCounts format: "
+            f"{file}"
+        )
+
+    df = pd.read_csv(
+        file,
+        sep="\t",
+        comment="#",
+        header=0,
+        usecols=[0] + list(columns),
+        dtype={
+            header[column]: "int32"
+            for column in columns
+        }
+    )
+
+    df = df.set_index(header[0])
+    df.index.name = "Geneid"
+
+    return df[[header[column] for column in columns]]
+
+
+def plan_merge(entries):
+    """
+    Group count entries by time point and barcode.
+
+    Returns {tp: {"total": n_entries, "maps": {kind: {barcode:
+    entries}}, "barcodes": {barcode: entries}}}. A barcode is merged
+    from its combined tables if it has any, otherwise from its paired
+    plus unpaired tables, which must both exist.
+    """
+
+    plan = {}
+
+    for entry in entries:
+
+        name = entry[0]
+        tp = extract_timepoint(name)
+
+        if tp is None:
+            continue
+
+        tp_plan = plan.setdefault(
+            tp,
+            {"total": 0, "maps": {}}
+        )
+
+        tp_plan["total"] += 1
+
+        kind = table_kind(name)
+        barcode = extract_barcode(name)
+
+        if kind and barcode:
+            tp_plan["maps"].setdefault(kind, {}).setdefault(
+                barcode,
+                []
+            ).append(entry)
+
+    for tp_plan in plan.values():
+
+        maps = tp_plan["maps"]
+
+        paired_map = maps.get("paired", {})
+        unpaired_map = maps.get("unpaired", {})
+        combined_map = maps.get("combined", {})
+
+        barcodes = {}
+
+        for barcode in sorted(
+            set(paired_map).intersection(unpaired_map).union(
+                combined_map
+            )
+        ):
+
+            # A combined table already holds the paired and
+            # unpaired counts of its sample
+            if barcode in combined_map:
+                barcodes[barcode] = combined_map[barcode]
+            else:
+                barcodes[barcode] = (
+                    paired_map[barcode]
+                    + unpaired_map[barcode]
+                )
+
+        tp_plan["barcodes"] = barcodes
+
+    return plan
+
+
+def merge_counts(plan):
+    """
+    Sum the count entries of every (time point, barcode) of a
+    plan_merge() plan into one Series indexed by (tp, barcode,
+    Geneid). Every table is parsed once, with all its needed
+    count columns, and all entries are summed in one groupby.
+    """
+
+    keys_by_file = {}
+
+    for tp, tp_plan in plan.items():
+        for barcode, entries in tp_plan["barcodes"].items():
+            for _, file, column in entries:
+                keys_by_file.setdefault(file, []).append(
+                    (column, tp, barcode)
+                )
+
+    pieces = []
+    keys = []
+
+    for file, file_keys in sorted(keys_by_file.items()):
+
+        columns = sorted({column for column, _, _ in file_keys})
+
+        df = read_count_columns(file, columns)
+
+        for column, tp, barcode in file_keys:
+
+            pieces.append(df.iloc[:, columns.index(column)])
+            keys.append((tp, barcode))
+
+    if not pieces:
+        return pd.Series(
+            dtype="int32",
+            index=pd.MultiIndex.from_tuples(
+                [],
+                names=["tp", "barcode", "Geneid"]
+            )
+        )
+
+    return pd.concat(
+        pieces,
+        keys=keys,
+        names=["tp", "barcode", "Geneid"]
+    ).groupby(level=["tp", "barcode", "Geneid"]).sum()
+
+
+def file_fingerprint(file, previous=None):
+    """
+    Size, modification time and SHA-1 of a table file. The SHA-1 of
+    <previous> (an earlier fingerprint) is reused when size and
+    modification time are unchanged.
+    """
+
+    stat = os.stat(file)
+
+    fingerprint = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+    if previous and all(
+        previous.get(key) == value
+        for key, value in fingerprint.items()
+    ):
+        fingerprint["sha1"] = previous["sha1"]
+        return fingerprint
+
+    digest = hashlib.sha1()
+
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    fingerprint["sha1"] = digest.hexdigest()
+
+    return fingerprint
+
+
+def timepoint_signature(tp_plan, fingerprints):
+    """
+    Digest of the tables and count columns merged for one time
+    point: it changes when any input of the time point changes.
+    """
+
+    inputs = sorted(
+        (barcode, name, column, fingerprints[file]["sha1"])
+        for barcode, entries in tp_plan["barcodes"].items()
+        for name, file, column in entries
+    )
+
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+
+def read_manifest(output_dir):
+    """
+    Manifest of the previous Step 07 run ({"files": {path:
+    fingerprint}, "timepoints": {tp: signature}}), empty if there is
+    none.
+    """
+
+    path = os.path.join(output_dir, MANIFEST_FILENAME)
+
+    if not os.path.isfile(path):
+        return {"files": {}, "timepoints": {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(output_dir, manifest):
+
+    path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = os.path.join(output_dir, ".tmp." + MANIFEST_FILENAME)
+
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_path, path)
+
+
 # ------------------------------------------------------------
 # Main
 # ------------------------------------------------------------
@@ -75,6 +386,26 @@ def main():
         )
     )
 
+    parser.add_argument(
+        "--no-csv",
+        action="store_true",
+        help=(
+            "Only write the count cube, not the per-time-point "
+            "CSV files (count_cube.export_csv() writes them later)."
+        )
+    )
+
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help=(
+            "Re-merge every time point. By default only time "
+            "points whose tables changed since the last run "
+            "(see the manifest next to the count cube) are "
+            "re-parsed; the others are taken from the cube."
+        )
+    )
+
     args = parser.parse_args()
 
 
@@ -131,16 +462,20 @@ def main():
     )
 
 
+    # One entry per count column; multi-file tables of
+    # 06.featurecounts.sh hold several
+    all_entries = find_count_columns(all_table_files)
+
+
+
     # --------------------------------------------------------
     # Identify available time points
     # --------------------------------------------------------
 
+    plan = plan_merge(all_entries)
+
     timepoints = sorted(
-        {
-            extract_timepoint(file)
-            for file in all_table_files
-            if extract_timepoint(file) is not None
-        },
+        plan,
         key=timepoint_sort_key
     )
 
@@ -160,121 +495,47 @@ def main():
     print()
 
 
-    # ========================================================
-    # Process each time point
-    # ========================================================
+    # --------------------------------------------------------
+    # Select the tables of every time point and barcode
+    # --------------------------------------------------------
 
     for tp in timepoints:
 
-        print("----------------------------------------")
-        print(f"Processing {tp}")
-
+        tp_plan = plan[tp]
+        maps = tp_plan["maps"]
 
-        # ----------------------------------------------------
-        # Find files belonging to this time point
-        #
-        # glob.glob is intentionally used here to preserve
-        # the original workflow style.
-        # ----------------------------------------------------
+        print("----------------------------------------")
+        print(f"Selecting {tp}")
 
-        tp_files = glob.glob(
-            os.path.join(
-                input_dir,
-                f"*{tp}*.table"
-            )
+        print(
+            f"  Total tables:    {tp_plan['total']}"
         )
 
+        for kind in ("paired", "unpaired", "combined"):
 
-        # Separate paired and unpaired tables.
-        #
-        # Exclude "unpaired" from paired_files because the
-        # word "unpaired" also contains "paired".
-        paired_files = [
-            file
-            for file in glob.glob(
-                os.path.join(
-                    input_dir,
-                    f"*{tp}*_paired*table"
-                )
+            n_tables = sum(
+                len(entries)
+                for entries in maps.get(kind, {}).values()
             )
-            if "_unpaired" not in os.path.basename(file)
-        ]
 
-
-        unpaired_files = glob.glob(
-            os.path.join(
-                input_dir,
-                f"*{tp}*_unpaired*table"
+            print(
+                f"  {kind.capitalize() + ' tables:':<17}"
+                f"{n_tables}"
             )
-        )
-
 
-        print(
-            f"  Total tables:    {len(tp_files)}"
-        )
 
-        print(
-            f"  Paired tables:   {len(paired_files)}"
-        )
-
-        print(
-            f"  Unpaired tables: {len(unpaired_files)}"
-        )
-
-
-        if not paired_files or not unpaired_files:
+        if "combined" not in maps and (
+            "paired" not in maps or "unpaired" not in maps
+        ):
 
             print(
                 f"WARNING: Skipping {tp}: "
                 "missing paired or unpaired tables."
             )
 
-            print()
-            continue
-
-
-        # ----------------------------------------------------
-        # Group files by barcode
-        # ----------------------------------------------------
-
-        paired_map = {}
-        unpaired_map = {}
+            tp_plan["barcodes"] = {}
 
-
-        for file in paired_files:
-
-            barcode = extract_barcode(file)
-
-            if barcode:
-                paired_map.setdefault(
-                    barcode,
-                    []
-                ).append(file)
-
-
-        for file in unpaired_files:
-
-            barcode = extract_barcode(file)
-
-            if barcode:
-                unpaired_map.setdefault(
-                    barcode,
-                    []
-                ).append(file)
-
-
-        # ----------------------------------------------------
-        # Barcodes present in both groups
-        # ----------------------------------------------------
-
-        common_barcodes = sorted(
-            set(paired_map.keys()).intersection(
-                unpaired_map.keys()
-            )
-        )
-
-
-        if not common_barcodes:
+        elif not tp_plan["barcodes"]:
 
             print(
                 f"WARNING: Skipping {tp}: "
@@ -282,206 +543,182 @@ def main():
                 "paired and unpaired files."
             )
 
-            print()
-            continue
-
-
-        print(
-            "  Barcodes: "
-            + ", ".join(common_barcodes)
-        )
-
-
-        # ----------------------------------------------------
-        # Create time-point output directory
-        # ----------------------------------------------------
-
-        tp_output_dir = os.path.join(
-            output_dir,
-            tp
-        )
-
-        os.makedirs(
-            tp_output_dir,
-            exist_ok=True
-        )
-
-
-        # ----------------------------------------------------
-        # Merge counts
-        # ----------------------------------------------------
-
-        merged_df = None
-
-
-        for barcode in common_barcodes:
-
-            all_files = (
-                paired_map[barcode]
-                + unpaired_map[barcode]
-            )
-
+        else:
 
             print(
-                f"  {barcode}: merging "
-                f"{len(all_files)} tables"
+                "  Barcodes: "
+                + ", ".join(tp_plan["barcodes"])
             )
 
-
-            barcode_df = None
-
-
-            for file in all_files:
-
-                df = pd.read_csv(
-                    file,
-                    sep="\t",
-                    comment="#",
-                    header=0
+            for barcode, entries in tp_plan["barcodes"].items():
+                print(
+                    f"  {barcode}: merging "
+                    f"{len(entries)} tables"
                 )
 
+        print()
 
-                # featureCounts output:
-                #
-                # Geneid  Chr  Start  End  Strand  Length  sample
-                #
-                # First column = Geneid
-                # Seventh column = count
-
-                if df.shape[1] < 7:
-                    raise ValueError(
-                        f"Unexpected featureCounts format: "
-                        f"{file}"
-                    )
-
-
-                df = df.iloc[:, [0, 6]].copy()
 
-                df.columns = [
-                    "Geneid",
-                    "count"
-                ]
+    # --------------------------------------------------------
+    # Time points whose inputs changed since the last run
+    # --------------------------------------------------------
 
+    manifest = read_manifest(output_dir)
 
-                # Ensure numeric count values
-                df["count"] = pd.to_numeric(
-                    df["count"],
-                    errors="raise"
-                )
+    cube_filename = os.path.join(
+        output_dir,
+        CUBE_FILENAME
+    )
 
+    previous_cube = None
 
-                if barcode_df is None:
+    if not args.full and os.path.isfile(cube_filename):
+        previous_cube = load_cube(cube_filename, mmap=False)
 
-                    barcode_df = df
 
-                else:
+    fingerprints = {
+        file: file_fingerprint(file, manifest["files"].get(file))
+        for file in sorted(
+            {
+                file
+                for tp_plan in plan.values()
+                for entries in tp_plan["barcodes"].values()
+                for _, file, _ in entries
+            }
+        )
+    }
 
-                    barcode_df = pd.merge(
-                        barcode_df,
-                        df,
-                        on="Geneid",
-                        how="outer",
-                        suffixes=(
-                            "",
-                            "_new"
-                        )
-                    ).fillna(0)
+    signatures = {
+        tp: timepoint_signature(plan[tp], fingerprints)
+        for tp in timepoints
+    }
 
 
-                    barcode_df["count"] = (
-                        barcode_df["count"]
-                        + barcode_df["count_new"]
-                    )
+    merged_tps = [
+        tp
+        for tp in timepoints
+        if plan[tp]["barcodes"]
+    ]
 
+    changed = [
+        tp
+        for tp in merged_tps
+        if previous_cube is None
+        or not previous_cube.has_timepoint(tp)
+        or manifest["timepoints"].get(tp) != signatures[tp]
+    ]
 
-                    barcode_df.drop(
-                        columns=["count_new"],
-                        inplace=True
-                    )
+    unchanged = [
+        tp
+        for tp in merged_tps
+        if tp not in changed
+    ]
 
 
-            # Rename count column to barcode
-            barcode_df.rename(
-                columns={
-                    "count": barcode
-                },
-                inplace=True
-            )
+    print(
+        "Time points to merge: "
+        + (", ".join(changed) or "none")
+    )
 
+    if unchanged:
+        print(
+            "Unchanged, from the count cube: "
+            + ", ".join(unchanged)
+        )
 
-            # ------------------------------------------------
-            # Add barcode to combined matrix
-            # ------------------------------------------------
+    print()
 
-            if merged_df is None:
 
-                merged_df = barcode_df
+    # ========================================================
+    # Merge the changed time points in one pass
+    # ========================================================
 
-            else:
+    counts = merge_counts(
+        {
+            tp: plan[tp]
+            for tp in changed
+        }
+    )
 
-                merged_df = pd.merge(
-                    merged_df,
-                    barcode_df,
-                    on="Geneid",
-                    how="outer"
-                ).fillna(0)
+    if unchanged:
+        counts = pd.concat(
+            [
+                counts,
+                previous_cube.to_series(unchanged)
+            ]
+        )
 
 
-        # ----------------------------------------------------
-        # Arrange barcode columns numerically
-        # ----------------------------------------------------
+    # --------------------------------------------------------
+    # Gene x barcode x time-point count cube
+    # --------------------------------------------------------
 
-        barcode_columns = sorted(
-            [
-                col
-                for col in merged_df.columns
-                if col.startswith("bc")
-            ],
-            key=lambda x: int(
-                re.search(r'\d+', x).group()
-            )
+    barcodes = sorted(
+        {
+            barcode
+            for tp_plan in plan.values()
+            for barcode in tp_plan["barcodes"]
+        },
+        key=lambda x: int(
+            re.search(r'\d+', x).group()
         )
+    )
 
+    cube = CountCube.from_series(
+        counts,
+        timepoints,
+        barcodes
+    )
 
-        merged_df = merged_df[
-            ["Geneid"] + barcode_columns
-        ]
+    cube.save(cube_filename)
 
+    write_manifest(
+        output_dir,
+        {
+            "files": fingerprints,
+            "timepoints": signatures,
+        }
+    )
 
-        # Convert counts to integers
-        for barcode in barcode_columns:
+    print("Count cube written:")
+    print(f"  {cube_filename}")
 
-            merged_df[barcode] = (
-                merged_df[barcode]
-                .astype(int)
-            )
 
+    # --------------------------------------------------------
+    # Per-time-point CSV export
+    # --------------------------------------------------------
 
-        # ----------------------------------------------------
-        # Write merged matrix
-        # ----------------------------------------------------
+    if not args.no_csv:
 
-        output_filename = os.path.join(
-            tp_output_dir,
-            "merged_by_barcode_Astart_readCount.csv"
-        )
+        # Changed time points, and unchanged ones whose CSV is
+        # missing
+        export_tps = [
+            tp
+            for tp in timepoints
+            if tp in changed
+            or not os.path.isfile(
+                os.path.join(output_dir, tp, CSV_FILENAME)
+            )
+        ]
 
+        for output_filename in export_csv(
+            cube,
+            output_dir,
+            export_tps
+        ):
 
-        merged_df.to_csv(
-            output_filename,
-            index=False
-        )
+            tp = os.path.basename(os.path.dirname(output_filename))
 
+            print(
+                f"{tp}: merged table written:"
+            )
 
-        print(
-            f"  Merged table written:"
-        )
+            print(
+                f"  {output_filename}"
+            )
 
-        print(
-            f"  {output_filename}"
-        )
 
-        print()
+    print()
 
 
     print("========================================")
@@ -492,4 +729,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-```
@@ -3,6 +3,11 @@
 import argparse
 import os
 import pickle as pkl
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from joblib.externals.loky import get_reusable_executor
 
 import numpy as np
 import pandas as pd
@@ -10,6 +15,237 @@ import pandas as pd
 from pydeseq2.dds import DeseqDataSet
 from pydeseq2.default_inference import DefaultInference
 
+from count_cube import find_cube, load_cube
+from dds_store import (
+    DDS_SUFFIX,
+    LEGACY_DDS_SUFFIX,
+    check_settings,
+    save_dds,
+)
+
+
+def log(message):
+    """
+    Print one line with a single write, so that the lines of
+    concurrent fits do not interleave.
+    """
+
+    sys.stdout.write(message + "\n")
+    sys.stdout.flush()
+
+
+def fit_timepoint(tp, df, output_dds, n_cpus, min_total_count):
+    """
+    Fit the PyDESeq2 model of one time point from its gene x barcode
+    count matrix <df> and save the DDS to <output_dds> (save_dds(), or
+    a *_dds.pkl pickle if the fit lacks arrays it needs), using
+    <n_cpus> CPUs. Returns (tp, wall time in seconds).
+
+    Runs in a worker process when several time points are fitted
+    at once.
+    """
+
+    start_time = time.perf_counter()
+
+    if df.shape[1] != 8:
+        raise ValueError(
+            f"[tp{tp}] Expected 8 barcode samples, "
+            f"found {df.shape[1]}."
+        )
+
+    # ----------------------------------------------------
+    # Make sure barcode order is bc01-bc08
+    # ----------------------------------------------------
+
+    expected_barcodes = [
+        f"bc{i:02d}"
+        for i in range(1, 9)
+    ]
+
+    missing_barcodes = [
+        bc
+        for bc in expected_barcodes
+        if bc not in df.columns
+    ]
+
+    if missing_barcodes:
+        raise ValueError(
+            f"[tp{tp}] Missing expected barcodes: "
+            f"{', '.join(missing_barcodes)}"
+        )
+
+    df = df[expected_barcodes]
+
+    # ----------------------------------------------------
+    # Convert counts to numeric
+    # ----------------------------------------------------
+
+    counts = df.apply(
+        pd.to_numeric,
+        errors="coerce"
+    )
+
+    if counts.isna().any().any():
+        raise ValueError(
+            f"[tp{tp}] Non-numeric or missing values "
+            "detected in count matrix."
+        )
+
+    # featureCounts produces integer read counts
+    counts = counts.astype(int)
+
+    # ----------------------------------------------------
+    # Filter low-count features
+    # ----------------------------------------------------
+
+    n_before = counts.shape[0]
+
+    keep = (
+        counts.sum(axis=1)
+        >= min_total_count
+    )
+
+    counts = counts.loc[keep]
+
+    n_after = counts.shape[0]
+
+    log(
+        f"[tp{tp}] Features before filtering: {n_before}"
+    )
+
+    log(
+        f"[tp{tp}] Features retained:         {n_after}"
+    )
+
+    if n_after == 0:
+        raise ValueError(
+            f"[tp{tp}] No features remain after filtering."
+        )
+
+    # ----------------------------------------------------
+    # Metadata
+    #
+    # bc01-bc04 = positive HELIOS samples
+    # bc05-bc08 = negative controls
+    # ----------------------------------------------------
+
+    metadata = pd.DataFrame(
+        {
+            "sample_id": expected_barcodes,
+            "conditions": (
+                ["Treated"] * 4
+                + ["Control"] * 4
+            )
+        },
+        index=expected_barcodes
+    )
+
+    # PyDESeq2 expects samples x features
+    counts = counts.T
+
+    # ----------------------------------------------------
+    # Fit DESeq2 model
+    # ----------------------------------------------------
+
+    inference = DefaultInference(
+        n_cpus=n_cpus
+    )
+
+    dds = DeseqDataSet(
+        counts=counts,
+        metadata=metadata,
+        design_factors="conditions",
+        refit_cooks=False,
+        inference=inference
+    )
+
+    # Fail before the fit if the DDS could not be saved
+    check_settings(dds)
+
+    log(
+        f"[tp{tp}] Fitting size factors..."
+    )
+
+    dds.fit_size_factors(
+        fit_type="ratio"
+    )
+
+    log(
+        f"[tp{tp}] Fitting dispersions..."
+    )
+
+    dds.fit_genewise_dispersions()
+    dds.fit_dispersion_trend()
+    dds.fit_dispersion_prior()
+    dds.fit_MAP_dispersions()
+
+    log(
+        f"[tp{tp}] Fitting log2 fold changes..."
+    )
+
+    dds.fit_LFC()
+
+    if dds.refit_cooks:
+
+        dds.varm["replaced"] = np.zeros_like(
+            dds.var_names,
+            dtype=bool
+        )
+
+        dds.refit()
+
+    # ----------------------------------------------------
+    # Save fitted DDS
+    # ----------------------------------------------------
+
+    try:
+
+        save_dds(
+            dds,
+            output_dds
+        )
+
+    except KeyError as error:
+
+        # Keep the fit as a pickle, which Step 09 still reads
+        output_dds = output_dds[:-len(DDS_SUFFIX)] + LEGACY_DDS_SUFFIX
+
+        log(
+            f"[tp{tp}] WARNING: {error}; pickling the DDS instead."
+        )
+
+        with open(
+            output_dds,
+            "wb"
+        ) as f:
+
+            pkl.dump(
+                dds,
+                f
+            )
+
+    log(
+        f"[tp{tp}] Saved DDS: {output_dds}"
+    )
+
+    return tp, time.perf_counter() - start_time
+
+
+def fit_timepoint_worker(*args):
+    """
+    fit_timepoint() in a worker process of the ProcessPoolExecutor.
+
+    PyDESeq2 runs its fits on joblib's reusable loky executor. Its
+    worker processes stay idle for minutes after a fit, and the pool
+    worker waits for them when it exits, so they are shut down here.
+    """
+
+    try:
+        return fit_timepoint(*args)
+
+    finally:
+        get_reusable_executor().shutdown(wait=True)
+
 
 def main():
 
@@ -49,6 +285,17 @@ def main():
         help="Number of CPUs used by PyDESeq2. Default: 8."
     )
 
+    parser.add_argument(
+        "--parallel-fits",
+        type=int,
+        default=4,
+        help=(
+            "Time points fitted at once in worker processes; "
+            "each fit gets threads / parallel-fits CPUs. "
+            "Default: 4."
+        )
+    )
+
     parser.add_argument(
         "--min-total-count",
         type=int,
@@ -74,12 +321,19 @@ def main():
     print(f"Input directory:     {input_dir}")
     print(f"Time points:         tp{args.start_tp}-tp{args.end_tp}")
     print(f"CPUs:                {args.threads}")
+    print(f"Parallel fits:       {args.parallel_fits}")
     print(f"Minimum total count: {args.min_total_count}")
     print("========================================")
 
-    inference = DefaultInference(
-        n_cpus=args.threads
-    )
+    # Step 07 count cube; per-time-point CSV files are read
+    # when it is missing
+    cube_path = find_cube(input_dir)
+    cube = load_cube(cube_path) if cube_path else None
+
+    if cube is not None:
+        print(f"Count cube:          {cube_path}")
+
+    jobs = []
 
     for tp in range(
         args.start_tp,
@@ -96,16 +350,21 @@ def main():
             "merged_by_barcode_Astart_readCount.csv"
         )
 
-        output_pkl = os.path.join(
+        output_dds = os.path.join(
             tp_dir,
-            "merged_by_barcode_Astart_readCount_dds.pkl"
+            "merged_by_barcode_Astart_readCount" + DDS_SUFFIX
         )
 
         # ----------------------------------------------------
         # Skip missing time points
         # ----------------------------------------------------
 
-        if not os.path.isfile(input_csv):
+        in_cube = (
+            cube is not None
+            and cube.has_timepoint(f"tp{tp}")
+        )
+
+        if not in_cube and not os.path.isfile(input_csv):
 
             print(
                 f"[tp{tp}] Skipping: input file not found:"
@@ -119,178 +378,83 @@ def main():
         print()
         print("----------------------------------------")
         print(f"[tp{tp}] Processing")
-        print(f"Input:  {input_csv}")
+        print(f"Input:  {cube_path if in_cube else input_csv}")
 
         # ----------------------------------------------------
         # Read count matrix
         # ----------------------------------------------------
 
-        df = pd.read_csv(
-            input_csv,
-            index_col=0
-        )
-
-        if df.shape[1] != 8:
-            raise ValueError(
-                f"[tp{tp}] Expected 8 barcode samples, "
-                f"found {df.shape[1]}."
+        if in_cube:
+            df = cube.timepoint(f"tp{tp}")
+        else:
+            df = pd.read_csv(
+                input_csv,
+                index_col=0
             )
 
-        # ----------------------------------------------------
-        # Make sure barcode order is bc01-bc08
-        # ----------------------------------------------------
-
-        expected_barcodes = [
-            f"bc{i:02d}"
-            for i in range(1, 9)
-        ]
-
-        missing_barcodes = [
-            bc
-            for bc in expected_barcodes
-            if bc not in df.columns
-        ]
-
-        if missing_barcodes:
-            raise ValueError(
-                f"[tp{tp}] Missing expected barcodes: "
-                f"{', '.join(missing_barcodes)}"
-            )
-
-        df = df[expected_barcodes]
-
-        # ----------------------------------------------------
-        # Convert counts to numeric
-        # ----------------------------------------------------
-
-        counts = df.apply(
-            pd.to_numeric,
-            errors="coerce"
+        jobs.append(
+            (tp, df, output_dds)
         )
 
-        if counts.isna().any().any():
-            raise ValueError(
-                f"[tp{tp}] Non-numeric or missing values "
-                "detected in count matrix."
-            )
-
-        # featureCounts produces integer read counts
-        counts = counts.astype(int)
+    # --------------------------------------------------------
+    # Fit the time points, several at once: --threads is
+    # split between the concurrent fits
+    # --------------------------------------------------------
 
-        # ----------------------------------------------------
-        # Filter low-count features
-        # ----------------------------------------------------
-
-        n_before = counts.shape[0]
+    parallel_fits = max(
+        1,
+        min(args.parallel_fits, len(jobs), args.threads)
+    )
 
-        keep = (
-            counts.sum(axis=1)
-            >= args.min_total_count
-        )
+    n_cpus = max(
+        1,
+        args.threads // parallel_fits
+    )
 
-        counts = counts.loc[keep]
+    print()
+    print(
+        f"Fitting {len(jobs)} time points, {parallel_fits} at "
+        f"once with {n_cpus} CPUs each",
+        flush=True
+    )
 
-        n_after = counts.shape[0]
+    if parallel_fits == 1:
 
-        print(
-            f"Features before filtering: {n_before}"
-        )
+        for tp, df, output_dds in jobs:
 
-        print(
-            f"Features retained:         {n_after}"
-        )
-
-        if n_after == 0:
-            raise ValueError(
-                f"[tp{tp}] No features remain after filtering."
+            tp, elapsed = fit_timepoint(
+                tp,
+                df,
+                output_dds,
+                n_cpus,
+                args.min_total_count
             )
 
-        # ----------------------------------------------------
-        # Metadata
-        #
-        # bc01-bc04 = positive HELIOS samples
-        # bc05-bc08 = negative controls
-        # ----------------------------------------------------
-
-        metadata = pd.DataFrame(
-            {
-                "sample_id": expected_barcodes,
-                "conditions": (
-                    ["Treated"] * 4
-                    + ["Control"] * 4
-                )
-            },
-            index=expected_barcodes
-        )
-
-        # PyDESeq2 expects samples x features
-        counts = counts.T
-
-        # ----------------------------------------------------
-        # Fit DESeq2 model
-        # ----------------------------------------------------
-
-        dds = DeseqDataSet(
-            counts=counts,
-            metadata=metadata,
-            design_factors="conditions",
-            refit_cooks=False,
-            inference=inference
-        )
-
-        print(
-            f"[tp{tp}] Fitting size factors..."
-        )
-
-        dds.fit_size_factors(
-            fit_type="ratio"
-        )
-
-        print(
-            f"[tp{tp}] Fitting dispersions..."
-        )
-
-        dds.fit_genewise_dispersions()
-        dds.fit_dispersion_trend()
-        dds.fit_dispersion_prior()
-        dds.fit_MAP_dispersions()
-
-        print(
-            f"[tp{tp}] Fitting log2 fold changes..."
-        )
-
-        dds.fit_LFC()
-
-        if dds.refit_cooks:
+            log(f"[tp{tp}] Wall time: {elapsed:.1f} s")
 
-            dds.varm["replaced"] = np.zeros_like(
-                dds.var_names,
-                dtype=bool
-            )
+    else:
 
-            dds.refit()
+        with ProcessPoolExecutor(
+            max_workers=parallel_fits
+        ) as executor:
 
-        # ----------------------------------------------------
-        # Save fitted DDS
-        # ----------------------------------------------------
-
-        with open(
-            output_pkl,
-            "wb"
-        ) as f:
+            futures = [
+                executor.submit(
+                    fit_timepoint_worker,
+                    tp,
+                    df,
+                    output_dds,
+                    n_cpus,
+                    args.min_total_count
+                )
+                for tp, df, output_dds in jobs
+            ]
 
-            pkl.dump(
-                dds,
-                f
-            )
+            for future in as_completed(futures):
 
-        print(
-            f"[tp{tp}] Saved DDS:"
-        )
+                tp, elapsed = future.result()
 
-        print(
-            f"        {output_pkl}"
-        )
+                log(f"[tp{tp}] Wall time: {elapsed:.1f} s")
 
     print()
     print("========================================")
@@ -7,6 +7,8 @@ import pickle as pkl
 from pydeseq2.default_inference import DefaultInference
 from pydeseq2.ds import DeseqStats
 
+from dds_store import DDS_SUFFIX, LEGACY_DDS_SUFFIX, load_dds
+
 
 def main():
 
@@ -21,7 +23,8 @@ def main():
         "input_dir",
         help=(
             "Directory containing tp1, tp2, ... subdirectories "
-            "with *_dds.pkl files generated by Step 08."
+            "with *_dds.npz files generated by Step 08 "
+            "(or *_dds.pkl files from earlier versions)."
         )
     )
 
@@ -118,21 +121,28 @@ def main():
             continue
 
         # ----------------------------------------------------
-        # Find DDS object generated by Step 08
+        # Find DDS file generated by Step 08, falling back to
+        # a pickle of an earlier run
         # ----------------------------------------------------
 
-        dds_files = sorted(
-            [
-                f
-                for f in os.listdir(tp_dir)
-                if f.endswith("_dds.pkl")
-            ]
-        )
+        for dds_suffix in (DDS_SUFFIX, LEGACY_DDS_SUFFIX):
+
+            dds_files = sorted(
+                [
+                    f
+                    for f in os.listdir(tp_dir)
+                    if f.endswith(dds_suffix)
+                ]
+            )
+
+            if dds_files:
+                break
 
         if not dds_files:
 
             print(
-                f"[{tp_name}] No *_dds.pkl file found, skipping."
+                f"[{tp_name}] No *{DDS_SUFFIX} or "
+                f"*{LEGACY_DDS_SUFFIX} file found, skipping."
             )
 
             skipped += 1
@@ -141,7 +151,7 @@ def main():
         if len(dds_files) > 1:
 
             raise RuntimeError(
-                f"[{tp_name}] More than one *_dds.pkl file found: "
+                f"[{tp_name}] More than one *{dds_suffix} file found: "
                 f"{dds_files}"
             )
 
@@ -158,15 +168,25 @@ def main():
         print(f"        {dds_path}")
 
         # ----------------------------------------------------
-        # Load fitted DDS
+        # Load fitted DDS; counts and Cook's distances are
+        # memory-mapped
         # ----------------------------------------------------
 
-        with open(
-            dds_path,
-            "rb"
-        ) as f:
+        if dds_suffix == DDS_SUFFIX:
+
+            dds = load_dds(
+                dds_path,
+                inference=inference
+            )
+
+        else:
+
+            with open(
+                dds_path,
+                "rb"
+            ) as f:
 
-            dds = pkl.load(f)
+                dds = pkl.load(f)
 
         # ----------------------------------------------------
         # Run statistical testing
@@ -204,9 +224,9 @@ def main():
         # Save results
         # ----------------------------------------------------
 
-        output_name = dds_file.replace(
-            "_dds.pkl",
-            "_results.csv"
+        output_name = (
+            dds_file[:-len(dds_suffix)]
+            + "_results.csv"
         )
 
         output_path = os.path.join(
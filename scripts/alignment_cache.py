@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+
+"""
+Unique-sequence collapsing and an on-disk alignment cache for Step 04.
+
+NAD-Seq libraries are highly redundant, so the cascade does not need to
+align every read. collapse_reads() groups the trimmed reads of a sample
+into unique sequences: one key per distinct (R1, R2) pair of the paired
+stream and one per distinct singleton sequence. Only keys missing from
+the AlignmentCache (a SQLite file shared by all samples and runs) are
+aligned, once each. Their SAM records are stored in the cache without
+read name and qualities. expand_alignments() then writes the usual
+per-read SAM files of 04.bowtie2.sh from the cached records, with the
+name and qualities of every read, so the multiplicities are expanded
+before Steps 05/06 and the UMI deduplication see the alignments.
+
+All copies of a sequence get the alignment of its first read; bowtie2
+may place repeated reads of a multi-mapping sequence differently.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from itertools import islice
+
+from fastq_io import open_fastq
+
+
+# Unique sequences looked up per SQLite query
+LOOKUP_BATCH = 500
+
+
+def paired_key(r1_seq, r2_seq):
+    """
+    Cache key (SHA-1 digest) of a read pair with the sequences (bytes)
+    <r1_seq> and <r2_seq>.
+    """
+
+    return hashlib.sha1(b"P" + r1_seq + b"\0" + r2_seq).digest()
+
+
+def single_key(seq):
+    """
+    Cache key (SHA-1 digest) of a singleton read. R1 and R2 singletons
+    with the same sequence share the key.
+    """
+
+    return hashlib.sha1(b"U" + seq).digest()
+
+
+def index_signature(indexes, stages):
+    """
+    Signature of the alignment settings: the index path, its modification
+    time and the bowtie2 options of every stage. Cached alignments are
+    only reused under the same signature.
+    """
+
+    settings = []
+
+    for stage, options in stages:
+
+        index = os.path.abspath(indexes[stage])
+
+        mtimes = [
+            os.path.getmtime(path)
+            for path in sorted(glob.glob(index + ".*.bt2*"))
+        ]
+
+        settings.append([stage, index, max(mtimes, default=0), list(options)])
+
+    return hashlib.sha1(json.dumps(settings).encode()).hexdigest()
+
+
+def read_fastq_records(path, chunk_reads=100000):
+    """
+    Yield (name_line, seq, qual) of every record of a FASTQ file as
+    bytes without line ends.
+    """
+
+    with open_fastq(path, "rb") as fin:
+
+        while True:
+            lines = list(islice(fin, chunk_reads * 4))
+
+            if not lines:
+                return
+
+            for i in range(0, len(lines) - 3, 4):
+                yield (
+                    lines[i].rstrip(b"\r\n"),
+                    lines[i + 1].rstrip(b"\r\n"),
+                    lines[i + 3].rstrip(b"\r\n"),
+                )
+
+
+def collapse_reads(inputs):
+    """
+    Group the reads of a sample ({"R1_paired", "R2_paired",
+    "R1_unpaired", "R2_unpaired"} FASTQ paths) by sequence.
+
+    Returns (uniques, stats): uniques maps every key to
+    [multiplicity, sequences, qualities] with the sequences and
+    qualities of its first read (one entry per mate); stats counts the
+    input reads (pairs once) and unique keys.
+    """
+
+    uniques = {}
+    reads = 0
+
+    for (_, r1_seq, r1_qual), (_, r2_seq, r2_qual) in zip(
+        read_fastq_records(inputs["R1_paired"]),
+        read_fastq_records(inputs["R2_paired"])
+    ):
+        key = paired_key(r1_seq, r2_seq)
+        reads += 1
+
+        if key in uniques:
+            uniques[key][0] += 1
+        else:
+            uniques[key] = [1, (r1_seq, r2_seq), (r1_qual, r2_qual)]
+
+    for stream in ("R1_unpaired", "R2_unpaired"):
+
+        for _, seq, qual in read_fastq_records(inputs[stream]):
+
+            key = single_key(seq)
+            reads += 1
+
+            if key in uniques:
+                uniques[key][0] += 1
+            else:
+                uniques[key] = [1, (seq,), (qual,)]
+
+    return uniques, {"reads": reads, "unique": len(uniques)}
+
+
+def write_unique_fastq(uniques, keys, paths):
+    """
+    Write the unique sequences <keys> as FASTQ files for alignment:
+    pairs to paths["R1_paired"]/["R2_paired"] and singletons to
+    paths["R1_unpaired"] (paths["R2_unpaired"] stays empty). Every read
+    is named by the hex digest of its key.
+    """
+
+    with open(paths["R1_paired"], "wb") as r1_out, \
+         open(paths["R2_paired"], "wb") as r2_out, \
+         open(paths["R1_unpaired"], "wb") as single_out, \
+         open(paths["R2_unpaired"], "wb"):
+
+        for key in keys:
+
+            _, seqs, quals = uniques[key]
+            name = b"@" + key.hex().encode() + b"\n"
+
+            if len(seqs) == 2:
+                r1_out.write(name + seqs[0] + b"\n+\n" + quals[0] + b"\n")
+                r2_out.write(name + seqs[1] + b"\n+\n" + quals[1] + b"\n")
+            else:
+                single_out.write(name + seqs[0] + b"\n+\n" + quals[0] + b"\n")
+
+
+def read_stage_sam(path, stage, results):
+    """
+    Add the records of a SAM file from the alignment of unique reads to
+    <results> ({key: {stage: [[fields_before_qual, fields_after_qual]]}})
+    and return the header lines. Read names and qualities are left out;
+    expand_alignments() fills them in per read.
+    """
+
+    header = []
+
+    with open(path) as sam:
+
+        for line in sam:
+
+            if line.startswith("@"):
+                header.append(line)
+                continue
+
+            qname, rest = line.rstrip("\n").split("\t", 1)
+            fields = rest.split("\t")
+
+            if len(fields) < 10:
+                continue
+
+            before = "\t".join(fields[:9])
+            after = "".join("\t" + field for field in fields[10:])
+
+            results.setdefault(bytes.fromhex(qname), {}).setdefault(
+                stage,
+                []
+            ).append([before, after])
+
+    return "".join(header)
+
+
+class AlignmentCache:
+    """
+    SQLite cache of the cascade alignments of unique sequences, keyed by
+    index_signature() and the sequence key. Safe to share between the
+    threads of one process.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS alignments ("
+                "signature TEXT, key BLOB, result TEXT, "
+                "PRIMARY KEY (signature, key)) WITHOUT ROWID"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS headers ("
+                "signature TEXT, stage TEXT, header TEXT, "
+                "PRIMARY KEY (signature, stage)) WITHOUT ROWID"
+            )
+
+    def lookup(self, signature, keys):
+        """
+        Cached results ({key: {stage: records}}) of the <keys> found.
+        """
+
+        keys = list(keys)
+        found = {}
+
+        with self._lock:
+
+            for start in range(0, len(keys), LOOKUP_BATCH):
+
+                batch = keys[start:start + LOOKUP_BATCH]
+
+                rows = self._db.execute(
+                    "SELECT key, result FROM alignments "
+                    "WHERE signature = ? AND key IN ("
+                    + ", ".join("?" * len(batch)) + ")",
+                    [signature] + batch
+                )
+
+                for key, result in rows:
+                    found[bytes(key)] = json.loads(result)
+
+        return found
+
+    def store(self, signature, results, headers):
+        """
+        Add the results of newly aligned sequences and the SAM headers
+        ({stage: header}) of their alignment.
+        """
+
+        with self._lock, self._db:
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)",
+                (
+                    (signature, key, json.dumps(result))
+                    for key, result in results.items()
+                )
+            )
+
+            self._db.executemany(
+                "INSERT OR REPLACE INTO headers VALUES (?, ?, ?)",
+                (
+                    (signature, stage, header)
+                    for stage, header in headers.items()
+                )
+            )
+
+    def headers(self, signature):
+        """
+        Cached SAM headers ({stage: header}) for <signature>.
+        """
+
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT stage, header FROM headers WHERE signature = ?",
+                (signature,)
+            )
+
+            return dict(rows)
+
+    def close(self):
+
+        with self._lock:
+            self._db.close()
+
+
+def sam_line(name_line, record, qual, r1_qual=None, r2_qual=None):
+    """
+    SAM line of one read from a cached record: the read name (up to the
+    first whitespace) and its own qualities, reversed for reverse-strand
+    records. For mates the quality is picked by the FLAG.
+    """
+
+    before, after = record
+    flag = int(before.split("\t", 1)[0])
+
+    if r1_qual is not None:
+        qual = r2_qual if flag & 0x80 else r1_qual
+
+    qual = qual.decode()
+
+    if flag & 0x10:
+        qual = qual[::-1]
+
+    name = name_line[1:].split(None, 1)[0].decode()
+
+    # bowtie2 drops the /1 and /2 suffixes of mate names
+    if r1_qual is not None and name[-2:] in ("/1", "/2"):
+        name = name[:-2]
+
+    return f"{name}\t{before}\t{qual}{after}\n"
+
+
+def expand_alignments(inputs, results, headers, stage_paths):
+    """
+    Write the per-read SAM files of every stage from the results of the
+    unique sequences.
+
+    <stage_paths> maps a stage to its output files ({"paired_sam",
+    "R1_unpaired_sam", "R2_unpaired_sam"}, as from stage_output_paths).
+    Returns the number of reads (pairs once) that entered every stage.
+    """
+
+    outputs = {}
+    reads = {stage: 0 for stage in stage_paths}
+
+    try:
+
+        for stage, paths in stage_paths.items():
+            for key in ("paired_sam", "R1_unpaired_sam", "R2_unpaired_sam"):
+                outputs[stage, key] = open(paths[key], "w")
+                outputs[stage, key].write(headers.get(stage, ""))
+
+        for (r1_name, r1_seq, r1_qual), (_, r2_seq, r2_qual) in zip(
+            read_fastq_records(inputs["R1_paired"]),
+            read_fastq_records(inputs["R2_paired"])
+        ):
+            result = results.get(paired_key(r1_seq, r2_seq), {})
+
+            for stage, records in result.items():
+
+                reads[stage] += 1
+                out = outputs[stage, "paired_sam"]
+
+                for record in records:
+                    out.write(
+                        sam_line(r1_name, record, None, r1_qual, r2_qual)
+                    )
+
+        for stream in ("R1_unpaired", "R2_unpaired"):
+
+            for name, seq, qual in read_fastq_records(inputs[stream]):
+
+                result = results.get(single_key(seq), {})
+
+                for stage, records in result.items():
+
+                    reads[stage] += 1
+                    out = outputs[stage, f"{stream}_sam"]
+
+                    for record in records:
+                        out.write(sam_line(name, record, qual))
+
+    finally:
+
+        for out in outputs.values():
+            out.close()
+
+    return reads
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the 5' G/N trimming engines of Step 02 on a synthetic FASTQ.
+
+Compares reads/sec of the original line-based implementation
+(str decoding, regex ^[GN]* per read) with the bytes-mode block engine
+in trim_engine.py, and checks that both produce byte-identical output.
+
+Usage:
+    python scripts/benchmark_5prime_trim.py --reads 2000000
+"""
+
+import argparse
+import hashlib
+import os
+import random
+import tempfile
+import time
+from itertools import islice
+
+import regex as re
+
+from trim_engine import new_trim_stats, trim_5prime_block
+
+
+# ------------------------------------------------------------
+# Synthetic data
+# ------------------------------------------------------------
+
+def write_synthetic_fastq(path, n_reads, read_length, seed):
+    """
+    Write a FASTQ file with a HELIOS-like mix of leading G/N runs.
+    """
+
+    rng = random.Random(seed)
+
+    bases = "ACGT"
+    qualities = [chr(q) for q in range(35, 74)]
+
+    with open(path, "w") as fout:
+
+        for i in range(n_reads):
+
+            prefix = "".join(
+                rng.choice("GGGN")
+                for _ in range(rng.choice((0, 0, 1, 2, 3, 4, 6)))
+            )
+
+            length = rng.randint(read_length // 2, read_length)
+
+            sequence = prefix + "".join(
+                rng.choice(bases)
+                for _ in range(length - len(prefix))
+            )
+
+            quality = "".join(
+                rng.choice(qualities)
+                for _ in sequence
+            )
+
+            fout.write(
+                f"@read{i} 1:N:0:1\n{sequence}\n+\n{quality}\n"
+            )
+
+
+# ------------------------------------------------------------
+# Implementations
+# ------------------------------------------------------------
+
+def legacy_trim(input_path, output_path):
+    """
+    Original Step 02 per-read loop (forward read only).
+    """
+
+    adapter_object = re.compile(r"^[GN]*")
+
+    total_reads = 0
+    buffer = []
+
+    with open(input_path, "r") as fin, open(output_path, "w") as fout:
+
+        while True:
+            lines = [next(fin, None) for _ in range(4)]
+
+            if None in lines:
+                break
+
+            total_reads += 1
+
+            match = adapter_object.search(lines[1].strip())
+
+            if match:
+                end_index = match.end()
+
+                sequence = lines[1].strip()[end_index:]
+                quality = lines[3].strip()[end_index:]
+
+                lines[1] = sequence + "\n"
+                lines[3] = quality + "\n"
+
+            buffer.extend(lines)
+
+            if len(buffer) >= 25000 * 4:
+                fout.writelines(buffer)
+                buffer = []
+
+        fout.writelines(buffer)
+
+    return total_reads
+
+
+def engine_trim(input_path, output_path, chunk_reads=25000):
+    """
+    Bytes-mode block engine used by Step 02.
+    """
+
+    stats = new_trim_stats()
+
+    with open(input_path, "rb") as fin, open(output_path, "wb") as fout:
+
+        while True:
+            lines = list(islice(fin, chunk_reads * 4))
+            lines = lines[:len(lines) - len(lines) % 4]
+
+            if not lines:
+                break
+
+            trim_5prime_block(lines, stats)
+            fout.write(b"".join(lines))
+
+    return stats["total_reads"]
+
+
+# ------------------------------------------------------------
+# Benchmark
+# ------------------------------------------------------------
+
+def file_digest(path):
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def time_best(function, input_path, output_path, repeats):
+
+    best = None
+    reads = 0
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        reads = function(input_path, output_path)
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return reads, best
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the Step 02 5' G/N trimming implementations "
+            "on a synthetic FASTQ file."
+        )
+    )
+
+    parser.add_argument(
+        "--reads",
+        type=int,
+        default=1000000,
+        help="Number of synthetic reads. Default: 1000000."
+    )
+
+    parser.add_argument(
+        "--read-length",
+        type=int,
+        default=75,
+        help="Maximum read length. Default: 75."
+    )
+
+    parser.add_argument(
+        "--repeats",
+        type=int,
+        default=3,
+        help="Runs per implementation; the best is reported. Default: 3."
+    )
+
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed. Default: 1."
+    )
+
+    parser.add_argument(
+        "--tmp-dir",
+        default=None,
+        help="Directory for the temporary FASTQ files."
+    )
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+
+        input_path = os.path.join(tmp_dir, "synthetic_R1_001.fastq")
+        legacy_path = os.path.join(tmp_dir, "legacy_trimmed.fastq")
+        engine_path = os.path.join(tmp_dir, "engine_trimmed.fastq")
+
+        print(f"Writing {args.reads} synthetic reads...")
+
+        write_synthetic_fastq(
+            input_path,
+            args.reads,
+            args.read_length,
+            args.seed
+        )
+
+        results = {}
+
+        for name, function, output_path in (
+            ("legacy (str + regex)", legacy_trim, legacy_path),
+            ("engine (bytes block)", engine_trim, engine_path),
+        ):
+
+            reads, elapsed = time_best(
+                function,
+                input_path,
+                output_path,
+                args.repeats
+            )
+
+            results[name] = reads / elapsed
+
+            print(
+                f"{name:22s} {elapsed:8.2f} s  "
+                f"{reads / elapsed:12,.0f} reads/sec"
+            )
+
+        identical = file_digest(legacy_path) == file_digest(engine_path)
+
+        legacy_rate, engine_rate = results.values()
+
+        print(f"Speed-up:              {engine_rate / legacy_rate:.2f}x")
+        print(f"Byte-identical output: {identical}")
+
+        if not identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+
+"""
+Stream trimmed reads straight into the spike RNA stage of Step 04.
+
+Instead of writing the four Step 03 FASTQ files, the trimmers can hand
+their output blocks to a SpikeAlignmentStream. It runs the three spike
+RNA bowtie2 alignments of 04.bowtie2.sh (paired, R1 singletons, R2
+singletons) on named pipes, so that trimming and alignment run at the
+same time. The SAM files and unaligned FASTQ files are written under the
+names used by 04.bowtie2.sh, which then skips the spike stage and
+continues with tRNA/rRNA depletion.
+"""
+
+import errno
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+import pysam
+
+from fastq_io import FastqWriter
+
+
+# Step 04 alignment stages in cascade order, with extra bowtie2 options
+STAGES = (
+    ("spike", ()),
+    ("rrna", ()),
+    ("eColi", ("--local",)),
+)
+
+# SAM tag recording which Step 03 output (paired, R1_unpaired,
+# R2_unpaired) a read of a combined alignment came from
+ORIGIN_TAG = "YO"
+
+
+def bowtie2_command(bowtie2, index, threads, options=()):
+    """
+    Start of a bowtie2 command line with <threads> search threads.
+
+    --mm memory-maps the index, so concurrent bowtie2 processes on the
+    same index share one page-cached copy instead of loading their own.
+    """
+
+    return [bowtie2, "-x", index, "-p", str(threads), "--mm", *options]
+
+
+def bowtie2_read_count(log):
+    """
+    Number of reads (pairs for paired input) in a bowtie2 summary.
+    """
+
+    match = re.search(r"^(\d+) reads; of these:", log, re.MULTILINE)
+
+    return int(match.group(1)) if match else 0
+
+
+def tag_origin(lines, origin):
+    """
+    Replace the comment of every header line of a FASTQ block (a list
+    of lines) with the SAM tag YO:Z:<origin>.
+
+    bowtie2 copies the comment into the SAM record with
+    --sam-append-comment and writes --un/--un-conc reads exactly as
+    read, so the tag is kept through all stages of a cascade.
+    """
+
+    tag = f" {ORIGIN_TAG}:Z:{origin}\n".encode()
+
+    lines[0::4] = [line.split(None, 1)[0] + tag for line in lines[0::4]]
+
+    return lines
+
+
+def stage_output_paths(alignment_dir, base_name, stage):
+    """
+    Outputs of one alignment stage of a sample, as named by
+    04.bowtie2.sh: the three SAM files, the prefix of the --un-conc
+    FASTQ pair, the two --un FASTQ files and the bowtie2 log. The
+    single SAM file of a combined alignment (paired and singleton reads
+    in one bowtie2 call) is <base_name>_<stage>_combined.sam.
+    """
+
+    sample_dir = os.path.join(alignment_dir, base_name)
+
+    def path(suffix):
+        return os.path.join(sample_dir, f"{base_name}_{suffix}")
+
+    if stage == "eColi":
+        r1_sam = path("eColi_R1_unpaired.sam")
+        r2_sam = path("eColi_R2_unpaired.sam")
+    else:
+        r1_sam = path(f"{stage}_unpaired_R1.sam")
+        r2_sam = path(f"{stage}_unpaired_R2.sam")
+
+    return {
+        "paired_sam": path(f"{stage}_paired.sam"),
+        "combined_sam": path(f"{stage}_combined.sam"),
+        "R1_unpaired_sam": r1_sam,
+        "R2_unpaired_sam": r2_sam,
+        "unconc_prefix": path(f"unaligned_{stage}_paired"),
+        "R1_unpaired_un": path(f"unaligned_{stage}_R1_unpaired.fastq"),
+        "R2_unpaired_un": path(f"unaligned_{stage}_R2_unpaired.fastq"),
+        "log": path(f"{stage}_bowtie2.log"),
+    }
+
+
+def bam_path(sam_path):
+    """
+    Path of the sorted BAM file written instead of a SAM file.
+    """
+
+    return re.sub(r"\.sam$", "", sam_path) + ".bam"
+
+
+def alignment_exists(sam_path):
+    """
+    True if an alignment was written as <sam_path> or as its BAM file.
+    """
+
+    return os.path.isfile(sam_path) or os.path.isfile(bam_path(sam_path))
+
+
+def sam_to_bam(sam_path, threads=1):
+    """
+    Replace a SAM file by a coordinate-sorted, indexed BAM file
+    (bam_path) using pysam with <threads> sorting and compression
+    threads. An empty SAM file (a stage without input reads) becomes a
+    BAM file with an empty header. Returns the BAM path.
+    """
+
+    out_path = bam_path(sam_path)
+
+    tmp_path = os.path.join(
+        os.path.dirname(out_path),
+        ".tmp." + os.path.basename(out_path)
+    )
+
+    try:
+
+        if os.path.getsize(sam_path) == 0:
+            with pysam.AlignmentFile(
+                tmp_path,
+                "wb",
+                header={"HD": {"VN": "1.0", "SO": "coordinate"}}
+            ):
+                pass
+
+        else:
+            pysam.sort(
+                "-@", str(threads),
+                "-T", tmp_path + ".sort",
+                "-o", tmp_path,
+                sam_path
+            )
+
+        pysam.index(tmp_path)
+
+        os.replace(tmp_path + ".bai", out_path + ".bai")
+        os.replace(tmp_path, out_path)
+
+    finally:
+        for path in (tmp_path, tmp_path + ".bai"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    os.remove(sam_path)
+
+    return out_path
+
+
+def stage_complete(alignment_dir, base_name, stage, combined=False):
+    """
+    True if an alignment stage of a sample is complete (all three SAM
+    files, or their BAM files, exist, the same check as in
+    04.bowtie2.sh). With <combined>, the combined SAM file of the stage
+    also counts as complete.
+    """
+
+    paths = stage_output_paths(alignment_dir, base_name, stage)
+
+    if combined and alignment_exists(paths["combined_sam"]):
+        return True
+
+    return all(
+        alignment_exists(paths[key])
+        for key in ("paired_sam", "R1_unpaired_sam", "R2_unpaired_sam")
+    )
+
+
+def unaligned_inputs(alignment_dir, base_name, stage):
+    """
+    Unaligned reads of a stage on disk as input for the next stage:
+    {"R1_paired", "R2_paired", "R1_unpaired", "R2_unpaired"}, or None
+    if they were not kept.
+    """
+
+    paths = stage_output_paths(alignment_dir, base_name, stage)
+
+    inputs = {
+        "R1_paired": paths["unconc_prefix"] + ".1.fastq",
+        "R2_paired": paths["unconc_prefix"] + ".2.fastq",
+        "R1_unpaired": paths["R1_unpaired_un"],
+        "R2_unpaired": paths["R2_unpaired_un"],
+    }
+
+    if all(os.path.isfile(path) for path in inputs.values()):
+        return inputs
+
+    return None
+
+
+def open_fifo(path, process, poll_interval=0.1):
+    """
+    Open a named pipe for writing once <process> has opened it for
+    reading. Raises RuntimeError if the process exits first, instead of
+    blocking forever.
+    """
+
+    while True:
+
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as error:
+            if error.errno != errno.ENXIO:
+                raise
+
+            if process.poll() is not None:
+                raise RuntimeError(
+                    f"bowtie2 exited with code {process.returncode} "
+                    f"before reading {path}"
+                )
+
+            time.sleep(poll_interval)
+            continue
+
+        os.set_blocking(fd, True)
+
+        return os.fdopen(fd, "wb")
+
+
+def release_fifo(path, reader, poll_interval=0.1):
+    """
+    Open and close the write end of a named pipe so that <reader>, a
+    process that may be waiting to open it, sees end of file. Used when
+    the writing process exited without ever opening the pipe. Returns
+    once the pipe was released or <reader> has exited.
+    """
+
+    while True:
+
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return
+
+            if error.errno != errno.ENXIO:
+                raise
+
+            if reader.poll() is not None:
+                return
+
+            time.sleep(poll_interval)
+            continue
+
+        os.close(fd)
+        return
+
+
+class SpikeAlignmentStream:
+    """
+    Three spike RNA bowtie2 alignments of one sample reading the
+    trimmed reads from named pipes.
+
+    Blocks are passed with write(output, block), where <output> is one
+    of the Step 03 outputs (R1_paired, R1_unpaired, R2_paired,
+    R2_unpaired). Alignments are written to hidden temporary files and
+    moved into place by close() only if every bowtie2 run succeeded;
+    abort() stops the alignments and removes them.
+    """
+
+    def __init__(self, alignment_dir, base_name, index, threads=1,
+                 bowtie2="bowtie2"):
+
+        self.base_name = base_name
+        self.sample_dir = os.path.join(alignment_dir, base_name)
+
+        os.makedirs(self.sample_dir, exist_ok=True)
+
+        self.paths = stage_output_paths(alignment_dir, base_name, "spike")
+
+        self.tmp_paths = {
+            key: os.path.join(
+                self.sample_dir,
+                ".tmp." + os.path.basename(path)
+            )
+            for key, path in self.paths.items()
+            if key not in ("log", "combined_sam")
+        }
+
+        self.fifo_dir = tempfile.mkdtemp(
+            prefix=".fifo.",
+            dir=self.sample_dir
+        )
+
+        fifos = {}
+
+        for output in ("R1_paired", "R2_paired", "R1_unpaired",
+                       "R2_unpaired"):
+            fifos[output] = os.path.join(self.fifo_dir, f"{output}.fastq")
+            os.mkfifo(fifos[output])
+
+        common = bowtie2_command(bowtie2, index, threads)
+
+        commands = {
+            "paired": common + [
+                "-1", fifos["R1_paired"],
+                "-2", fifos["R2_paired"],
+                "-S", self.tmp_paths["paired_sam"],
+                "--un-conc", self.tmp_paths["unconc_prefix"] + ".fastq",
+            ],
+            "R1_unpaired": common + [
+                "-U", fifos["R1_unpaired"],
+                "-S", self.tmp_paths["R1_unpaired_sam"],
+                "--un", self.tmp_paths["R1_unpaired_un"],
+            ],
+            "R2_unpaired": common + [
+                "-U", fifos["R2_unpaired"],
+                "-S", self.tmp_paths["R2_unpaired_sam"],
+                "--un", self.tmp_paths["R2_unpaired_un"],
+            ],
+        }
+
+        self.log_paths = {
+            name: os.path.join(
+                self.fifo_dir,
+                f"{name}.log"
+            )
+            for name in commands
+        }
+
+        self.processes = {}
+        self.writers = {}
+        self.closed = False
+
+        try:
+
+            for name, command in commands.items():
+                with open(self.log_paths[name], "w") as log:
+                    self.processes[name] = subprocess.Popen(
+                        command,
+                        stdout=subprocess.DEVNULL,
+                        stderr=log
+                    )
+
+            readers = {
+                "R1_paired": "paired",
+                "R2_paired": "paired",
+                "R1_unpaired": "R1_unpaired",
+                "R2_unpaired": "R2_unpaired",
+            }
+
+            for output, fifo in fifos.items():
+
+                process = self.processes[readers[output]]
+
+                self.writers[output] = FastqWriter(
+                    fifo,
+                    atomic=False,
+                    opener=lambda path, process=process: open_fifo(
+                        path,
+                        process
+                    )
+                )
+
+        except BaseException:
+            self.abort()
+            raise
+
+    def write(self, output, block):
+        self.writers[output].write(block)
+
+    def _remove_tmp(self):
+
+        for key, path in self.tmp_paths.items():
+
+            if key == "unconc_prefix":
+                paths = [path + ".1.fastq", path + ".2.fastq"]
+            else:
+                paths = [path]
+
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+
+    def _read_logs(self):
+
+        logs = {}
+
+        for name, path in self.log_paths.items():
+            with open(path) as log:
+                logs[name] = log.read()
+
+        return logs
+
+    def close(self):
+        """
+        Finish the input, wait for bowtie2 and move the spike stage
+        outputs into place. The bowtie2 summaries are written to
+        <base_name>_spike_bowtie2.log in the sample directory.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+
+            for writer in self.writers.values():
+                writer.close()
+
+            for process in self.processes.values():
+                process.wait()
+
+            logs = self._read_logs()
+
+            for name, process in self.processes.items():
+                if process.returncode != 0:
+                    raise RuntimeError(
+                        f"bowtie2 ({name}) failed for {self.base_name} "
+                        f"with code {process.returncode}:\n{logs[name]}"
+                    )
+
+        except BaseException:
+            self._stop()
+            self._remove_tmp()
+            raise
+
+        # SAM files last: their presence marks the stage as complete
+        for key in ("unconc_prefix", "R1_unpaired_un", "R2_unpaired_un",
+                    "paired_sam", "R1_unpaired_sam", "R2_unpaired_sam"):
+
+            if key == "unconc_prefix":
+                for mate in (".1.fastq", ".2.fastq"):
+                    tmp_path = self.tmp_paths[key] + mate
+                    path = self.paths[key] + mate
+
+                    if os.path.exists(tmp_path):
+                        os.replace(tmp_path, path)
+                    else:
+                        open(path, "w").close()
+
+            elif os.path.exists(self.tmp_paths[key]):
+                os.replace(self.tmp_paths[key], self.paths[key])
+
+            else:
+                open(self.paths[key], "w").close()
+
+        with open(self.paths["log"], "w") as fout:
+            for name, log in logs.items():
+                fout.write(f"# {name}\n{log}\n")
+
+        shutil.rmtree(self.fifo_dir, ignore_errors=True)
+
+    def _stop(self):
+
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+
+        for process in self.processes.values():
+            process.wait()
+
+    def abort(self):
+        """
+        Stop the alignments and discard their outputs.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        # Stop bowtie2 first so that writers blocked on a full pipe fail
+        self._stop()
+
+        for writer in self.writers.values():
+            writer.abort()
+
+        self._remove_tmp()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+
+"""
+Binary gene x barcode x time-point count cube written by Step 07.
+
+Step 07 merges all time points at once. Besides the per-time-point
+CSV files (tpN/merged_by_barcode_Astart_readCount.csv) it stores the
+merged counts in one uncompressed .npz file next to them:
+
+    counts     int32 array (gene, barcode, time point)
+    genes      Geneid of every row, sorted as in the CSV files
+    barcodes   bc01, bc02, ... in numeric order
+    timepoints tp1, tp2, ... in numeric order
+    merged     bool (barcode, time point): the barcode was merged
+               for the time point
+    observed   bool (gene, time point): the gene occurs in the
+               tables of the time point
+
+load_cube() memory-maps the counts, so later steps can take a time
+point, a barcode or a gene without parsing CSV text. export_csv()
+writes the per-time-point CSV files from a cube.
+"""
+
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+
+CUBE_FILENAME = "merged_by_barcode_Astart_readCount_cube.npz"
+
+CSV_FILENAME = "merged_by_barcode_Astart_readCount.csv"
+
+
+class CountCube:
+    """
+    Gene x barcode x time-point read counts with their axis labels.
+    """
+
+    def __init__(self, counts, genes, barcodes, timepoints, merged, observed):
+
+        self.counts = counts
+        self.genes = list(genes)
+        self.barcodes = list(barcodes)
+        self.timepoints = list(timepoints)
+        self.merged = merged
+        self.observed = observed
+
+        self._gene_index = {gene: i for i, gene in enumerate(self.genes)}
+
+    @classmethod
+    def from_series(cls, counts, timepoints, barcodes):
+        """
+        Cube of a Series of counts indexed by (tp, barcode, Geneid),
+        with the given axis orders. Genes are sorted by Geneid.
+        """
+
+        genes = sorted(counts.index.unique(level="Geneid"))
+
+        tp_codes = pd.Index(timepoints).get_indexer(
+            counts.index.get_level_values("tp")
+        )
+        barcode_codes = pd.Index(barcodes).get_indexer(
+            counts.index.get_level_values("barcode")
+        )
+        gene_codes = pd.Index(genes).get_indexer(
+            counts.index.get_level_values("Geneid")
+        )
+
+        cube = np.zeros(
+            (len(genes), len(barcodes), len(timepoints)),
+            dtype=np.int32
+        )
+        merged = np.zeros((len(barcodes), len(timepoints)), dtype=bool)
+        observed = np.zeros((len(genes), len(timepoints)), dtype=bool)
+
+        cube[gene_codes, barcode_codes, tp_codes] = counts.to_numpy()
+        merged[barcode_codes, tp_codes] = True
+        observed[gene_codes, tp_codes] = True
+
+        return cls(cube, genes, barcodes, timepoints, merged, observed)
+
+    def save(self, path):
+        """
+        Write the cube to an uncompressed .npz file through a temporary
+        file, so that load_cube() can memory-map the counts.
+        """
+
+        tmp_path = os.path.join(
+            os.path.dirname(path),
+            ".tmp." + os.path.basename(path)
+        )
+
+        try:
+
+            with open(tmp_path, "wb") as out:
+                np.savez(
+                    out,
+                    counts=np.ascontiguousarray(self.counts),
+                    genes=np.array(self.genes, dtype=str),
+                    barcodes=np.array(self.barcodes, dtype=str),
+                    timepoints=np.array(self.timepoints, dtype=str),
+                    merged=self.merged,
+                    observed=self.observed
+                )
+
+            os.replace(tmp_path, path)
+
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def has_timepoint(self, tp):
+        """
+        True if barcodes were merged for time point <tp>.
+        """
+
+        return (
+            tp in self.timepoints
+            and bool(self.merged[:, self.timepoints.index(tp)].any())
+        )
+
+    def timepoint(self, tp):
+        """
+        Gene x barcode counts of one time point as a DataFrame indexed
+        by Geneid, with the merged barcodes and observed genes only
+        (the content of its CSV file).
+        """
+
+        t = self.timepoints.index(tp)
+
+        barcodes = np.flatnonzero(self.merged[:, t])
+        genes = np.flatnonzero(self.observed[:, t])
+
+        df = pd.DataFrame(
+            self.counts[genes][:, barcodes, t],
+            index=pd.Index([self.genes[i] for i in genes], name="Geneid"),
+            columns=[self.barcodes[i] for i in barcodes]
+        )
+
+        return df
+
+    def to_series(self, timepoints=None):
+        """
+        Merged counts of <timepoints> (default: all) as a Series indexed
+        by (tp, barcode, Geneid), the input of from_series().
+        """
+
+        tps = []
+        barcodes = []
+        genes = []
+        values = []
+
+        for tp in timepoints or self.timepoints:
+
+            t = self.timepoints.index(tp)
+
+            g, b = np.nonzero(
+                self.observed[:, t, None] & self.merged[None, :, t]
+            )
+
+            tps.extend([tp] * len(g))
+            barcodes.extend(self.barcodes[i] for i in b)
+            genes.extend(self.genes[i] for i in g)
+            values.append(np.asarray(self.counts[g, b, t]))
+
+        return pd.Series(
+            np.concatenate(values) if values else [],
+            index=pd.MultiIndex.from_arrays(
+                [tps, barcodes, genes],
+                names=["tp", "barcode", "Geneid"]
+            ),
+            dtype="int32"
+        )
+
+    def barcode(self, barcode):
+        """
+        Gene x time-point counts of one barcode as a DataFrame.
+        """
+
+        b = self.barcodes.index(barcode)
+
+        return pd.DataFrame(
+            self.counts[:, b, :],
+            index=pd.Index(self.genes, name="Geneid"),
+            columns=self.timepoints
+        )
+
+    def gene(self, gene):
+        """
+        Barcode x time-point counts of one Geneid as a DataFrame.
+        """
+
+        return pd.DataFrame(
+            self.counts[self._gene_index[gene]],
+            index=self.barcodes,
+            columns=self.timepoints
+        )
+
+    def select_genes(self, genes):
+        """
+        Counts (gene, barcode, time point) of the given Geneids that
+        are in the cube, and those Geneids.
+        """
+
+        found = [gene for gene in genes if gene in self._gene_index]
+
+        rows = [self._gene_index[gene] for gene in found]
+
+        return self.counts[rows], found
+
+
+def memmap_npz_member(path, name):
+    """
+    Memory-map the .npy member <name> of an .npz file, or return None
+    if the member is compressed.
+    """
+
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + ".npy")
+
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+
+    with open(path, "rb") as f:
+
+        # Local file header: 30 bytes, then file name and extra field
+        f.seek(info.header_offset + 26)
+        name_length, extra_length = np.frombuffer(f.read(4), dtype="<u2")
+
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+
+        version = np.lib.format.read_magic(f)
+
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+
+        offset = f.tell()
+
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran else "C"
+    )
+
+
+def load_cube(path, mmap=True):
+    """
+    Load a CountCube written by Step 07. With <mmap> the counts are
+    memory-mapped instead of read into memory.
+    """
+
+    counts = memmap_npz_member(path, "counts") if mmap else None
+
+    with np.load(path) as data:
+
+        if counts is None:
+            counts = data["counts"]
+
+        return CountCube(
+            counts,
+            data["genes"].tolist(),
+            data["barcodes"].tolist(),
+            data["timepoints"].tolist(),
+            data["merged"],
+            data["observed"]
+        )
+
+
+def find_cube(input_dir):
+    """
+    Path of the count cube in a Step 07 output directory, or None.
+    """
+
+    path = os.path.join(input_dir, CUBE_FILENAME)
+
+    return path if os.path.isfile(path) else None
+
+
+def export_csv(cube, output_dir, timepoints=None):
+    """
+    Write tpN/merged_by_barcode_Astart_readCount.csv for every time
+    point of the cube (or of <timepoints>) with merged barcodes.
+    Returns the written paths.
+    """
+
+    written = []
+
+    for tp in timepoints or cube.timepoints:
+
+        if not cube.has_timepoint(tp):
+            continue
+
+        tp_output_dir = os.path.join(output_dir, tp)
+        os.makedirs(tp_output_dir, exist_ok=True)
+
+        output_filename = os.path.join(tp_output_dir, CSV_FILENAME)
+
+        cube.timepoint(tp).astype(int).reset_index().to_csv(
+            output_filename,
+            index=False
+        )
+
+        written.append(output_filename)
+
+    return written
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""
+Compact storage of the fitted PyDESeq2 DeseqDataSet of a time point.
+
+Step 08 used to pickle the whole DeseqDataSet. The pickle holds every
+intermediate array and the inference object, and is slow to load.
+save_dds() keeps only what the Wald test of Step 09 needs, as plain
+arrays in one uncompressed .npz file:
+
+    X                     counts (sample, gene)
+    obs_names, var_names  barcodes and Geneids
+    obs/<column>          sample metadata (and size factors, pydeseq2
+                          0.5)
+    var/<column>          per-gene fit results (pydeseq2 0.5):
+                          dispersions, normed means, ...
+    obsm/<key>            design matrix (with obsm/design_matrix/columns)
+                          and size factors (pydeseq2 0.4)
+    varm/<key>            LFC (with varm/LFC/columns), and the per-gene
+                          fit results of pydeseq2 0.4
+    layers/cooks          Cook's distances
+    uns/<key>             dispersion trend coefficients and priors
+    attributes            DeseqDataSet settings, scalar uns values,
+                          column dtypes and index names (JSON)
+
+Every array is stored where the fitted DeseqDataSet keeps it, and
+load_dds() puts it back there, so a file is read with the pydeseq2
+release series (0.4 or 0.5) that wrote it. load_dds() rebuilds a
+DeseqDataSet that DeseqStats accepts, with the counts and Cook's
+distances memory-mapped.
+"""
+
+import inspect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from count_cube import memmap_npz_member
+
+
+DDS_SUFFIX = "_dds.npz"
+
+# DDS pickles, written by earlier versions of Step 08 and by Step 08
+# when save_dds() fails
+LEGACY_DDS_SUFFIX = "_dds.pkl"
+
+# DeseqDataSet settings stored in "attributes" and passed back to
+# DeseqDataSet() if the installed version accepts them
+ATTRIBUTES = (
+    "design",
+    "design_factors",
+    "continuous_factors",
+    "ref_level",
+    "fit_type",
+    "size_factors_fit_type",
+    "min_mu",
+    "min_disp",
+    "max_disp",
+    "refit_cooks",
+    "min_replicates",
+    "beta_tol",
+    "quiet",
+    "low_memory",
+)
+
+OBSM_KEYS = ("design_matrix", "size_factors")
+
+LAYER_KEYS = ("cooks",)
+
+# Fit results needed by DeseqStats: (name, sections to look in)
+REQUIRED = (
+    ("design_matrix", ("obsm",)),
+    ("size_factors", ("obs", "obsm")),
+    ("_normed_means", ("var", "varm")),
+    ("non_zero", ("var", "varm")),
+    ("dispersions", ("var", "varm")),
+    ("LFC", ("varm",)),
+)
+
+# Sample x gene arrays, memory-mapped by load_dds()
+MMAP_KEYS = ("X", "layers/cooks")
+
+
+def _json_value(value):
+    """
+    JSON-serialisable copy of a setting (numpy scalars, lists).
+    """
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+
+    return value
+
+
+def _add_array(arrays, key, value):
+    """
+    Store a DataFrame, Series or array under <key>; the column names
+    of a DataFrame go to <key>/columns and the index of a Series to
+    <key>/index.
+    """
+
+    if isinstance(value, pd.DataFrame):
+        arrays[key + "/columns"] = np.array(value.columns, dtype=str)
+        value = value.to_numpy()
+
+    elif isinstance(value, pd.Series):
+        arrays[key + "/index"] = np.array(value.index, dtype=str)
+        value = value.to_numpy()
+
+    value = np.asarray(value)
+
+    if value.dtype == object:
+        value = value.astype(str)
+
+    arrays[key] = value
+
+
+def _add_column(arrays, dtypes, key, column):
+    """
+    Store an obs or var column under <key> and its pandas dtype in
+    <dtypes>. Nullable columns (e.g. the "boolean" convergence flags of
+    pydeseq2 0.5) are stored as float with NaN for missing values.
+    """
+
+    dtypes[key] = str(column.dtype)
+
+    if isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+        arrays[key] = column.to_numpy(dtype=float, na_value=np.nan)
+    else:
+        _add_array(arrays, key, column.to_numpy())
+
+
+def _get_array(data, key, path, mmap, index=None):
+    """
+    Read <key> of an opened .npz as stored by _add_array().
+    """
+
+    value = memmap_npz_member(path, key) if mmap else None
+
+    if value is None:
+        value = data[key]
+
+    if key + "/columns" in data:
+        return pd.DataFrame(
+            value,
+            index=index,
+            columns=data[key + "/columns"].tolist()
+        )
+
+    if key + "/index" in data:
+        return pd.Series(value, index=data[key + "/index"].tolist())
+
+    return value
+
+
+def _get_column(data, key, dtypes, index):
+    """
+    Read an obs or var column stored by _add_column().
+    """
+
+    return pd.Series(data[key], index=index).astype(dtypes[key])
+
+
+def check_settings(dds):
+    """
+    Raise ValueError if the settings of an unfitted DeseqDataSet cannot
+    be stored by save_dds(), so that Step 08 fails before the fit.
+    """
+
+    design = getattr(dds, "design", None)
+
+    if design is not None and not isinstance(design, str):
+        raise ValueError(
+            "save_dds() stores the design as a formula string, "
+            "not as a design matrix."
+        )
+
+    if design is None and getattr(dds, "design_factors", None) is None:
+        raise ValueError(
+            "DeseqDataSet has neither a design nor design factors."
+        )
+
+
+def missing_results(dds):
+    """
+    Names of REQUIRED fit results that a fitted DeseqDataSet does not
+    have in any of their sections.
+    """
+
+    return [
+        name
+        for name, sections in REQUIRED
+        if not any(name in getattr(dds, section) for section in sections)
+    ]
+
+
+def save_dds(dds, path):
+    """
+    Write the arrays of a fitted DeseqDataSet needed by Step 09 to
+    <path> (.npz) through a temporary file. Cook's distances are
+    computed first if the fit did not compute them. Raises KeyError,
+    before writing, if fit results needed by DeseqStats are missing.
+    """
+
+    missing = missing_results(dds)
+
+    if missing:
+        raise KeyError(
+            "DeseqDataSet lacks fit results needed by Step 09: "
+            + ", ".join(missing)
+        )
+
+    if "cooks" not in dds.layers:
+        dds.calculate_cooks()
+
+    arrays = {
+        "X": np.asarray(dds.X),
+        "obs_names": np.array(dds.obs_names, dtype=str),
+        "var_names": np.array(dds.var_names, dtype=str),
+    }
+
+    dtypes = {}
+
+    for column in dds.obs.columns:
+        _add_column(arrays, dtypes, "obs/" + column, dds.obs[column])
+
+    for column in dds.var.columns:
+        _add_column(arrays, dtypes, "var/" + column, dds.var[column])
+
+    for key in OBSM_KEYS:
+        if key in dds.obsm:
+            _add_array(arrays, "obsm/" + key, dds.obsm[key])
+
+    for key in dds.varm.keys():
+        _add_array(arrays, "varm/" + key, dds.varm[key])
+
+    for key in LAYER_KEYS:
+        _add_array(arrays, "layers/" + key, dds.layers[key])
+
+    uns_values = {}
+
+    for key, value in dds.uns.items():
+
+        if np.ndim(value) == 0:
+            uns_values[key] = _json_value(value)
+        else:
+            _add_array(arrays, "uns/" + key, value)
+
+    attributes = {
+        name: _json_value(getattr(dds, name))
+        for name in ATTRIBUTES
+        if getattr(dds, name, None) is not None
+    }
+
+    arrays["attributes"] = np.array(
+        json.dumps(
+            {
+                "attributes": attributes,
+                "uns": uns_values,
+                "dtypes": dtypes,
+                "index_names": [dds.obs_names.name, dds.var_names.name],
+            }
+        )
+    )
+
+    tmp_path = os.path.join(
+        os.path.dirname(path),
+        ".tmp." + os.path.basename(path)
+    )
+
+    try:
+
+        with open(tmp_path, "wb") as out:
+            np.savez(out, **arrays)
+
+        os.replace(tmp_path, path)
+
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_dds(path, inference=None, mmap=True):
+    """
+    Rebuild a DeseqDataSet from a file written by save_dds(), ready for
+    DeseqStats. With <mmap> the counts and Cook's distances are
+    memory-mapped.
+    """
+
+    from pydeseq2.dds import DeseqDataSet
+
+    parameters = inspect.signature(DeseqDataSet).parameters
+
+    with np.load(path) as data:
+
+        stored = json.loads(str(data["attributes"]))
+        dtypes = stored["dtypes"]
+
+        obs_name, var_name = stored["index_names"]
+
+        obs_names = pd.Index(data["obs_names"].tolist(), name=obs_name)
+        var_names = pd.Index(data["var_names"].tolist(), name=var_name)
+
+        X = _get_array(data, "X", path, mmap)
+
+        counts = pd.DataFrame(X, index=obs_names, columns=var_names)
+
+        metadata = pd.DataFrame(
+            {
+                key[len("obs/"):]: _get_column(data, key, dtypes, obs_names)
+                for key in data.files
+                if key.startswith("obs/")
+            },
+            index=obs_names
+        )
+
+        dds = DeseqDataSet(
+            counts=counts,
+            metadata=metadata,
+            inference=inference,
+            **{
+                name: value
+                for name, value in stored["attributes"].items()
+                if name in parameters
+            }
+        )
+
+        # DeseqDataSet() copies the counts into memory
+        if mmap:
+            dds.X = X
+
+        for key in data.files:
+
+            section, _, name = key.partition("/")
+
+            if name.endswith(("/columns", "/index")):
+                continue
+
+            key_mmap = mmap and key in MMAP_KEYS
+
+            if section == "var":
+                dds.var[name] = _get_column(
+                    data, key, dtypes, dds.var_names
+                )
+
+            elif section == "obsm":
+                dds.obsm[name] = _get_array(
+                    data, key, path, key_mmap, index=dds.obs_names
+                )
+
+            elif section == "varm":
+                dds.varm[name] = _get_array(
+                    data, key, path, key_mmap, index=dds.var_names
+                )
+
+            elif section == "layers":
+                dds.layers[name] = _get_array(data, key, path, key_mmap)
+
+            elif section == "uns":
+                dds.uns[name] = _get_array(data, key, path, key_mmap)
+
+        dds.uns.update(stored["uns"])
+
+    # Set by fit_genewise_dispersions(), used by DeseqStats
+    non_zero = np.asarray(
+        dds.var["non_zero"] if "non_zero" in dds.var
+        else dds.varm["non_zero"],
+        dtype=bool
+    )
+
+    dds.non_zero_idx = np.arange(dds.n_vars)[non_zero]
+    dds.non_zero_genes = dds.var_names[non_zero]
+
+    return dds
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Barcode demultiplexing engine for HELIOS NAD-Seq.
+
+The HELIOS adapter places a fixed 6-nt barcode, a 6-7 nt random region
+(UMI) and a G at the 5' end of R2:
+
+    R2: <barcode(6)> <N x 6-7> G <insert ...>
+
+and, for inserts shorter than the read, the reverse complement at the
+3' end of R1:
+
+    R1: <insert ...> C <N x 6-7> <revcomp(barcode)>
+
+This is the design that 01.cutadapt.sh expresses as 16 -g and 16 -A
+adapter patterns. Here, reads are classified with an exact and
+1-mismatch hash lookup of the R2 prefix instead of aligning every
+adapter against every read, and the random region is moved into the read
+name as a UMI (@<read_id>_<UMI>) of both mates.
+"""
+
+
+# ------------------------------------------------------------
+# Barcode design
+# ------------------------------------------------------------
+
+BARCODES = {
+    "bc01": "TCAAGT",
+    "bc02": "CAGCGT",
+    "bc03": "ACCGGT",
+    "bc04": "ATGAGT",
+    "bc05": "GTTCGT",
+    "bc06": "TGCTGT",
+    "bc07": "TATGGT",
+    "bc08": "CTATGT",
+}
+
+BARCODE_LENGTH = 6
+
+# Allowed lengths of the random region, tried in this order. When both
+# fit, the longer adapter is used, as cutadapt scores it higher.
+UMI_LENGTHS = (7, 6)
+
+# Minimum overlap of a partial 3' adapter at the end of R1 (cutadapt -O)
+MIN_OVERLAP = 12
+
+UNKNOWN = "unknown"
+
+COMPLEMENT = bytes.maketrans(b"ACGTN", b"TGCAN")
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+
+# Reverse-complemented barcodes as found at the 3' end of R1
+RC_BARCODES = {
+    name: reverse_complement(barcode.encode())
+    for name, barcode in BARCODES.items()
+}
+
+
+def build_barcode_lookup(barcodes=None, mismatches=1):
+    """
+    Map every barcode and (with mismatches=1) every sequence at Hamming
+    distance 1 from it to (barcode name, number of mismatches).
+
+    Variants that are within one mismatch of more than one barcode are
+    left out, so they are reported as unknown.
+    """
+
+    if barcodes is None:
+        barcodes = BARCODES
+
+    lookup = {}
+    ambiguous = set()
+
+    for name, barcode in barcodes.items():
+        lookup[barcode.encode()] = (name, 0)
+
+    if mismatches:
+
+        for name, barcode in barcodes.items():
+
+            for i in range(len(barcode)):
+                for base in "ACGTN":
+
+                    if base == barcode[i]:
+                        continue
+
+                    variant = (
+                        barcode[:i] + base + barcode[i + 1:]
+                    ).encode()
+
+                    if variant in lookup and lookup[variant][0] != name:
+                        ambiguous.add(variant)
+                    elif variant not in lookup:
+                        lookup[variant] = (name, 1)
+
+    for variant in ambiguous:
+        if lookup[variant][1] > 0:
+            del lookup[variant]
+
+    return lookup
+
+
+def new_demux_stats():
+    return {
+        "total_reads": 0,
+        "exact_barcode": 0,
+        "corrected_barcode": 0,
+        "unknown": 0,
+        "r1_adapter_trimmed": 0,
+    }
+
+
+def add_demux_stats(stats, other):
+    for key, value in other.items():
+        stats[key] += value
+
+
+# ------------------------------------------------------------
+# Per-read classification
+# ------------------------------------------------------------
+
+def classify_r2(sequence, lookup):
+    """
+    Classify an R2 sequence (bytes, no newline).
+
+    Returns (barcode name, mismatches, UMI, trim length) or None if the
+    read does not start with a known barcode followed by a 6-7 nt
+    random region and a G.
+    """
+
+    hit = lookup.get(sequence[:BARCODE_LENGTH])
+
+    if hit is None:
+        return None
+
+    for umi_length in UMI_LENGTHS:
+
+        g_index = BARCODE_LENGTH + umi_length
+
+        if sequence[g_index:g_index + 1] == b"G":
+            return (
+                hit[0],
+                hit[1],
+                sequence[BARCODE_LENGTH:g_index],
+                g_index + 1
+            )
+
+    return None
+
+
+def find_r1_adapter(sequence, rc_barcode, umi_length,
+                    min_overlap=MIN_OVERLAP):
+    """
+    Find the start of the 3' adapter C <N x umi_length> <rc_barcode>
+    in an R1 sequence (bytes, no newline).
+
+    Full-length occurrences are searched first, leftmost first. A
+    partial adapter of at least <min_overlap> bases at the very end of
+    the read is accepted as well. Returns the adapter start or None.
+    """
+
+    adapter_length = 1 + umi_length + len(rc_barcode)
+
+    position = sequence.find(rc_barcode, umi_length + 1)
+
+    while position != -1:
+
+        start = position - umi_length - 1
+
+        if sequence[start:start + 1] == b"C":
+            return start
+
+        position = sequence.find(rc_barcode, position + 1)
+
+    # Partial adapter at the 3' end of the read
+    for overlap in range(adapter_length - 1, min_overlap - 1, -1):
+
+        start = len(sequence) - overlap
+
+        if start < 0:
+            continue
+
+        if (
+            sequence[start:start + 1] == b"C"
+            and rc_barcode.startswith(sequence[start + 1 + umi_length:])
+        ):
+            return start
+
+    return None
+
+
+def add_umi(header, umi):
+    """
+    Append _<UMI> to the read ID of a FASTQ header line.
+    """
+
+    name, separator, comment = header.rstrip(b"\r\n").partition(b" ")
+
+    return name + b"_" + umi + separator + comment + b"\n"
+
+
+# ------------------------------------------------------------
+# Block demultiplexing
+# ------------------------------------------------------------
+
+def demux_block(r1_lines, r2_lines, lookup, stats,
+                trim_r1_adapter=True):
+    """
+    Demultiplex a record-aligned block of R1/R2 FASTQ lines (bytes).
+
+    R2 reads lose barcode, random region and G; R1 reads lose the 3'
+    adapter. Both mates carry the UMI in their read name. Unclassified
+    pairs are returned unchanged under UNKNOWN.
+
+    Returns {barcode: (r1_lines, r2_lines)}. Counters are added to
+    <stats>.
+    """
+
+    output = {}
+
+    for i in range(0, len(r2_lines), 4):
+
+        stats["total_reads"] += 1
+
+        r1 = r1_lines[i:i + 4]
+        r2 = r2_lines[i:i + 4]
+
+        r2_sequence = r2[1].rstrip(b"\r\n")
+
+        hit = classify_r2(r2_sequence, lookup)
+
+        if hit is None:
+            stats["unknown"] += 1
+            barcode_lines = output.setdefault(UNKNOWN, ([], []))
+            barcode_lines[0].extend(r1)
+            barcode_lines[1].extend(r2)
+            continue
+
+        barcode, mismatches, umi, trim_length = hit
+
+        if mismatches:
+            stats["corrected_barcode"] += 1
+        else:
+            stats["exact_barcode"] += 1
+
+        r2[0] = add_umi(r2[0], umi)
+        r2[1] = r2_sequence[trim_length:] + b"\n"
+        r2[3] = r2[3].rstrip(b"\r\n")[trim_length:] + b"\n"
+
+        r1[0] = add_umi(r1[0], umi)
+
+        if trim_r1_adapter:
+
+            r1_sequence = r1[1].rstrip(b"\r\n")
+
+            adapter_start = find_r1_adapter(
+                r1_sequence,
+                RC_BARCODES[barcode],
+                len(umi)
+            )
+
+            if adapter_start is not None:
+                stats["r1_adapter_trimmed"] += 1
+                r1[1] = r1_sequence[:adapter_start] + b"\n"
+                r1[3] = r1[3].rstrip(b"\r\n")[:adapter_start] + b"\n"
+
+        barcode_lines = output.setdefault(barcode, ([], []))
+        barcode_lines[0].extend(r1)
+        barcode_lines[1].extend(r2)
+
+    return output
@@ -0,0 +1,493 @@
+#!/usr/bin/env python3
+
+"""
+Shared FASTQ input/output helpers for the HELIOS NAD-Seq Python stages.
+
+Plain and gzip/BGZF-compressed FASTQ files are handled transparently:
+files ending in .gz are decompressed on input, and compressed output is
+written as BGZF (blocked gzip, readable by gzip, zcat, cutadapt,
+Trimmomatic, bowtie2 and htslib) with compression done on background
+threads.
+"""
+
+import glob
+import gzip
+import os
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+
+# ------------------------------------------------------------
+# File name handling
+# ------------------------------------------------------------
+
+def is_gzipped(path):
+    return path.endswith(".gz")
+
+
+def fastq_output_path(path, compress):
+    """
+    Return <path> with or without a trailing .gz, depending on whether
+    the output should be compressed.
+    """
+
+    if path.endswith(".gz"):
+        path = path[:-3]
+
+    if compress:
+        path += ".gz"
+
+    return path
+
+
+def trimmed_output_paths(output_dir, base_name, compress):
+    """
+    Step 03 output files of one sample, as expected by 04.bowtie2.sh:
+
+        {"R1_paired": <output_dir>/<base_name>_R1_trimmed_paired.fastq,
+         "R1_unpaired": ..., "R2_paired": ..., "R2_unpaired": ...}
+    """
+
+    paths = {}
+
+    for read in ("R1", "R2"):
+        for kind in ("paired", "unpaired"):
+
+            path = os.path.join(
+                output_dir,
+                f"{base_name}_{read}_trimmed_{kind}.fastq"
+            )
+
+            paths[f"{read}_{kind}"] = fastq_output_path(path, compress)
+
+    return paths
+
+
+def find_fastq_pairs(input_dir, forward_tag="R1_001.fastq",
+                     reverse_tag="R2_001.fastq"):
+    """
+    Find R1/R2 FASTQ pairs in <input_dir>.
+
+    Forward files are files ending in <forward_tag> or <forward_tag>.gz.
+    The reverse file of a pair is the forward file name with
+    <forward_tag> replaced by <reverse_tag>.
+
+    Returns:
+        pairs    : {forward_basename: {"forward": path, "reverse": path}}
+        unpaired : list of forward files without a matching R2 file
+    """
+
+    all_forward_files = sorted(
+        glob.glob(os.path.join(input_dir, f"*{forward_tag}"))
+        + glob.glob(os.path.join(input_dir, f"*{forward_tag}.gz"))
+    )
+
+    pairs = {}
+    unpaired = []
+
+    for forward_file in all_forward_files:
+
+        reverse_file = forward_file.replace(
+            forward_tag,
+            reverse_tag
+        )
+
+        if os.path.isfile(reverse_file):
+            pairs[os.path.basename(forward_file)] = {
+                "forward": forward_file,
+                "reverse": reverse_file
+            }
+        else:
+            unpaired.append(forward_file)
+
+    return pairs, unpaired
+
+
+# ------------------------------------------------------------
+# Input
+# ------------------------------------------------------------
+
+def open_fastq(path, mode="r"):
+    """
+    Open a FASTQ file for reading, decompressing .gz files on the fly.
+
+    <mode> is "r" for text or "rb" for bytes.
+    """
+
+    if is_gzipped(path):
+        if mode == "r":
+            mode = "rt"
+        return gzip.open(path, mode)
+
+    return open(path, mode)
+
+
+def read_pair_chunks(forward_file, reverse_file, chunk_reads):
+    """
+    Yield record-aligned (forward_lines, reverse_lines) chunks of up to
+    <chunk_reads> read pairs from two binary FASTQ files. Reading stops
+    at the first incomplete record in either file.
+    """
+
+    while True:
+        forward_lines = list(islice(forward_file, chunk_reads * 4))
+        reverse_lines = list(islice(reverse_file, chunk_reads * 4))
+
+        n_lines = min(len(forward_lines), len(reverse_lines))
+        n_lines -= n_lines % 4
+
+        if n_lines == 0:
+            break
+
+        if n_lines < len(forward_lines):
+            del forward_lines[n_lines:]
+
+        if n_lines < len(reverse_lines):
+            del reverse_lines[n_lines:]
+
+        yield forward_lines, reverse_lines
+
+        if n_lines < chunk_reads * 4:
+            break
+
+
+def ordered_imap(pool, function, iterable, max_pending):
+    """
+    Apply <function> to the items of <iterable> on <pool> and yield the
+    results in input order.
+
+    Unlike Pool.imap, which consumes the whole iterable up front, at most
+    <max_pending> items are read ahead of the results, so memory stays
+    bounded when the items are chunks of a large file.
+    """
+
+    pending = deque()
+
+    for item in iterable:
+        pending.append(pool.apply_async(function, (item,)))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+
+# ------------------------------------------------------------
+# BGZF output
+# ------------------------------------------------------------
+
+# Uncompressed payload per BGZF block. Same limit as htslib, so the
+# compressed block always fits into the 64 KiB BGZF block size.
+BGZF_BLOCK_SIZE = 0xff00
+
+BGZF_EOF = bytes.fromhex(
+    "1f8b08040000000000ff0600424302001b0003000000000000000000"
+)
+
+
+def compress_bgzf_block(data, level):
+    """
+    Compress up to BGZF_BLOCK_SIZE bytes into a single BGZF block.
+    """
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    payload = compressor.compress(data) + compressor.flush()
+
+    header = struct.pack(
+        "<4BI2BH2BHH",
+        0x1f, 0x8b, 8, 4,   # gzip magic, deflate, FEXTRA
+        0,                  # mtime
+        0, 0xff,            # xfl, unknown OS
+        6,                  # extra field length
+        ord("B"), ord("C"),
+        2,
+        len(payload) + 25   # total block size - 1
+    )
+
+    trailer = struct.pack(
+        "<2I",
+        zlib.crc32(data),
+        len(data)
+    )
+
+    return header + payload + trailer
+
+
+def compress_bgzf(data, level):
+    """
+    Compress a batch of bytes into consecutive BGZF blocks.
+    """
+
+    return b"".join(
+        compress_bgzf_block(data[i:i + BGZF_BLOCK_SIZE], level)
+        for i in range(0, len(data), BGZF_BLOCK_SIZE)
+    )
+
+
+class BgzfWriter:
+    """
+    File-like BGZF writer that compresses on background threads.
+
+    Written data is collected into batches of BGZF blocks. Each batch is
+    compressed by a thread pool (zlib releases the GIL, so batches are
+    compressed in parallel) and written to disk in submission order.
+    Both str and bytes can be written.
+    """
+
+    def __init__(self, path, mode="w", threads=2, level=6,
+                 batch_blocks=16):
+
+        if mode not in ("w", "a"):
+            raise ValueError(
+                f"Unsupported BGZF writer mode: {mode}"
+            )
+
+        self.path = path
+        self.level = level
+
+        self._raw = open(path, mode + "b")
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, threads)
+        )
+        self._pending = deque()
+        self._max_pending = 2 * max(1, threads)
+        self._batch_size = BGZF_BLOCK_SIZE * batch_blocks
+        self._buffer = []
+        self._buffered = 0
+        self.closed = False
+
+    def write(self, data):
+
+        if isinstance(data, str):
+            data = data.encode()
+
+        self._buffer.append(data)
+        self._buffered += len(data)
+
+        if self._buffered >= self._batch_size:
+            self._submit()
+
+    def writelines(self, lines):
+
+        lines = list(lines)
+
+        if lines:
+            joiner = "" if isinstance(lines[0], str) else b""
+            self.write(joiner.join(lines))
+
+    def _submit(self):
+
+        if not self._buffer:
+            return
+
+        data = b"".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+
+        self._pending.append(
+            self._executor.submit(compress_bgzf, data, self.level)
+        )
+
+        # Bound the number of batches held in memory
+        while len(self._pending) > self._max_pending:
+            self._raw.write(self._pending.popleft().result())
+
+    def close(self):
+
+        if self.closed:
+            return
+
+        try:
+            self._submit()
+
+            while self._pending:
+                self._raw.write(self._pending.popleft().result())
+
+            self._raw.write(BGZF_EOF)
+
+        finally:
+            self._executor.shutdown()
+            self._raw.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_fastq_output(path, mode="w", threads=2, level=6):
+    """
+    Open a FASTQ file for writing bytes. Files ending in .gz are written
+    as BGZF with <threads> background compression threads.
+
+    <mode> is "w" or "a".
+    """
+
+    if is_gzipped(path):
+        return BgzfWriter(
+            path,
+            mode=mode,
+            threads=threads,
+            level=level
+        )
+
+    return open(path, mode + "b")
+
+
+# ------------------------------------------------------------
+# Persistent writer
+# ------------------------------------------------------------
+
+class FastqWriter:
+    """
+    Persistent FASTQ writer with a dedicated writer thread.
+
+    Blocks passed to write() go through a bounded queue to a thread that
+    owns the open output handle, so the caller can keep trimming while
+    earlier blocks are written (and compressed, for .gz output). Data is
+    written to a hidden temporary file next to <path> that is renamed to
+    <path> only when the writer is closed successfully; on error the
+    temporary file is removed, so half-written outputs are never left
+    behind under the final name.
+    """
+
+    def __init__(self, path, threads=2, level=6, queue_size=8,
+                 atomic=True, opener=None):
+        """
+        With atomic=False the output is written straight to <path>
+        (e.g. a named pipe). <opener> is an optional callable returning
+        a binary handle for the output path; it is called on the writer
+        thread, so opening a pipe never blocks the caller.
+        """
+
+        self.path = path
+        self.atomic = atomic
+
+        if atomic:
+            self.tmp_path = os.path.join(
+                os.path.dirname(path),
+                ".tmp." + os.path.basename(path)
+            )
+        else:
+            self.tmp_path = path
+
+        if opener is None:
+            opener = partial(
+                open_fastq_output,
+                threads=threads,
+                level=level
+            )
+
+        self._opener = opener
+        self._handle = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+        self.closed = False
+
+        self._thread = threading.Thread(
+            target=self._run,
+            daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+
+        try:
+            self._handle = self._opener(self.tmp_path)
+        except BaseException as error:
+            self._error = error
+
+        while True:
+            block = self._queue.get()
+
+            if block is None:
+                break
+
+            # After an error keep draining the queue so that the
+            # producer never blocks on a full queue.
+            if self._error is None:
+                try:
+                    self._handle.write(block)
+                except BaseException as error:
+                    self._error = error
+
+    def write(self, block):
+
+        if self._error is not None:
+            raise self._error
+
+        self._queue.put(block)
+
+    def _finish(self):
+
+        self._queue.put(None)
+        self._thread.join()
+
+        if self._handle is not None:
+            try:
+                self._handle.close()
+            except BaseException as error:
+                if self._error is None:
+                    self._error = error
+
+    def _remove_tmp(self):
+
+        if self.atomic and os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def close(self):
+        """
+        Flush all queued blocks and move the output into place.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+            self._finish()
+
+            if self._error is not None:
+                raise self._error
+
+        except BaseException:
+            self._remove_tmp()
+            raise
+
+        if self.atomic:
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Stop writing and discard the temporary output.
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        try:
+            self._finish()
+        finally:
+            self._remove_tmp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+"""
+featureCounts-compatible counting of read 5′ ends.
+
+06.featurecounts.py counts the A-start alignment files of Step 05 in one
+process without the featureCounts binary. Step 05 can also count the
+A-start reads of an alignment file while it reads them (--gtf), instead
+of writing *.Astart files for Step 06 to read again.
+
+The features of the intergenic GTF (make_intergenic_gtf.py) are grouped
+into meta-features by gene_id, as featureCounts does, and every read is
+assigned by the genomic coordinate of its 5′ end (five_prime.py). As
+with featureCounts defaults, a read whose 5′ end falls into features of
+several genes is not counted (ambiguous).
+
+The tables are written in the featureCounts layout (Geneid, Chr, Start,
+End, Strand, Length, count) read by 07.merge_featurecounts_barcode.py,
+together with a .summary file.
+
+The FeatureIndex cuts every chromosome into elementary segments between
+feature boundaries and stores, per segment, the single meta-feature
+covering it (or NO_FEATURE / AMBIGUOUS). Batches of 5′-end coordinates
+are then assigned with one np.searchsorted() call and counted with
+np.bincount().
+"""
+
+import os
+import re
+
+import numpy as np
+
+
+ATTR_RE = re.compile(r'(\S+)\s+"([^"]+)"')
+
+# Reads buffered by a FeatureCounter before assigning them as a batch
+COUNT_BATCH = 100000
+
+# Segment assignments of a FeatureIndex that are not meta-features
+NO_FEATURE = -1
+AMBIGUOUS = -2
+
+# featureCounts summary categories written by Step 05
+SUMMARY_KEYS = (
+    "Assigned",
+    "Unassigned_Unmapped",
+    "Unassigned_NoFeatures",
+    "Unassigned_Ambiguity",
+)
+
+
+def read_features(gtf_path, feature_type="intergenic", attribute="gene_id"):
+    """
+    Read the <feature_type> features of a GTF file.
+
+    Returns (genes, features): genes lists the meta-feature ids in
+    annotation order; features maps every id to its
+    [(chrom, start, end, strand)] features (1-based, inclusive).
+    """
+
+    genes = []
+    features = {}
+
+    with open(gtf_path) as gtf:
+
+        for line in gtf:
+
+            if line.startswith("#"):
+                continue
+
+            cols = line.rstrip("\n").split("\t")
+
+            if len(cols) < 9 or cols[2] != feature_type:
+                continue
+
+            gene_id = dict(ATTR_RE.findall(cols[8])).get(attribute)
+
+            if gene_id is None:
+                continue
+
+            if gene_id not in features:
+                genes.append(gene_id)
+                features[gene_id] = []
+
+            features[gene_id].append(
+                (cols[0], int(cols[3]), int(cols[4]), cols[6])
+            )
+
+    return genes, features
+
+
+def meta_feature_length(features):
+    """
+    Number of reference bases covered by a meta-feature (overlapping
+    features counted once), as in the featureCounts Length column.
+    """
+
+    length = 0
+    chrom = None
+    covered_end = 0
+
+    for chrom_, start, end, _ in sorted(features):
+
+        if chrom_ != chrom:
+            chrom = chrom_
+            covered_end = 0
+
+        if end > covered_end:
+            length += end - max(start, covered_end + 1) + 1
+            covered_end = end
+
+    return length
+
+
+class FeatureIndex:
+    """
+    Per-chromosome segment index of the features of read_features()
+    for assigning 5′-end coordinates to meta-features.
+    """
+
+    def __init__(self, genes, features):
+
+        self.genes = genes
+        self.features = features
+
+        by_chrom = {}
+
+        for gene, gene_id in enumerate(genes):
+            for chrom, start, end, strand in features[gene_id]:
+                by_chrom.setdefault(chrom, []).append(
+                    (start, end, strand, gene)
+                )
+
+        # {chrom: (boundaries, {strand: assignments})}
+        self._segments = {
+            chrom: self._build_segments(intervals)
+            for chrom, intervals in by_chrom.items()
+        }
+
+    @staticmethod
+    def _build_segments(intervals):
+        """
+        Segment boundaries of one chromosome (segment i covers
+        boundaries[i] to boundaries[i + 1] - 1) and the assignment of
+        every segment for unstranded (None), "+" and "-" lookups.
+        """
+
+        boundaries = np.unique(
+            [start for start, _, _, _ in intervals]
+            + [end + 1 for _, end, _, _ in intervals]
+        )
+
+        covering = {
+            strand: [set() for _ in boundaries]
+            for strand in (None, "+", "-")
+        }
+
+        for start, end, strand, gene in intervals:
+
+            first, last = np.searchsorted(boundaries, [start, end + 1])
+
+            for segment in range(first, last):
+
+                covering[None][segment].add(gene)
+
+                if strand in covering:
+                    covering[strand][segment].add(gene)
+
+        assignments = {}
+
+        for strand, genes in covering.items():
+            assignments[strand] = np.array(
+                [
+                    next(iter(hits)) if len(hits) == 1
+                    else AMBIGUOUS if hits
+                    else NO_FEATURE
+                    for hits in genes
+                ],
+                dtype=np.int64
+            )
+
+        return boundaries, assignments
+
+    @classmethod
+    def from_gtf(cls, gtf_path, feature_type="intergenic"):
+
+        return cls(*read_features(gtf_path, feature_type))
+
+    def assign(self, chrom, positions, strand=None):
+        """
+        Meta-feature index (into genes), NO_FEATURE or AMBIGUOUS for
+        every 1-based position of the array <positions> on <chrom>.
+        With a <strand>, only features on that strand are considered.
+        """
+
+        positions = np.asarray(positions, dtype=np.int64)
+
+        if chrom not in self._segments:
+            return np.full(len(positions), NO_FEATURE, dtype=np.int64)
+
+        boundaries, assignments = self._segments[chrom]
+
+        segments = np.searchsorted(boundaries, positions, side="right") - 1
+
+        # Positions before the first boundary lie outside all features;
+        # the segment after the last boundary is never covered
+        return np.where(
+            segments >= 0,
+            assignments[strand][np.maximum(segments, 0)],
+            NO_FEATURE
+        )
+
+
+class FeatureCounter:
+    """
+    Meta-feature counts of 5′ ends and featureCounts-style summary.
+
+    <strandedness> follows featureCounts -s: 0 unstranded, 1 the read
+    strand must match the feature, 2 it must be opposite. Reads are
+    buffered per reference and strand and assigned in batches; call
+    flush() before reading <counts>.
+    """
+
+    def __init__(self, index, strandedness=0):
+
+        self.index = index
+        self.strandedness = strandedness
+        self.counts = np.zeros(len(index.genes), dtype=np.int64)
+        self.summary = dict.fromkeys(SUMMARY_KEYS, 0)
+
+        self._pending = {}
+        self._buffered = 0
+
+    def add(self, end):
+        """
+        Count one read by its FivePrimeEnd. Unmapped reads (no
+        reference) and reads without a 5′ end (None) are reported as
+        Unassigned_Unmapped.
+        """
+
+        if end is None or end.reference is None:
+            self.summary["Unassigned_Unmapped"] += 1
+            return
+
+        strand = None
+
+        if self.strandedness == 1:
+            strand = end.strand
+        elif self.strandedness == 2:
+            strand = "+" if end.strand == "-" else "-"
+
+        self._pending.setdefault((end.reference, strand), []).append(
+            end.position
+        )
+        self._buffered += 1
+
+        if self._buffered >= COUNT_BATCH:
+            self.flush()
+
+    def flush(self):
+        """
+        Assign and count the buffered reads.
+        """
+
+        for (chrom, strand), positions in self._pending.items():
+
+            assigned = self.index.assign(chrom, positions, strand)
+
+            features = assigned[assigned >= 0]
+
+            self.counts += np.bincount(
+                features,
+                minlength=len(self.counts)
+            )
+
+            self.summary["Assigned"] += len(features)
+            self.summary["Unassigned_NoFeatures"] += int(
+                np.count_nonzero(assigned == NO_FEATURE)
+            )
+            self.summary["Unassigned_Ambiguity"] += int(
+                np.count_nonzero(assigned == AMBIGUOUS)
+            )
+
+        self._pending = {}
+        self._buffered = 0
+
+
+def write_table(path, index, counts, column, command=""):
+    """
+    Write <counts> (one per meta-feature of <index>) as a featureCounts
+    table with the count column named <column>.
+    """
+
+    with open(path, "w") as out:
+
+        out.write(f"# Program:HELIOS 5prime counts; Command:{command}\n")
+        out.write(
+            "Geneid\tChr\tStart\tEnd\tStrand\tLength\t" + column + "\n"
+        )
+
+        for gene_id, count in zip(index.genes, counts):
+
+            features = index.features[gene_id]
+
+            out.write(
+                "\t".join(
+                    [
+                        gene_id,
+                        ";".join(chrom for chrom, _, _, _ in features),
+                        ";".join(str(start) for _, start, _, _ in features),
+                        ";".join(str(end) for _, _, end, _ in features),
+                        ";".join(strand for _, _, _, strand in features),
+                        str(meta_feature_length(features)),
+                        str(count),
+                    ]
+                ) + "\n"
+            )
+
+
+def write_summary(path, summary, column):
+    """
+    Write a featureCounts-style .summary file.
+    """
+
+    with open(path, "w") as out:
+
+        out.write(f"Status\t{column}\n")
+
+        for key in SUMMARY_KEYS:
+            out.write(f"{key}\t{summary[key]}\n")
+
+
+def write_counts(out_path, counter, column, command=""):
+    """
+    Write the table of a flushed FeatureCounter to <out_path> and its
+    summary to <out_path>.summary, each through a temporary file that is
+    moved into place.
+    """
+
+    summary_path = out_path + ".summary"
+
+    tmp_paths = [
+        os.path.join(
+            os.path.dirname(path),
+            ".tmp." + os.path.basename(path)
+        )
+        for path in (out_path, summary_path)
+    ]
+
+    try:
+
+        write_table(
+            tmp_paths[0],
+            counter.index,
+            counter.counts,
+            column,
+            command=command
+        )
+
+        write_summary(tmp_paths[1], counter.summary, column)
+
+        os.replace(tmp_paths[0], out_path)
+        os.replace(tmp_paths[1], summary_path)
+
+    finally:
+        for tmp_path in tmp_paths:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
@@ -1,6 +1,8 @@
 import pandas as pd
 from pathlib import Path
 
+from count_cube import find_cube, load_cube
+
 # Base paths
 base_path       = Path("/gpfs/bwfor/work/ws/hd_uv268-YZ817_eColiHelios_2/table_Astart")
 nad_genes_file  = base_path / "common_nad_genes_across_timepoints.csv"
@@ -19,6 +21,10 @@ all_genes = sorted(set(all_genes))
 
 print(f"Total unique genes from common file: {len(all_genes)}")
 
+# Step 07 count cube, if present; otherwise the per-timepoint CSVs are read
+cube_path = find_cube(base_path)
+cube = load_cube(cube_path) if cube_path else None
+
 # Loop through each timepoint and filter its counts CSV by the global gene list
 for i in range(1, 17):
     tp          = f"tp{i}"
@@ -26,12 +32,17 @@ for i in range(1, 17):
     input_file  = tp_dir / "merged_by_barcode_Astart_readCount.csv"
     output_file = tp_dir / "nad_genes_readCount.csv"
 
-    if not input_file.exists():
+    if cube is not None and cube.has_timepoint(tp):
+        df = cube.timepoint(tp).reset_index()
+
+    elif not input_file.exists():
         print(f"Warning: {input_file} not found. Skipping {tp}.")
         continue
 
-    # Load the counts (must contain a 'Geneid' column)
-    df = pd.read_csv(input_file, dtype=str)
+    else:
+        # Load the counts (must contain a 'Geneid' column)
+        df = pd.read_csv(input_file, dtype=str)
+
     if "Geneid" not in df.columns:
         print(f"Warning: 'Geneid' column not found in {input_file}. Skipping {tp}.")
         continue
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Transcript 5′ ends of Step 04 alignments for the A-start filter.
+
+The SEQ field of a SAM record is stored on the forward reference strand,
+so for reverse-strand alignments its first base is the 3′ end of the
+read. The E. coli stage also aligns with --local, and soft-clipped bases
+at the 5′ end of a read are not part of the aligned transcript. The
+functions below resolve, from FLAG, POS and CIGAR, the first aligned
+base of a read in read orientation and its genomic coordinate, so that
+the A-start test and later counting steps use the same 5′ end. Unmapped
+reads have no coordinate, only the first base of the read: A-start
+unmapped reads are kept and counted as Unassigned_Unmapped, as
+featureCounts does.
+"""
+
+import re
+from collections import namedtuple
+
+
+# SAM FLAG bits
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+
+# CIGAR operations consuming the reference
+REFERENCE_OPS = set("MDN=X")
+
+CIGAR_RE = re.compile(r"(\d+)([MIDNSHP=X])")
+
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+FivePrimeEnd = namedtuple(
+    "FivePrimeEnd",
+    ["reference", "position", "strand", "base"]
+)
+FivePrimeEnd.__doc__ = """
+5′ end of an aligned read: reference name, 1-based coordinate of the
+first aligned base of the read, strand ("+" or "-") and that base in
+read (transcript) orientation. Reference, position and strand are None
+for unmapped reads.
+"""
+
+
+def unmapped_five_prime_end(seq, reverse=False):
+    """
+    FivePrimeEnd of an unmapped read with sequence <seq>: the first base
+    of the read, which SEQ stores reverse-complemented if <reverse>
+    (FLAG 0x10) is set.
+    """
+
+    if reverse:
+        return FivePrimeEnd(
+            None,
+            None,
+            None,
+            seq[-1].upper().translate(COMPLEMENT)
+        )
+
+    return FivePrimeEnd(None, None, None, seq[0].upper())
+
+
+def sam_five_prime_end(cols):
+    """
+    FivePrimeEnd of a SAM record split into its columns (at least the
+    first ten), or None for records without SEQ.
+    """
+
+    flag = int(cols[1])
+    seq = cols[9]
+
+    if seq == "*":
+        return None
+
+    if flag & FLAG_UNMAPPED or cols[5] == "*":
+        return unmapped_five_prime_end(seq, flag & FLAG_REVERSE)
+
+    ops = [(int(length), op) for length, op in CIGAR_RE.findall(cols[5])]
+
+    # Hard clips are not part of SEQ
+    ops = [(length, op) for length, op in ops if op != "H"]
+
+    if not ops:
+        return None
+
+    position = int(cols[3])
+
+    if flag & FLAG_REVERSE:
+
+        clip = ops[-1][0] if ops[-1][1] == "S" else 0
+
+        span = sum(
+            length for length, op in ops if op in REFERENCE_OPS
+        )
+
+        return FivePrimeEnd(
+            cols[2],
+            position + span - 1,
+            "-",
+            seq[len(seq) - clip - 1].upper().translate(COMPLEMENT)
+        )
+
+    clip = ops[0][0] if ops[0][1] == "S" else 0
+
+    return FivePrimeEnd(cols[2], position, "+", seq[clip].upper())
+
+
+def five_prime_end(read):
+    """
+    FivePrimeEnd of a pysam AlignedSegment, or None for reads without a
+    stored sequence.
+    """
+
+    seq = read.query_sequence
+
+    if not seq:
+        return None
+
+    if read.is_unmapped or not read.cigartuples:
+        return unmapped_five_prime_end(seq, read.is_reverse)
+
+    if read.is_reverse:
+
+        # query_alignment_end excludes the trailing soft clip
+        return FivePrimeEnd(
+            read.reference_name,
+            read.reference_end,
+            "-",
+            seq[read.query_alignment_end - 1].upper().translate(COMPLEMENT)
+        )
+
+    return FivePrimeEnd(
+        read.reference_name,
+        read.reference_start + 1,
+        "+",
+        seq[read.query_alignment_start].upper()
+    )
+
+
+def is_a_start(end):
+    """
+    True if a FivePrimeEnd (or None) starts with an A.
+    """
+
+    return end is not None and end.base == "A"
@@ -3,15 +3,24 @@ import os
 import glob
 import argparse
 import matplotlib.pyplot as plt
+import pysam
 from collections import Counter
 
 def build_tss_counts(sam_files):
     """
-    Build per-reference TSS counts (position of alignment start) from SAM files.
+    Build per-reference TSS counts (position of alignment start) from SAM or BAM files.
     Returns a dict: { rname: Counter({pos: count, ...}) }.
     """
     tss = {}
     for path in sam_files:
+        if path.endswith(".bam"):
+            with pysam.AlignmentFile(path, "rb", check_sq=False) as bam:
+                for read in bam.fetch(until_eof=True):
+                    rname = read.reference_name or "*"
+                    pos = read.reference_start + 1  # 1-based, 0 if unmapped
+                    cnt = tss.setdefault(rname, Counter())
+                    cnt[pos] += 1
+            continue
         with open(path, "r") as f:
             for line in f:
                 if line.startswith("@"):
@@ -52,7 +61,8 @@ def plot_tss(tss_counts, outdir, bc, tp):
         plt.tight_layout()
         plt.savefig(outpath)
         plt.close()
-      def main():
+
+def main():
     parser = argparse.ArgumentParser(
         description="Plot TSS distributions for each barcode (bc01?~@~Sbc08) and "
                     "timepoint (tp1?~@~Stp16) from SAM files.")
@@ -67,7 +77,7 @@ def plot_tss(tss_counts, outdir, bc, tp):
     for tp in timepoints:
         for bc in barcodes:
             pattern = os.path.join(sam_dir, f"{bc}*{tp}_*spike*.sam")
-            sam_files = glob.glob(pattern)
+            sam_files = glob.glob(pattern) + glob.glob(pattern[:-4] + ".bam")
             if not sam_files:
                 continue
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+"""
+Fused preprocessing engine for HELIOS NAD-Seq.
+
+Runs the per-read work of Steps 01-03 on one block of raw R1/R2 reads:
+
+    1. demultiplexing by the R2 barcode, UMI into the read name and
+       removal of the barcode adapter (demux_engine.py)
+    2. leading G/N trim of R1 (Step 02, trim_engine.py)
+    3. adapter clipping and SLIDINGWINDOW quality trimming of both
+       reads (Step 03)
+    4. MINLEN filter, splitting the pairs into paired and unpaired
+       reads like Trimmomatic PE
+"""
+
+import numpy as np
+
+from demux_engine import (
+    BARCODES,
+    UNKNOWN,
+    add_demux_stats,
+    demux_block,
+    new_demux_stats,
+)
+from trim_engine import (
+    MIN_LENGTH,
+    SLIDING_WINDOW,
+    SLIDING_WINDOW_QUALITY,
+    add_trim_stats,
+    new_pair_histograms,
+    new_quality_stats,
+    new_trim_stats,
+    quality_trim_pair_block,
+    trim_5prime_block,
+)
+
+
+def new_preprocess_stats():
+    return {
+        "demux": new_demux_stats(),
+        "5prime": new_trim_stats(),
+        "quality": new_quality_stats(),
+        "histograms": {
+            barcode: new_pair_histograms(r1_trimmed_5prime=True)
+            for barcode in BARCODES
+        },
+    }
+
+
+def add_preprocess_stats(stats, other):
+    add_demux_stats(stats["demux"], other["demux"])
+    add_trim_stats(stats["5prime"], other["5prime"])
+    add_trim_stats(stats["quality"], other["quality"])
+    add_trim_stats(stats["histograms"], other["histograms"])
+
+
+def preprocess_block(r1_lines, r2_lines, lookup, stats,
+                     window=SLIDING_WINDOW,
+                     threshold=SLIDING_WINDOW_QUALITY,
+                     min_length=MIN_LENGTH,
+                     clip_adapters=True):
+    """
+    Preprocess a record-aligned block of raw R1/R2 lines (bytes).
+
+    Returns {barcode: {output: lines}} with the outputs of
+    trim_engine.OUTPUTS. Pairs without a recognised barcode are counted
+    and dropped.
+    Counters are added to <stats>, trimming histograms per barcode to
+    stats["histograms"].
+    """
+
+    demuxed = demux_block(
+        r1_lines,
+        r2_lines,
+        lookup,
+        stats["demux"]
+    )
+
+    output = {}
+
+    for barcode, (r1_out, r2_out) in demuxed.items():
+
+        if barcode == UNKNOWN:
+            continue
+
+        untrimmed_lengths = np.array(
+            [len(line.strip()) for line in r1_out[1::4]],
+            dtype=np.int64
+        )
+
+        trim_5prime_block(r1_out, stats["5prime"])
+
+        trimmed_5prime = untrimmed_lengths - np.array(
+            [len(line) - 1 for line in r1_out[1::4]],
+            dtype=np.int64
+        )
+
+        output[barcode] = quality_trim_pair_block(
+            r1_out,
+            r2_out,
+            stats["quality"],
+            window=window,
+            threshold=threshold,
+            min_length=min_length,
+            clip_adapters=clip_adapters,
+            histograms=stats["histograms"][barcode],
+            r1_trimmed_5prime=trimmed_5prime
+        )
+
+    return output
@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+
+"""
+Bytes-mode read trimming engine for HELIOS NAD-Seq.
+
+Reads are handled as lists of raw FASTQ lines (bytes, four lines per
+record) so that large blocks can be trimmed without decoding and without
+the regex machinery.
+"""
+
+import json
+from collections import Counter
+
+import numpy as np
+
+
+# Bases removed from the 5' end of the forward read (regex ^[GN]*)
+FORWARD_5PRIME_BASES = b"GN"
+
+# Reads shorter than this after trimming are reported as short
+SHORT_READ_LENGTH = 18
+
+
+def new_trim_stats():
+    return {
+        "total_reads": 0,
+        "short_reads": 0,
+        "forward_trimmed_5prime": 0,
+        "forward_tot_length": 0,
+    }
+
+
+def add_trim_stats(stats, other):
+    """
+    Add the counters of <other> to <stats>. Nested dictionaries are
+    added recursively and Counter histograms are merged.
+    """
+
+    for key, value in other.items():
+        if isinstance(value, dict) and not isinstance(value, Counter):
+            add_trim_stats(stats[key], value)
+        else:
+            stats[key] += value
+
+
+def gn_prefix_length(sequence):
+    """
+    Length of the leading G/N run of a sequence (bytes).
+    """
+
+    return len(sequence) - len(sequence.lstrip(FORWARD_5PRIME_BASES))
+
+
+def trim_5prime_block(lines, stats, trim_5prime=True):
+    """
+    Trim the leading G/N run from every record of a block of FASTQ lines.
+
+    <lines> is a list of bytes lines, four per record; sequence and
+    quality lines are replaced in place. The result is byte-identical to
+    the line-based regex trimming: trimmed sequence and quality lines are
+    stripped of surrounding whitespace and terminated with a newline.
+
+    Counters are added to <stats>. Returns <lines>.
+    """
+
+    sequences = [line.strip() for line in lines[1::4]]
+
+    stats["total_reads"] += len(sequences)
+
+    if trim_5prime:
+
+        trimmed = [
+            sequence.lstrip(FORWARD_5PRIME_BASES)
+            for sequence in sequences
+        ]
+
+        qualities = [
+            quality.strip()[len(sequence) - len(kept):]
+            for quality, sequence, kept in zip(
+                lines[3::4],
+                sequences,
+                trimmed
+            )
+        ]
+
+        stats["forward_trimmed_5prime"] += sum(
+            len(sequence) != len(kept)
+            for sequence, kept in zip(sequences, trimmed)
+        )
+
+        lines[1::4] = [kept + b"\n" for kept in trimmed]
+        lines[3::4] = [quality + b"\n" for quality in qualities]
+
+        sequences = trimmed
+
+    lengths = [len(sequence) for sequence in sequences]
+
+    stats["forward_tot_length"] += sum(lengths)
+    stats["short_reads"] += sum(
+        length < SHORT_READ_LENGTH
+        for length in lengths
+    )
+
+    return lines
+
+
+# ------------------------------------------------------------
+# Adapter and quality trimming (Step 03)
+# ------------------------------------------------------------
+
+# Start of the TruSeq adapters as seen on read-through; shared by the
+# reverse complements of both TruSeq3-PE prefix sequences
+ADAPTER_JUNCTION = b"AGATCGGAAGAGC"
+
+# Shortest partial adapter clipped at the very end of a read
+ADAPTER_MIN_OVERLAP = 8
+
+# SLIDINGWINDOW:4:20 MINLEN:18, Phred+33
+SLIDING_WINDOW = 4
+SLIDING_WINDOW_QUALITY = 20
+MIN_LENGTH = 18
+PHRED_OFFSET = 33
+
+
+def adapter_clip_length(sequence, adapter=ADAPTER_JUNCTION,
+                        min_overlap=ADAPTER_MIN_OVERLAP):
+    """
+    Length of a sequence (bytes, no newline) to keep in front of the
+    adapter: the first full occurrence, or a partial adapter of at least
+    <min_overlap> bases at the end of the read.
+    """
+
+    position = sequence.find(adapter)
+
+    if position != -1:
+        return position
+
+    for overlap in range(len(adapter) - 1, min_overlap - 1, -1):
+        if sequence.endswith(adapter[:overlap]):
+            return len(sequence) - overlap
+
+    return len(sequence)
+
+
+def sliding_window_length(quality, window=SLIDING_WINDOW,
+                          threshold=SLIDING_WINDOW_QUALITY,
+                          offset=PHRED_OFFSET):
+    """
+    Length of a read to keep after Trimmomatic-style sliding window
+    trimming of its quality string (bytes, no newline).
+
+    The read is scanned from the 5' end and cut at the first window of
+    <window> bases whose average quality is below <threshold>; trailing
+    bases below <threshold> are then removed. Reads shorter than the
+    window, or whose first window fails, are dropped (length 0).
+    """
+
+    qualities = [value - offset for value in quality]
+
+    if len(qualities) < window:
+        return 0
+
+    required = threshold * window
+    total = sum(qualities[:window])
+
+    if total < required:
+        return 0
+
+    keep = len(qualities)
+
+    for i in range(len(qualities) - window):
+        total += qualities[i + window] - qualities[i]
+
+        if total < required:
+            keep = i + window
+            break
+
+    while keep > 0 and qualities[keep - 1] < threshold:
+        keep -= 1
+
+    return keep
+
+
+def sliding_window_lengths(qualities, window=SLIDING_WINDOW,
+                           threshold=SLIDING_WINDOW_QUALITY,
+                           offset=PHRED_OFFSET):
+    """
+    Vectorised sliding_window_length for a list of quality strings
+    (bytes, no newline).
+
+    The qualities are packed into one padded uint8 matrix, the window
+    sums are computed for all reads at once, and the cut position of
+    every read is taken from the first failing window. Returns an int
+    array of lengths to keep, identical to sliding_window_length.
+    """
+
+    n_reads = len(qualities)
+
+    lengths = np.fromiter(
+        (len(quality) for quality in qualities),
+        dtype=np.int64,
+        count=n_reads
+    )
+
+    max_length = int(lengths.max()) if n_reads else 0
+
+    if max_length < window:
+        return np.zeros(n_reads, dtype=np.int64)
+
+    # Padding with quality 0 never passes a window or the threshold
+    padding = bytes((offset,))
+
+    matrix = np.frombuffer(
+        b"".join(quality.ljust(max_length, padding) for quality in qualities),
+        dtype=np.uint8
+    ).reshape(n_reads, max_length)
+
+    scores = matrix.astype(np.int16) - offset
+
+    n_windows = max_length - window + 1
+
+    window_sums = scores[:, :n_windows].copy()
+
+    for i in range(1, window):
+        window_sums += scores[:, i:i + n_windows]
+
+    starts = np.arange(n_windows)
+
+    failed = (
+        (window_sums < threshold * window)
+        & (starts < (lengths - window + 1)[:, None])
+    )
+
+    # Cut at the first failing window after the first one; with a
+    # single window there is nothing to cut after it
+    if n_windows > 1:
+
+        later_failed = failed[:, 1:]
+        has_cut = later_failed.any(axis=1)
+
+        keep = np.where(
+            has_cut,
+            later_failed.argmax(axis=1) + window,
+            lengths
+        )
+
+    else:
+        keep = lengths.copy()
+
+    keep[failed[:, 0] | (lengths < window)] = 0
+
+    # Remove trailing bases below the threshold
+    good = (
+        (scores >= threshold)
+        & (np.arange(max_length) < keep[:, None])
+    )
+
+    last_good = max_length - good[:, ::-1].argmax(axis=1)
+
+    return np.where(good.any(axis=1), last_good, 0)
+
+
+# Reasons for dropping a read in the trimming histograms
+DROP_REASONS = ("input_too_short", "adapter", "quality")
+
+
+def new_trim_histograms(trimmed_5prime=False):
+    """
+    In-memory replacement for the per-read Trimmomatic trimlog of one
+    read (R1 or R2): read counts per surviving length, per number of
+    bases trimmed at the 3' end, and per reason a read was dropped.
+
+    With <trimmed_5prime>, also per number of bases trimmed at the 5'
+    end by Step 02, for reads whose 5' trimming is measured.
+    """
+
+    histograms = {"length": Counter()}
+
+    if trimmed_5prime:
+        histograms["trimmed_5prime"] = Counter()
+
+    histograms["trimmed_3prime"] = Counter()
+    histograms["dropped"] = Counter()
+
+    return histograms
+
+
+def _counts(values):
+    values, counts = np.unique(values, return_counts=True)
+    return Counter(dict(zip(values.tolist(), counts.tolist())))
+
+
+def add_trim_histograms(histograms, input_lengths, clipped_lengths, keep,
+                        min_length=MIN_LENGTH, trimmed_5prime=None):
+    """
+    Add one block of reads to <histograms> (see new_trim_histograms).
+
+    <input_lengths>, <clipped_lengths> and <keep> are int arrays with
+    the read lengths before trimming, after adapter clipping and after
+    quality trimming; <trimmed_5prime> holds the bases already removed
+    from the 5' end upstream (Step 02), if measured. It requires
+    histograms made with new_trim_histograms(trimmed_5prime=True).
+    """
+
+    surviving = keep >= min_length
+
+    histograms["length"] += _counts(keep[surviving])
+
+    if trimmed_5prime is not None:
+        histograms["trimmed_5prime"] += _counts(trimmed_5prime)
+
+    histograms["trimmed_3prime"] += _counts(input_lengths - keep)
+
+    input_too_short = input_lengths < min_length
+    adapter = ~input_too_short & (clipped_lengths < min_length)
+    quality = ~surviving & ~input_too_short & ~adapter
+
+    for reason, selected in zip(
+        DROP_REASONS,
+        (input_too_short, adapter, quality)
+    ):
+        dropped = int(selected.sum())
+
+        if dropped:
+            histograms["dropped"][reason] += dropped
+
+
+def quality_trim_block(lines, window=SLIDING_WINDOW,
+                       threshold=SLIDING_WINDOW_QUALITY,
+                       clip_adapters=True, histograms=None,
+                       min_length=MIN_LENGTH, trimmed_5prime=None):
+    """
+    Adapter-clip and quality-trim every record of a block of FASTQ
+    lines (bytes, four per record) in place.
+
+    If <histograms> is given, the block is added to it with
+    add_trim_histograms, using <min_length> to classify dropped reads.
+
+    Returns an int array with the remaining length of each read.
+    """
+
+    sequences = [line.rstrip(b"\r\n") for line in lines[1::4]]
+    qualities = [line.rstrip(b"\r\n") for line in lines[3::4]]
+
+    if histograms is not None:
+        input_lengths = np.fromiter(
+            (len(quality) for quality in qualities),
+            dtype=np.int64,
+            count=len(qualities)
+        )
+
+    if clip_adapters:
+        qualities = [
+            quality[:adapter_clip_length(sequence)]
+            for sequence, quality in zip(sequences, qualities)
+        ]
+
+    keep = sliding_window_lengths(
+        qualities,
+        window=window,
+        threshold=threshold
+    )
+
+    if histograms is not None:
+        clipped_lengths = np.fromiter(
+            (len(quality) for quality in qualities),
+            dtype=np.int64,
+            count=len(qualities)
+        )
+
+        add_trim_histograms(
+            histograms,
+            input_lengths,
+            clipped_lengths,
+            keep,
+            min_length=min_length,
+            trimmed_5prime=trimmed_5prime
+        )
+
+    kept = keep.tolist()
+
+    lines[1::4] = [
+        sequence[:length] + b"\n"
+        for sequence, length in zip(sequences, kept)
+    ]
+    lines[3::4] = [
+        quality[:length] + b"\n"
+        for quality, length in zip(qualities, kept)
+    ]
+
+    return keep
+
+
+# Output streams of paired-end trimming, in Step 03 naming order
+OUTPUTS = ("R1_paired", "R1_unpaired", "R2_paired", "R2_unpaired")
+
+
+def new_quality_stats():
+    return {
+        "input_pairs": 0,
+        "both_surviving": 0,
+        "r1_only_surviving": 0,
+        "r2_only_surviving": 0,
+        "dropped": 0,
+    }
+
+
+def new_pair_histograms(r1_trimmed_5prime=False):
+    """
+    Trimming histograms of R1 and R2 (new_trim_histograms). Only R1 is
+    trimmed by Step 02; <r1_trimmed_5prime> adds its 5' histogram when
+    the trim lengths are passed to quality_trim_pair_block.
+    """
+
+    return {
+        "R1": new_trim_histograms(trimmed_5prime=r1_trimmed_5prime),
+        "R2": new_trim_histograms(),
+    }
+
+
+def quality_trim_pair_block(r1_lines, r2_lines, stats,
+                            window=SLIDING_WINDOW,
+                            threshold=SLIDING_WINDOW_QUALITY,
+                            min_length=MIN_LENGTH,
+                            clip_adapters=True, histograms=None,
+                            r1_trimmed_5prime=None):
+    """
+    Trimmomatic PE on a record-aligned block of R1/R2 lines (bytes).
+
+    Both reads are trimmed with quality_trim_block and filtered by
+    <min_length>; pairs are split into the outputs of OUTPUTS like
+    Trimmomatic. Returns {output: lines}. Counters are added to <stats>
+    and, if given, to the "R1"/"R2" entries of <histograms>
+    (new_pair_histograms).
+    """
+
+    if histograms is None:
+        histograms = {"R1": None, "R2": None}
+
+    r1_keep = quality_trim_block(
+        r1_lines,
+        window=window,
+        threshold=threshold,
+        clip_adapters=clip_adapters,
+        histograms=histograms["R1"],
+        min_length=min_length,
+        trimmed_5prime=r1_trimmed_5prime
+    ) >= min_length
+
+    r2_keep = quality_trim_block(
+        r2_lines,
+        window=window,
+        threshold=threshold,
+        clip_adapters=clip_adapters,
+        histograms=histograms["R2"],
+        min_length=min_length
+    ) >= min_length
+
+    output = {name: [] for name in OUTPUTS}
+
+    targets = (
+        (r1_keep & r2_keep, r1_lines, "R1_paired"),
+        (r1_keep & r2_keep, r2_lines, "R2_paired"),
+        (r1_keep & ~r2_keep, r1_lines, "R1_unpaired"),
+        (~r1_keep & r2_keep, r2_lines, "R2_unpaired"),
+    )
+
+    for selected, lines, name in targets:
+        for i in np.flatnonzero(selected).tolist():
+            output[name].extend(lines[4 * i:4 * i + 4])
+
+    both = int((r1_keep & r2_keep).sum())
+    r1_only = int((r1_keep & ~r2_keep).sum())
+    r2_only = int((~r1_keep & r2_keep).sum())
+
+    stats["input_pairs"] += len(r1_keep)
+    stats["both_surviving"] += both
+    stats["r1_only_surviving"] += r1_only
+    stats["r2_only_surviving"] += r2_only
+    stats["dropped"] += len(r1_keep) - both - r1_only - r2_only
+
+    return output
+
+
+def write_trim_report(json_path, tsv_path, sample, histograms,
+                      stats=None, settings=None):
+    """
+    Write the trimming histograms of one sample (new_pair_histograms)
+    as JSON, together with per-read totals, <stats> and <settings>, and
+    as a long TSV table (read, histogram, value, reads).
+    """
+
+    report = {
+        "sample": sample,
+        "settings": settings or {},
+        "stats": stats or {},
+        "reads": {
+            read: {
+                "input": sum(read_histograms["trimmed_3prime"].values()),
+                "surviving": sum(read_histograms["length"].values()),
+                "dropped": sum(read_histograms["dropped"].values()),
+            }
+            for read, read_histograms in histograms.items()
+        },
+        "histograms": {
+            read: {
+                name: {
+                    str(value): count
+                    for value, count in sorted(counts.items())
+                }
+                for name, counts in read_histograms.items()
+            }
+            for read, read_histograms in histograms.items()
+        },
+    }
+
+    with open(json_path, "w") as fout:
+        json.dump(report, fout, indent=2)
+        fout.write("\n")
+
+    with open(tsv_path, "w") as fout:
+
+        fout.write("read\thistogram\tvalue\treads\n")
+
+        for read, read_histograms in histograms.items():
+            for name, counts in read_histograms.items():
+                for value, count in sorted(counts.items()):
+                    fout.write(f"{read}\t{name}\t{value}\t{count}\n")
@@ -0,0 +1,114 @@
+"""
+Regression tests for the A-start counting of
+scripts/05.filter_sam_by_A_start.py --gtf and scripts/06.featurecounts.py.
+
+The expected numbers are those of the baseline Steps 05+06: the A-start
+SAM file counted per read by featureCounts 2.0.6 -p (without
+--countReadPairs).
+"""
+
+import importlib.util
+import os
+import sys
+
+SCRIPTS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "scripts"
+)
+
+sys.path.insert(0, SCRIPTS)
+
+from feature_counts import FeatureCounter, FeatureIndex  # noqa: E402
+
+
+def load_script(name):
+
+    spec = importlib.util.spec_from_file_location(
+        name.replace(".", "_"),
+        os.path.join(SCRIPTS, name + ".py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+step05 = load_script("05.filter_sam_by_A_start")
+step06 = load_script("06.featurecounts")
+
+
+INDEX = FeatureIndex(
+    ["g1", "g2"],
+    {
+        "g1": [("chr", 1, 100, "+")],
+        "g2": [("chr", 101, 200, "+")],
+    }
+)
+
+SEQ = "ACGTACGTAC"
+REVERSE_SEQ = "CGTACGTACT"
+
+RECORDS = [
+    # r1: read 1 fails (C at its 5' end), read 2 passes (reverse, T)
+    ("r1", 99, 10, "10M", 150, "C" + SEQ[1:]),
+    ("r1", 147, 150, "10M", 10, REVERSE_SEQ),
+    # r2: both mates pass
+    ("r2", 99, 20, "10M", 60, SEQ),
+    ("r2", 147, 60, "10M", 20, REVERSE_SEQ),
+    # r3: read 1 passes, read 2 fails
+    ("r3", 99, 120, "10M", 170, SEQ),
+    ("r3", 147, 170, "10M", 120, "A" + REVERSE_SEQ[1:-1] + "G"),
+    # r4: read 1 unmapped and A-start, read 2 fails
+    ("r4", 69, 30, "*", 30, SEQ),
+    ("r4", 137, 30, "10M", 30, "C" + SEQ[1:]),
+]
+
+
+def write_sam(path, records):
+
+    with open(path, "w") as out:
+
+        out.write("@HD\tVN:1.6\tSO:unsorted\n")
+        out.write("@SQ\tSN:chr\tLN:1000\n")
+
+        for name, flag, pos, cigar, mate_pos, seq in records:
+            out.write(
+                "\t".join(
+                    [
+                        name, str(flag), "chr", str(pos), "42", cigar,
+                        "=", str(mate_pos), "0", seq, "I" * len(seq),
+                    ]
+                ) + "\n"
+            )
+
+
+def test_read_2_counted_when_read_1_fails(tmp_path):
+
+    sam_path = str(tmp_path / "bc01_tp1_eColi_paired.sam")
+    write_sam(sam_path, RECORDS)
+
+    total, retained, counter = step05.count_alignments_by_first_base(
+        sam_path,
+        INDEX
+    )
+
+    assert (total, retained) == (8, 5)
+    assert counter.counts.tolist() == [2, 2]
+    assert counter.summary["Assigned"] == 4
+    assert counter.summary["Unassigned_Unmapped"] == 1
+
+
+def test_fused_counts_match_astart_file_counts(tmp_path):
+
+    sam_path = str(tmp_path / "bc01_tp1_eColi_paired.sam")
+    astart_path = str(tmp_path / "bc01_tp1_eColi_paired.Astart.sam")
+    write_sam(sam_path, RECORDS)
+
+    assert step05.filter_sam_by_first_base(sam_path, astart_path) == (8, 5)
+
+    _, _, fused = step05.count_alignments_by_first_base(sam_path, INDEX)
+
+    counter = FeatureCounter(INDEX)
+
+    assert step06.count_alignment_file(astart_path, counter) == 5
+    assert counter.counts.tolist() == fused.counts.tolist()
+    assert counter.summary == fused.summary
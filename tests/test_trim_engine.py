@@ -0,0 +1,69 @@
+"""
+Regression tests for the vectorised sliding window trimmer and the
+trimming histograms of scripts/trim_engine.py.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+)
+
+from trim_engine import (  # noqa: E402
+    SLIDING_WINDOW,
+    new_pair_histograms,
+    new_quality_stats,
+    quality_trim_pair_block,
+    sliding_window_length,
+    sliding_window_lengths,
+)
+
+
+def test_single_window_batch():
+
+    assert sliding_window_lengths([b"IIII"]).tolist() == [4]
+
+
+def test_batches_not_longer_than_window():
+
+    batches = [
+        [b"III"],
+        [b"IIII", b"III", b""],
+        [b"#III", b"II#I", b"III#"],
+        [b"I" * (SLIDING_WINDOW - 1), b"I" * SLIDING_WINDOW],
+    ]
+
+    for qualities in batches:
+
+        assert sliding_window_lengths(qualities).tolist() == [
+            sliding_window_length(quality) for quality in qualities
+        ]
+
+
+def test_5prime_histogram_only_where_measured():
+
+    def block():
+        return [b"@r1\n", b"A" * 30 + b"\n", b"+\n", b"I" * 30 + b"\n"]
+
+    histograms = new_pair_histograms()
+
+    quality_trim_pair_block(
+        block(), block(), new_quality_stats(), histograms=histograms
+    )
+
+    assert "trimmed_5prime" not in histograms["R1"]
+    assert "trimmed_5prime" not in histograms["R2"]
+
+    histograms = new_pair_histograms(r1_trimmed_5prime=True)
+
+    quality_trim_pair_block(
+        block(), block(), new_quality_stats(), histograms=histograms,
+        r1_trimmed_5prime=np.array([3])
+    )
+
+    assert histograms["R1"]["trimmed_5prime"] == {3: 1}
+    assert "trimmed_5prime" not in histograms["R2"]